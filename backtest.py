@@ -0,0 +1,321 @@
+import argparse
+import glob
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from calibration import load_calibrated
+from data_quality import excluded_runs
+from dgo_store import read_compiled
+from filters import parse_filter
+from run_features import cumulative_energy
+from threshold_index import SIGNAL_DIRECTIONS
+"""
+EXIT RULE BACKTESTING -- replay candidate exit rules over every compiled dgo run
+
+A rule is a combination of:
+    sht_threshold - the SHT40 delta has come back up to this value after dropping below it (None to not use the SHT40)
+    rh_threshold  - the RH delta has come back down to this value after rising above it (None to not use the RH)
+    combine       - "and"/"or" of the two conditions when both are used
+    min_elapsed   - don't stop before this many minutes into the run
+    dwell         - the condition has to hold this many minutes in a row before stopping
+
+Each rule is replayed on every run to find where DGO would have been stopped, how much shorter the run would have been
+("Diff. in Time"), whether the rule never fired ("missed"), the Ohaus water weight left at the stop time, and the energy
+stopping there would have saved (see run_features). Rules can be ranked by the minutes or the kWh saved over the fleet.
+The deltas can be smoothed by a causal filter first (--smoothing, see filters), which is what a live detector would see.
+The grid of rules is split across a process pool, each worker loads the runs once. Runs the data quality report marks
+bad (see data_quality) are left out. The deltas are calibrated (see calibration) unless --no-calibration is given, the
+same default as the dashboards and the report, so the thresholds ranked here are the ones users see there.
+"""
+
+RULE_COLUMNS = ["sht_threshold", "rh_threshold", "combine", "min_elapsed", "dwell"]
+BACKTEST_CHANNELS = ["Intake SHT40", "Exhaust SHT40", "Intake Air RH", "Exhaust RH", "Ohaus Water Weight", "Watts"]
+
+'''
+desc: forward fill the NaN samples of a series (dropout rows hold the last valid value so they don't break a dwell)
+input: x - numpy array
+output: filled copy (leading NaNs stay NaN)
+'''
+def ffill(x):
+    idx = np.where(np.isnan(x), 0, np.arange(len(x)))
+    np.maximum.accumulate(idx, out=idx)
+    filled = x[idx]
+    return filled
+
+'''
+desc: load the arrays a backtest needs from a compiled run
+input: filepath - compiled dgo csv
+       smoothing - filter spec the deltas are smoothed with (see filters), None for the raw deltas
+       calibrated - apply the sensor calibration (see calibration.load_calibrated())
+output: dict of name, time [min], SHT40 delta, RH delta, water weight (NaN filled) and cumulative energy [Wh]
+'''
+def load_backtest_run(filepath, smoothing=None, calibrated=True):
+    if calibrated:
+        dgo_data = load_calibrated(filepath, BACKTEST_CHANNELS)
+    else:
+        dgo_data = read_compiled(filepath, BACKTEST_CHANNELS)
+    t_min = dgo_data["time"].to_numpy() / 60
+    smooth = parse_filter(smoothing)
+    smooth = smooth.batch if smooth is not None else (lambda x: x)
+    return {"name": os.path.basename(filepath)[:-len(".csv")],
+            "t": t_min,
+            "t_end": t_min[-1],
+            "SHT40": ffill(smooth((dgo_data["Exhaust SHT40"] - dgo_data["Intake SHT40"]).to_numpy())),
+            "RH": ffill(smooth((dgo_data["Exhaust RH"] - dgo_data["Intake Air RH"]).to_numpy())),
+            "water": ffill(dgo_data["Ohaus Water Weight"].to_numpy()),
+            "energy": cumulative_energy(t_min, dgo_data["Watts"].to_numpy())}
+
+'''
+desc: build the grid of rules from lists of values for each parameter
+input: sht_thresholds, rh_thresholds - lists of thresholds (use [None] to leave a signal out)
+       combines - list of "and"/"or"
+       min_elapsed - list of minimum times [min]
+       dwells - list of dwell times [min]
+output: list of rule dicts (rules that only differ in combine are only kept once when a signal is left out)
+'''
+def rule_grid(sht_thresholds=(None,), rh_thresholds=(None,), combines=("and",), min_elapsed=(0,), dwells=(0,)):
+    rules = []
+    seen = set()
+    for sht, rh, combine, t_min, dwell in itertools.product(sht_thresholds, rh_thresholds, combines, min_elapsed,
+                                                             dwells):
+        if (sht is None) and (rh is None):
+            continue
+        if (sht is None) or (rh is None):
+            combine = "and"  # doesn't matter with one signal
+        rule = (sht, rh, combine, t_min, dwell)
+        if rule not in seen:
+            seen.add(rule)
+            rules.append(dict(zip(RULE_COLUMNS, rule)))
+    return rules
+
+'''
+desc: condition of a single signal at every sample for a vector of thresholds, in the exit direction of the signal. the
+delta has to have been on the other side of the threshold first, otherwise e.g. an SHT40 threshold below the starting
+delta would be met at t=0
+input: run - output of load_backtest_run()
+       signal - "SHT40" or "RH"
+       thresholds - array of thresholds
+output: boolean array (thresholds x samples)
+'''
+def signal_met(run, signal, thresholds):
+    delta = run[signal]
+    x = np.asarray(thresholds, dtype=np.float64)[:, None]
+    if SIGNAL_DIRECTIONS[signal] == "up":
+        return (delta >= x) & (np.fmin.accumulate(delta) < x)
+    return (delta <= x) & (np.fmax.accumulate(delta) > x)
+
+'''
+desc: first sample where each (min_elapsed, dwell) pair stops the run for one condition mask. the mask is reduced to its
+streaks once, so each pair only costs a search over the streaks instead of a pass over the run
+input: t - sample times [min]
+       met - boolean condition at every sample
+       min_elapsed, dwell - arrays of the rule parameters [min]
+output: index of the stop sample for each pair (-1 if it never stops)
+'''
+def _stop_from_mask(t, met, min_elapsed, dwell):
+    edges = np.diff(np.concatenate(([0], met.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)  # first sample of each streak
+    ends = np.flatnonzero(edges == -1) - 1  # last sample of each streak
+    if len(starts) == 0:
+        return np.full(len(min_elapsed), -1)
+
+    # streaks are cut at the first sample after min_elapsed (pairs x streaks)
+    k_min = np.searchsorted(t, min_elapsed, side="left")[:, None]
+    start = np.maximum(starts[None, :], k_min)
+    k = np.searchsorted(t, t[np.minimum(start, len(t) - 1)] + dwell[:, None], side="left")
+    stops = (start <= ends[None, :]) & (k <= ends[None, :])
+    first = np.argmax(stops, axis=1)
+    return np.where(stops[np.arange(len(first)), first], k[np.arange(len(first)), first], -1)
+
+'''
+desc: group the rules that share their thresholds and combine, so they can share their condition mask
+input: rules - dataframe of rules (columns of RULE_COLUMNS, NaN thresholds for unused signals)
+output: dict of the thresholds used, the groups as (sht threshold, rh threshold, combine, rows), and the min_elapsed and
+        dwell arrays
+'''
+def _plan_rules(rules):
+    keys = rules[["sht_threshold", "rh_threshold", "combine"]].fillna(np.inf)
+    groups = [(sht, rh, combine, rows)
+              for (sht, rh, combine), rows in keys.groupby(list(keys.columns), sort=False).indices.items()]
+    return {"sht": rules["sht_threshold"].dropna().unique(),
+            "rh": rules["rh_threshold"].dropna().unique(),
+            "groups": groups,
+            "min_elapsed": rules["min_elapsed"].to_numpy(dtype=np.float64),
+            "dwell": rules["dwell"].to_numpy(dtype=np.float64)}
+
+'''
+desc: first sample where each rule would have stopped the run
+input: run - output of load_backtest_run()
+       rules - dataframe of rules (columns of RULE_COLUMNS, NaN thresholds for unused signals), or the output of
+               _plan_rules() to reuse it across runs
+output: index of the stop sample of each rule (-1 if the rule never fires)
+'''
+def stop_indices(run, rules):
+    plan = rules if isinstance(rules, dict) else _plan_rules(rules)
+    t = run["t"]
+    all_met = np.ones(len(t), dtype=bool)  # for a signal the rule doesn't use (single signal rules are "and")
+    sht = dict(zip(plan["sht"], signal_met(run, "SHT40", plan["sht"])))
+    rh = dict(zip(plan["rh"], signal_met(run, "RH", plan["rh"])))
+
+    stops = np.full(len(plan["dwell"]), -1)
+    for sht_threshold, rh_threshold, combine, rows in plan["groups"]:
+        met_sht = sht.get(sht_threshold, all_met)
+        met_rh = rh.get(rh_threshold, all_met)
+        met = (met_sht | met_rh) if combine == "or" else (met_sht & met_rh)
+        stops[rows] = _stop_from_mask(t, met, plan["min_elapsed"][rows], plan["dwell"][rows])
+    return stops
+
+'''
+desc: first sample where a single rule would have stopped the run
+input: run - output of load_backtest_run()
+       rule - rule dict
+output: index of the stop sample (-1 if the rule never fires)
+'''
+def stop_index(run, rule):
+    return int(stop_indices(run, _rules_frame([rule]))[0])
+
+'''
+desc: rule dicts as a dataframe with NaN for the unused thresholds
+'''
+def _rules_frame(rules):
+    frame = pd.DataFrame(rules, columns=RULE_COLUMNS)
+    frame[["sht_threshold", "rh_threshold"]] = frame[["sht_threshold", "rh_threshold"]].astype(np.float64)
+    return frame
+
+'''
+desc: replay a list of rules over a list of runs
+input: runs - list of outputs of load_backtest_run()
+       rules - list of rule dicts
+output: dataframe with one row per rule and run
+'''
+def backtest_rules(runs, rules):
+    rules = _rules_frame(rules)
+    plan = _plan_rules(rules)
+    parts = []
+    for run in runs:
+        k = stop_indices(run, plan)
+        missed = k < 0
+        t_stop = np.where(missed, run["t_end"], run["t"][k])
+        part = rules.copy()
+        part["Name"] = run["name"]
+        part["Runtime End"] = run["t_end"]
+        part["Time @ Stop"] = np.where(missed, np.nan, t_stop)
+        part["Diff. in Time"] = run["t_end"] - t_stop
+        part["Missed"] = missed
+        part["Water @ Stop"] = run["water"][np.where(missed, -1, k)]
+        part["Water @ End"] = run["water"][-1]
+        part["Energy Saved [Wh]"] = np.where(missed, 0.0, run["energy"][-1] - run["energy"][np.maximum(k, 0)])
+        parts.append(part)
+    if not parts:
+        return rules.assign(**{c: [] for c in ["Name", "Runtime End", "Time @ Stop", "Diff. in Time", "Missed",
+                                                "Water @ Stop", "Water @ End", "Energy Saved [Wh]"]})
+    return pd.concat(parts, ignore_index=True)
+
+# runs loaded once per worker process
+_worker_runs = None
+
+'''
+desc: process pool initializer, loads every run into the worker
+'''
+def _init_worker(filepaths, smoothing=None, calibrated=True):
+    global _worker_runs
+    _worker_runs = [load_backtest_run(f, smoothing, calibrated) for f in filepaths]
+
+'''
+desc: backtest a chunk of rules over the runs of the worker
+'''
+def _backtest_chunk(rules):
+    return backtest_rules(_worker_runs, rules)
+
+'''
+desc: summarize the per run results of each rule
+input: results - output of backtest_rules()
+output: dataframe with one row per rule
+'''
+def summarize(results):
+    keys = list(RULE_COLUMNS)
+    grouped = results.fillna({"sht_threshold": np.inf, "rh_threshold": np.inf}).groupby(keys, sort=False)
+    summary = grouped.agg(**{"Runs": ("Name", "size"),
+                             "Missed Runs": ("Missed", "sum"),
+                             "Mean Diff. in Time": ("Diff. in Time", "mean"),
+                             "Total Diff. in Time": ("Diff. in Time", "sum"),
+                             "Mean Water @ Stop": ("Water @ Stop", "mean"),
+                             "Max Water @ Stop": ("Water @ Stop", "max"),
+                             "Total Energy Saved [kWh]": ("Energy Saved [Wh]", "sum")}).reset_index()
+    summary["Total Energy Saved [kWh]"] /= 1000
+    summary[["sht_threshold", "rh_threshold"]] = summary[["sht_threshold", "rh_threshold"]].replace(np.inf, np.nan)
+    return summary
+
+'''
+desc: backtest a grid of rules over every compiled run on a process pool
+input: rules - list of rule dicts (see rule_grid())
+       data_root - folder of the compiled dgo csv's
+       workers - number of worker processes (None = one per core, 1 = run in this process)
+       chunksize - rules per task
+       smoothing - filter spec of the deltas (see load_backtest_run())
+       exclude_bad - leave out the runs the data quality report of data_root marks bad
+       calibrated - backtest the calibrated deltas (see load_backtest_run())
+output: summary - one row per rule (see summarize())
+        results - one row per rule and run
+'''
+def run_backtest(rules, data_root="./125C_DATA/O2_DGO_DATA", workers=None, chunksize=256, smoothing=None,
+                 exclude_bad=True, calibrated=True):
+    filepaths = sorted(glob.glob(os.path.join(data_root, "**", "*.csv"), recursive=True))
+    if exclude_bad:
+        bad = excluded_runs(data_root)
+        filepaths = [f for f in filepaths if os.path.basename(f)[:-len(".csv")] not in bad]
+    chunks = [rules[i:i + chunksize] for i in range(0, len(rules), chunksize)]
+    if (workers == 1) or (len(chunks) <= 1):
+        _init_worker(filepaths, smoothing, calibrated)
+        parts = [_backtest_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(filepaths, smoothing, calibrated)) as pool:
+            parts = list(pool.map(_backtest_chunk, chunks))
+    results = pd.concat(parts, ignore_index=True) if parts else backtest_rules([], [])
+    return summarize(results), results
+
+'''
+desc: parse a "start:stop:step" range (inclusive) or a comma separated list of values. "none" leaves the signal out
+'''
+def _parse_values(text):
+    if text.lower() == "none":
+        return [None]
+    if ":" in text:
+        start, stop, step = (float(v) for v in text.split(":"))
+        return [round(v, 6) for v in np.arange(start, stop + step / 2, step)]
+    return [float(v) for v in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="backtest a grid of exit rules over every compiled dgo run")
+    parser.add_argument("--data-root", default="./125C_DATA/O2_DGO_DATA")
+    parser.add_argument("--sht", default="-8:-2:0.5", help="SHT40 delta thresholds, start:stop:step, a,b,c or none")
+    parser.add_argument("--rh", default="none", help="RH delta thresholds, start:stop:step, a,b,c or none")
+    parser.add_argument("--combine", default="and", help="and, or, or and,or")
+    parser.add_argument("--min-elapsed", default="0,20", help="minimum elapsed times [min]")
+    parser.add_argument("--dwell", default="0,2,5", help="dwell times [min]")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--rank", choices=["time", "energy"], default="time",
+                        help="rank the rules by the minutes or the kWh they save over the fleet")
+    parser.add_argument("--smoothing", default=None, help="smooth the deltas first, e.g. ema:12 or median:13")
+    parser.add_argument("--keep-bad-runs", action="store_true",
+                        help="also backtest the runs the data quality report marks bad")
+    parser.add_argument("--no-calibration", action="store_true", help="backtest the uncalibrated deltas")
+    parser.add_argument("--out", default=None, help="write the per rule summary to this csv")
+    args = parser.parse_args()
+
+    rules = rule_grid(_parse_values(args.sht), _parse_values(args.rh), args.combine.split(","),
+                      _parse_values(args.min_elapsed), _parse_values(args.dwell))
+    t0 = time.perf_counter()
+    summary, results = run_backtest(rules, args.data_root, args.workers, smoothing=args.smoothing,
+                                    exclude_bad=not args.keep_bad_runs, calibrated=not args.no_calibration)
+    print(f"{len(rules)} rules x {results['Name'].nunique()} runs in {time.perf_counter() - t0:.2f} s")
+    saved = "Mean Diff. in Time" if args.rank == "time" else "Total Energy Saved [kWh]"
+    summary = summary.sort_values(["Missed Runs", saved], ascending=[True, False])
+    print(summary.head(20).to_string(index=False))
+    if args.out is not None:
+        summary.to_csv(args.out, index=False)
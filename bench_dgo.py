@@ -0,0 +1,400 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import time
+import numpy as np
+import pandas as pd
+import instrumentation
+from dgo_io import read_raw_csv, read_dgo_csv
+from dgo_cache import DASHBOARD_COLUMNS, invalidate, cache_stats
+from extrapolate_dgo import compile_dgos, extrapolate_dgo, find_raw_files
+from fleet import Fleet
+from fleet_aggregate import fleet_envelopes
+from threshold_index import build_run_index, crossing_stats
+from plot_downsample import decimated_trace
+"""
+Benchmark harness at fleet scale, on synthetic raw logs.
+
+generate_fleet() writes raw logs in the same format as the rig's (UTF-8 BOM, quoted header, an "undefined" first row,
+"undefined"/empty scale dropout rows every ~11 samples, a third of the units without the inductance channel), with the
+intake SHT40 shape find_dgo_bounds() relies on: flat at ambient, an exponential heat-up to a plateau, and a cool-down
+after the end. The exhaust SHT40 and the RH's follow slower curves so the deltas cover the same ranges as the real runs.
+Every run's parameters (duration, plateau, time constants, ...) are drawn from its own seed, so a fleet is reproducible
+and the runs of a small fleet are the first runs of a bigger one.
+
+run_benchmark() times each stage on N x today's 17 runs:
+
+    ingest     read_raw_csv() of every log
+    segment    find the cycle and slice it out (extrapolate_dgo()) of every log, already in memory
+    compile    compile_dgos() end to end (read, segment, write the csv's, catalog), forced
+    detect     build the crossing indexes of every compiled run and the crossing stats of a threshold
+    aggregate  per unit percentile envelopes (fleet_aggregate), with the dataset cache warm
+    dashboard  what streamlit_125Cop does before drawing: deltas, crossing indexes, stats, decimated traces. cold (empty
+               dataset cache) and warm (a rerun)
+
+and appends one record per stage to RESULTS_PATH with the git commit, so `python bench_dgo.py compare` shows how each
+stage moved between commits. The synthetic logs are kept under SYNTH_DIR and reused (1000x is ~17000 logs, ~7 GB).
+"""
+
+SYNTH_DIR = "./bench/data"
+RESULTS_PATH = "./bench/results.jsonl"
+BASE_RUNS = 17  # runs in 125C_DATA today
+SCALES = [10, 100, 1000]
+DAYS_PER_UNIT = 7
+SYNTH_PARAMS = {"duration_min": (145.0, 240.0), "period_s": 5.0, "noise": 0.01, "dropout_every": 11}
+REGRESSION_RATIO = 1.2  # flagged in compare() when a stage got this much slower
+
+'''
+desc: one synthetic raw log
+input: rng - numpy Generator (all the run's parameters and noise are drawn from it)
+       duration_min - length of the dgo cycle [min]
+       period_s - sampling period [s]
+       noise - std of the temperature noise [degC] (RH noise is 10x that)
+       dropout_every - a scale dropout row about every this many samples (0 for none)
+       inductance - log the inductance channel (unit 1 doesn't)
+       start_time - epoch ms of the first sample
+       pre_min, post_min - minutes logged before the heat-up and after the end of the cycle
+output: raw_data - dataframe with int64 epoch ms time and the sensor channels (float64, NaN for the dropout rows), same
+        columns as read_raw_csv() gives
+'''
+def synthetic_run(rng, duration_min=150.0, period_s=5.0, noise=0.01, dropout_every=11, inductance=True,
+                  start_time=1709713200000, pre_min=6.0, post_min=4.0):
+    n_pre, n_cycle, n_post = (int(round(m * 60 / period_s)) for m in (pre_min, duration_min, post_min))
+    n = n_pre + n_cycle + n_post
+    t_min = np.arange(n) * period_s / 60
+    t_end = (n_pre + n_cycle - 1) * period_s / 60
+    tc = np.clip(t_min - pre_min, 0, None)  # minutes into the cycle
+    cooling = t_min > t_end
+    tcool = np.where(cooling, t_min - t_end, 0.0)
+
+    ambient, plateau = rng.uniform(20, 24), rng.uniform(55, 62)
+    tau_in, tau_ex = rng.uniform(10, 20), rng.uniform(30, 60)
+    tau_dry, tau_cool = rng.uniform(20, 60), rng.uniform(6, 12)
+    exhaust_plateau = plateau - rng.uniform(5, 9)
+    rh_ambient, rh_dry, rh_wet = rng.uniform(30, 40), rng.uniform(4, 7), rng.uniform(15, 28)
+
+    def heat(start, end, tau):
+        return end + (start - end) * np.exp(-tc / tau)
+
+    in_sht = heat(ambient, plateau, tau_in)
+    in_sht = np.where(cooling, in_sht + (ambient - in_sht) * (1 - np.exp(-tcool / tau_cool)), in_sht)
+    ex_sht = heat(ambient - 1, exhaust_plateau, tau_ex)
+    ex_sht = np.where(cooling, ex_sht + (ambient - ex_sht) * (1 - np.exp(-tcool / (4 * tau_cool))), ex_sht)
+    in_rh = heat(rh_ambient, rh_dry, tau_in)
+    in_rh = np.where(cooling, in_rh + (rh_ambient - in_rh) * (1 - np.exp(-tcool / tau_cool)), in_rh)
+    wetness = rh_wet * np.exp(-tc / tau_dry) * (1 - np.exp(-tc / 3)) + rng.uniform(6, 9)  # hump as the load heats up
+    ex_rh = in_rh + wetness
+
+    # heater cycling on/off in blocks during the cycle
+    heater_on = (rng.random(n // 6 + 1) < 0.6).repeat(6)[:n] & (tc > 0) & ~cooling
+    water = rng.uniform(0.4, 0.6) - rng.uniform(0.15, 0.25) * (1 - np.exp(-tc / tau_dry))
+
+    def jitter(x, scale):
+        return x + rng.normal(0, scale, n)
+
+    channels = {
+        "Ohaus Tare Weight": jitter(np.full(n, 3.9), 0.002),
+        "Ohaus Water Weight": jitter(water, 0.001),
+        "Ohaus Weight": jitter(water + 30.35, 0.002),
+        "Bucket Temp": jitter(np.where(tc > 0, heat(ambient, 120, 8), ambient), 1.5),
+        "Bucket Temp 2 (Figure out later lol)": jitter(np.where(tc > 0, heat(ambient, 124, 8), ambient), 1.5),
+        "Intake Air RH": jitter(in_rh, 10 * noise),
+        "Exhaust RH": jitter(ex_rh, 10 * noise),
+        "Grinder PWM": (rng.random(n) < 0.5) * 100.0,
+        "Grinder RPM": np.round(jitter(np.full(n, 1600.0), 80)),
+        "Stable Mass ": np.round(jitter(np.full(n, 15500.0), 40)),
+        "Intake Fan PWM": np.where(tc > 0, 80.0, 0.0),
+        "Intake Fan RPM": np.where(tc > 0, np.round(jitter(np.full(n, 5070.0), 10)), 0.0),
+        "Exhaust Fan PWM": np.where(tc > 0, 45.0, 15.0),
+        "Exhaust Fan RPM": np.round(jitter(np.where(tc > 0, 5500.0, 1605.0), 10)),
+        "Intake SHT40": jitter(in_sht, noise),
+        "Exhaust SHT40": jitter(ex_sht, noise),
+        "V_rms ": jitter(np.full(n, 117.0), 0.8),
+        "I_rms": jitter(np.where(heater_on, 3.0, 0.13), 0.02),
+        "Watts": jitter(np.where(heater_on, 355.0, 16.0), 3.0),
+        "Bucket Heater PWM": np.where(heater_on, 100.0, 0.0),
+        "Intake Heater PWM": np.where((tc > 0) & ~cooling, np.clip(100 - tc / 3, 40, 100), 0.0),
+        "Inductance/10000": jitter(np.full(n, 234.7), 0.05),
+    }
+    if not inductance:
+        del channels["Inductance/10000"]
+    raw_data = pd.DataFrame({"time": start_time + np.round(np.arange(n) * period_s * 1000).astype(np.int64),
+                             **channels})
+
+    # the logger's first row and the scale dropouts
+    dropouts = [0]
+    if dropout_every:
+        dropouts += np.cumsum(rng.integers(dropout_every - 1, dropout_every + 2, n // max(dropout_every - 1, 1)))
+    dropouts = np.asarray(dropouts)
+    raw_data.iloc[dropouts[dropouts < n], 1:] = np.nan
+    return raw_data
+
+'''
+desc: write a raw log in the rig's format: BOM, quoted header, dropout rows as "undefined" in the scale columns
+and empty everywhere else
+input: raw_data - output of synthetic_run()
+       path - csv file
+'''
+def write_raw_log(raw_data, path):
+    out = raw_data.copy()
+    scale = ["Ohaus Tare Weight", "Ohaus Water Weight", "Ohaus Weight", "Bucket Temp"]
+    for column in scale:
+        out[column] = out[column].map("{:.5f}".format).where(out[column].notna(), "undefined")
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        f.write(",".join(f'"{c}"' for c in out.columns) + "\n")
+        out.to_csv(f, header=False, index=False, float_format="%.5f", na_rep="", lineterminator="\n")
+
+'''
+desc: write (or reuse) a fleet of synthetic raw logs, O2-DVT-DGO-{unit}_D{day}_RAW.csv with 7 days per unit
+input: n_runs - number of logs
+       root - folder (default: one per fleet under SYNTH_DIR)
+       seed - fleet seed, run i uses the seed (seed, i)
+       params - overrides of SYNTH_PARAMS
+output: root - folder of the logs
+'''
+def generate_fleet(n_runs, root=None, seed=0, **params):
+    params = {**SYNTH_PARAMS, **params}
+    lo, hi = params["duration_min"]
+    if root is None:
+        root = os.path.join(SYNTH_DIR, f"runs{n_runs}_seed{seed}_p{params['period_s']:g}_n{params['noise']:g}"
+                                       f"_d{lo:g}-{hi:g}_x{params['dropout_every']}")
+    marker = os.path.join(root, ".complete")
+    if os.path.isfile(marker):
+        return root
+    os.makedirs(root, exist_ok=True)
+    start = pd.Timestamp("2024-03-06 09:00", tz="America/Los_Angeles")
+    for i in range(n_runs):
+        unit, day = i // DAYS_PER_UNIT + 1, i % DAYS_PER_UNIT + 1
+        rng = np.random.default_rng([seed, i])
+        start_time = int((start + pd.Timedelta(days=day - 1, minutes=float(rng.uniform(0, 120)))).value // 10 ** 6)
+        raw_data = synthetic_run(rng, rng.uniform(lo, hi), params["period_s"], params["noise"],
+                                 params["dropout_every"], inductance=(unit % 3 != 1), start_time=start_time)
+        write_raw_log(raw_data, os.path.join(root, f"O2-DVT-DGO-{unit}_D{day}_RAW.csv"))
+    with open(marker, "w") as f:
+        json.dump({"n_runs": n_runs, "seed": seed, **params}, f)
+    return root
+
+'''
+desc: time one stage: wall time, rows processed, and the instrumentation spans recorded during it
+'''
+class Stage:
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.nbytes = 0
+        self.extra = {}
+
+    def __enter__(self):
+        instrumentation.reset()
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.t0
+        self.spans = instrumentation.snapshot()["spans"]
+        return False
+
+    def record(self):
+        return {"stage": self.name, "seconds": self.seconds, "rows": int(self.rows), "mb": self.nbytes / 1e6,
+                "rows_per_s": self.rows / self.seconds if self.seconds > 0 else None, **self.extra,
+                "peak_rss_mb": instrumentation.peak_rss_mb(), "spans": self.spans}
+
+'''
+desc: the data prep of the main dashboard (everything before the figures are sent), see streamlit_125Cop.py
+input: fleet - Fleet of the compiled runs
+       threshold - SHT40/RH threshold used for both stats tables
+output: number of samples that went through the deltas
+'''
+def dashboard_prep(fleet, threshold=-5.0):
+    deltas = fleet.deltas()
+    indexes = {name: fleet.crossing_index(name) for name in fleet.names}
+    crossing_stats(indexes, "SHT40", threshold)
+    crossing_stats(indexes, "RH", -threshold)
+    for i, name in enumerate(fleet.names):
+        decimated_trace(deltas["time"][i], deltas["SHT40"][i], name)
+        decimated_trace(deltas["time"][i], deltas["RH"][i], name)
+    return len(deltas["time"].values)
+
+'''
+desc: time every stage on a synthetic fleet of scale x today's runs
+input: scale - multiple of BASE_RUNS
+       seed - fleet seed
+       workers - compile worker processes (None = one per core)
+       stages - stages to run (default: all)
+       keep_work - keep the compiled runs/catalog of the benchmark
+       params - overrides of SYNTH_PARAMS
+output: list of the stage records (also appended to RESULTS_PATH unless results_path is None)
+'''
+def run_benchmark(scale, seed=0, workers=None, stages=None, keep_work=False, results_path=RESULTS_PATH, **params):
+    stages = stages or ["ingest", "segment", "compile", "detect", "aggregate", "dashboard"]
+    n_runs = int(round(scale * BASE_RUNS))
+    t0 = time.perf_counter()
+    raw_root = generate_fleet(n_runs, seed=seed, **params)
+    print(f"{n_runs} synthetic logs in {raw_root} ({time.perf_counter() - t0:.1f} s)")
+    files = find_raw_files(raw_root)
+    work = os.path.join(SYNTH_DIR, "work", os.path.basename(raw_root))
+    compiled_root = os.path.join(work, "compiled")
+    records = []
+
+    if ("ingest" in stages) or ("segment" in stages):
+        # same loop for both so the logs are only read once, each timed on its own
+        ingest, segment = Stage("ingest"), Stage("segment")
+        read_s = segment_s = 0.0
+        with Stage("ingest+segment") as both:
+            for filepath in files:
+                t = time.perf_counter()
+                raw_data = read_raw_csv(filepath)
+                read_s += time.perf_counter() - t
+                ingest.rows += len(raw_data)
+                ingest.nbytes += os.path.getsize(filepath)
+                if "segment" in stages:
+                    t = time.perf_counter()
+                    segment.rows += len(extrapolate_dgo(raw_data, os.path.basename(filepath)))
+                    segment_s += time.perf_counter() - t
+        for stage, seconds, prefixes in [(ingest, read_s, ("load.",)), (segment, segment_s, ("segment.",))]:
+            if stage.name in stages:
+                stage.seconds = seconds
+                stage.spans = {k: v for k, v in both.spans.items() if k.startswith(prefixes)}
+                records.append(stage.record())
+
+    needs_compiled = any(s in stages for s in ["compile", "detect", "aggregate", "dashboard"])
+    if needs_compiled:
+        with Stage("compile") as stage, contextlib.redirect_stdout(io.StringIO()):
+            summary = compile_dgos(raw_root, compiled_root, workers, force=True,
+                                   catalog_path=os.path.join(work, "catalog.sqlite"))
+            stage.rows = summary["Rows"].fillna(0).sum()
+            stage.extra["errors"] = int((summary["Status"] != "ok").sum())
+        if "compile" in stages:
+            records.append(stage.record())
+
+    fleet = Fleet(compiled_root) if needs_compiled else None
+    if "detect" in stages:
+        with Stage("detect") as stage:
+            indexes = {}
+            for name in fleet.names:
+                # loaded outside of the dataset cache so only the index building is measured against the cache
+                dgo_data = read_dgo_csv(fleet.path(name), DASHBOARD_COLUMNS, sensor_dtype=np.float64)
+                indexes[name] = build_run_index(dgo_data)
+                stage.rows += len(dgo_data)
+            crossing_stats(indexes, "SHT40", -5.0)
+            crossing_stats(indexes, "RH", 5.0)
+        del indexes
+        records.append(stage.record())
+
+    if "aggregate" in stages:
+        invalidate()
+        fleet.deltas()  # warm the cache like a dashboard rerun would be
+        with Stage("aggregate") as stage:
+            envelopes = fleet_envelopes(fleet, "SHT40", by="Unit")
+            envelopes = fleet_envelopes(fleet, "RH", by="Unit")
+            stage.rows = len(fleet.deltas()["time"].values)
+            stage.extra["grid_points"] = len(envelopes)
+        records.append(stage.record())
+
+    if "dashboard" in stages:
+        invalidate()
+        for name in ["dashboard_cold", "dashboard_warm"]:
+            with Stage(name) as stage:
+                before = cache_stats()
+                stage.rows = dashboard_prep(fleet)
+                after = cache_stats()
+                stage.extra.update({k: after[k] - before[k] for k in ["hits", "misses", "evictions"]})
+            records.append(stage.record())
+        invalidate()
+
+    if not keep_work:
+        shutil.rmtree(work, ignore_errors=True)
+
+    meta = {"time": pd.Timestamp.now(tz="UTC").isoformat(timespec="seconds"), **instrumentation.git_state(),
+            "scale": scale, "n_runs": n_runs, "seed": seed, "workers": workers, "params": {**SYNTH_PARAMS, **params},
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "machine": platform.platform(), "cpus": os.cpu_count()}
+    records = [{**meta, **record} for record in records]
+    if results_path is not None:
+        os.makedirs(os.path.dirname(results_path) or ".", exist_ok=True)
+        with open(results_path, "a") as f:
+            for record in records:
+                f.write(json.dumps(record, default=float) + "\n")
+    return records
+
+'''
+desc: table of the stage timings of the benchmark records
+'''
+def records_frame(records):
+    frame = pd.DataFrame(records)
+    columns = ["scale", "n_runs", "stage", "seconds", "rows", "rows_per_s", "mb", "peak_rss_mb", "hits", "misses",
+               "evictions", "errors"]
+    return frame[[c for c in columns if c in frame]]
+
+'''
+desc: stage timings of the recorded benchmarks, one column per commit (oldest first), with the ratio of the last commit
+to the one before it
+input: results_path - results file
+       scale - scale to compare
+       commits - number of most recent commits to show
+output: dataframe indexed by stage
+'''
+def compare(results_path=RESULTS_PATH, scale=10, commits=5):
+    results = pd.read_json(results_path, lines=True)
+    results = results[results["scale"] == scale]
+    if len(results) == 0:
+        return pd.DataFrame()
+    results["label"] = results["commit"].fillna("unknown").str[:8] + np.where(results["dirty"] == True, "+", "")
+    # the latest run of each stage per commit
+    latest = results.sort_values("time").groupby(["label", "stage"], as_index=False).last()
+    order = latest.groupby("label")["time"].max().sort_values().index[-commits:]
+    table = latest.pivot(index="stage", columns="label", values="seconds")[list(order)]
+    if len(order) >= 2:
+        table["ratio"] = table[order[-1]] / table[order[-2]]
+        table["flag"] = np.where(table["ratio"] > REGRESSION_RATIO, "slower",
+                                 np.where(table["ratio"] < 1 / REGRESSION_RATIO, "faster", ""))
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the pipeline on synthetic raw logs at fleet scale")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run = sub.add_parser("run", help="time every stage and append the results")
+    run.add_argument("--scales", type=float, nargs="+", default=SCALES, help="multiples of today's 17 runs")
+    run.add_argument("--stages", nargs="+", default=None,
+                     choices=["ingest", "segment", "compile", "detect", "aggregate", "dashboard"])
+    run.add_argument("--workers", type=int, default=None, help="compile worker processes (default: one per core)")
+    run.add_argument("--results", default=RESULTS_PATH, help="results file (.jsonl)")
+    run.add_argument("--keep-work", action="store_true", help="keep the compiled runs of the benchmark")
+
+    generate = sub.add_parser("generate", help="only write a synthetic fleet")
+    generate.add_argument("--runs", type=int, default=BASE_RUNS)
+    generate.add_argument("--out", default=None, help="folder (default: under bench/data)")
+
+    for p in [run, generate]:
+        p.add_argument("--seed", type=int, default=0)
+        p.add_argument("--duration", type=float, nargs=2, default=SYNTH_PARAMS["duration_min"],
+                       metavar=("MIN", "MAX"), help="range of the cycle durations [min]")
+        p.add_argument("--period", type=float, default=SYNTH_PARAMS["period_s"], help="sampling period [s]")
+        p.add_argument("--noise", type=float, default=SYNTH_PARAMS["noise"], help="temperature noise std [degC]")
+        p.add_argument("--dropout-every", type=int, default=SYNTH_PARAMS["dropout_every"])
+
+    cmp = sub.add_parser("compare", help="compare the recorded results across commits")
+    cmp.add_argument("--results", default=RESULTS_PATH)
+    cmp.add_argument("--scale", type=float, default=10)
+    cmp.add_argument("--commits", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        print(compare(args.results, args.scale, args.commits).to_string())
+    else:
+        params = {"duration_min": tuple(args.duration), "period_s": args.period, "noise": args.noise,
+                  "dropout_every": args.dropout_every}
+        if args.command == "generate":
+            print(generate_fleet(args.runs, args.out, args.seed, **params))
+        else:
+            for scale in args.scales:
+                records = run_benchmark(scale, args.seed, args.workers, args.stages, args.keep_work, args.results,
+                                        **params)
+                print(records_frame(records).to_string(index=False))
@@ -0,0 +1,199 @@
+import argparse
+import functools
+import os
+import numpy as np
+import pandas as pd
+import run_catalog
+from dgo_io import parse_run_name
+from dgo_store import read_compiled
+"""
+Sensor calibration of the compiled runs, applied when a run is loaded (dgo_cache.load_run(calibrated=True)).
+
+Before the heat-up the intake and exhaust sensors sit in the same room air, yet they disagree (about 0.7 degC between
+the SHT40s of O2-DVT-DGO-1_D1 at t=0, several points between the RH's), so every exhaust - intake delta carries that
+bias. Two sources of corrections, per unit (rig) and channel, corrected = gain * raw + offset:
+
+    calibration table   CALIBRATION_PATH, rows of Unit, Channel, Gain, Offset (e.g. from a bench calibration, or
+                        estimated from the catalogued baselines with `python calibration.py --estimate`)
+    pre-heat baselines  for the exhaust sensors (BASELINE_PAIRS): the median exhaust - intake difference over the
+                        PREHEAT_SAMPLES raw samples before the cycle starts, measured by compile_dgos() and kept in the
+                        run catalog. runs that aren't catalogued fall back to their first compiled sample
+
+A table entry wins over the baseline of a pair if either of its channels has one. The corrections of a run are one gain
+and one offset vector, applied to all the channels at once as a single (samples x channels) multiply-add.
+"""
+
+CALIBRATION_PATH = "./125C_DATA/calibration.csv"
+CALIBRATION_COLUMNS = ["Unit", "Channel", "Gain", "Offset"]
+# channel corrected by the pre-heat baseline -> the reference channel it is matched to
+BASELINE_PAIRS = {"Exhaust SHT40": "Intake SHT40", "Exhaust RH": "Intake Air RH"}
+PREHEAT_SAMPLES = 24  # 2 min at 5 s, the raw logs start a few minutes before the heat-up
+FALLBACK_SAMPLES = 1  # first compiled sample, the last one before the intake starts rising
+
+'''
+desc: the calibration table
+input: path - csv of Unit, Channel, Gain, Offset
+output: dataframe (empty if there is no table)
+'''
+def load_table(path=CALIBRATION_PATH):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return pd.DataFrame(columns=CALIBRATION_COLUMNS)
+    return _read_table(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+'''
+desc: read the table once per version of the file
+'''
+@functools.lru_cache(maxsize=8)
+def _read_table(path, mtime_ns, size):
+    table = pd.read_csv(path, dtype={"Unit": np.int64, "Channel": str, "Gain": np.float64, "Offset": np.float64})
+    missing = set(CALIBRATION_COLUMNS) - set(table.columns)
+    if missing:
+        raise ValueError(f"{path} has no column(s) {sorted(missing)}")
+    return table[CALIBRATION_COLUMNS]
+
+'''
+desc: offsets that bring the exhaust sensors onto the intake ones, from the samples before the heat-up
+input: raw_data - dataframe of the raw log
+       start_index - positional index of the start of the cycle (see find_dgo_bounds())
+       samples - number of samples before the start to use
+output: dict of channel -> (offset, number of samples used). channels without any valid sample are left out
+'''
+def preheat_offsets(raw_data, start_index, samples=PREHEAT_SAMPLES):
+    window = slice(max(int(start_index) - samples, 0), int(start_index))
+    offsets = {}
+    for channel, reference in BASELINE_PAIRS.items():
+        if (channel not in raw_data) or (reference not in raw_data):
+            continue
+        diff = (raw_data[reference].to_numpy(dtype=np.float64)[window]
+                - raw_data[channel].to_numpy(dtype=np.float64)[window])
+        diff = diff[~np.isnan(diff)]
+        if len(diff):
+            offsets[channel] = (float(np.median(diff)), len(diff))
+    return offsets
+
+'''
+desc: same as preheat_offsets() from the first samples of a compiled run, for runs without a catalogued baseline
+input: dgo_data - dataframe of a compiled run
+output: dict of channel -> (offset, number of samples used)
+'''
+def fallback_offsets(dgo_data):
+    return preheat_offsets(dgo_data.iloc[:FALLBACK_SAMPLES], FALLBACK_SAMPLES, FALLBACK_SAMPLES)
+
+'''
+desc: gain and offset of every channel of a run
+input: dataname - run name (the unit comes from it)
+       channels - channels to correct
+       table - calibration table (see load_table())
+       baselines - dict of channel -> (offset, samples) of the run's pre-heat baseline
+output: gain, offset - float64 arrays, one per channel; source - dict of channel -> "table"/"baseline" for the channels
+        that are corrected
+'''
+def run_corrections(dataname, channels, table, baselines):
+    unit, _ = parse_run_name(dataname)
+    entries = table[table["Unit"] == unit].set_index("Channel") if unit is not None else table.iloc[:0]
+    gain, offset = np.ones(len(channels)), np.zeros(len(channels))
+    source = {}
+    for i, channel in enumerate(channels):
+        if channel in entries.index:
+            gain[i], offset[i] = entries.at[channel, "Gain"], entries.at[channel, "Offset"]
+            source[channel] = "table"
+        elif (channel in baselines) and (BASELINE_PAIRS[channel] not in entries.index):
+            offset[i] = baselines[channel][0]
+            source[channel] = "baseline"
+    return gain, offset, source
+
+'''
+desc: apply the calibration to a compiled run
+input: dgo_data - dataframe of a compiled run (any subset of the channels)
+       dataname - run name
+       table - calibration table (None to load CALIBRATION_PATH)
+       baselines - pre-heat baselines of the run (None to use fallback_offsets())
+output: dataframe with the same columns, corrected. attrs["calibration"] has the gain/offset/source of each corrected
+        channel
+'''
+def calibrate(dgo_data, dataname, table=None, baselines=None):
+    table = load_table() if table is None else table
+    baselines = fallback_offsets(dgo_data) if baselines is None else baselines
+    channels = [c for c in dgo_data.columns if c != "time"]
+    gain, offset, source = run_corrections(dataname, channels, table, baselines)
+
+    values = dgo_data[channels].to_numpy(dtype=np.float64) * gain + offset
+    calibrated = pd.DataFrame(values, columns=channels, index=dgo_data.index)
+    calibrated.insert(0, "time", dgo_data["time"].to_numpy())
+    calibrated.attrs.update(dgo_data.attrs)
+    calibrated.attrs["calibration"] = {c: {"gain": float(gain[i]), "offset": float(offset[i]), "source": source[c]}
+                                       for i, c in enumerate(channels) if c in source}
+    return calibrated
+
+'''
+desc: load a compiled run calibrated with its catalogued baseline (what dgo_cache.load_run(calibrated=True) caches).
+the reference channels of the baseline pairs are read too when they weren't asked for, so the fallback baseline can
+still be taken
+input: filepath - compiled dgo csv (the run name comes from it)
+       columns - channels to load (time is always loaded; None for all)
+       calibration_path, catalog_path - calibration table and run catalog
+output: calibrated dataframe (float64), see calibrate()
+'''
+def load_calibrated(filepath, columns=None, calibration_path=CALIBRATION_PATH, catalog_path=run_catalog.CATALOG_PATH):
+    dataname = os.path.splitext(os.path.basename(filepath))[0]
+    needed = None
+    if columns is not None:
+        needed = list(columns) + [BASELINE_PAIRS[c] for c in columns if (c in BASELINE_PAIRS) and
+                                  (BASELINE_PAIRS[c] not in columns)]
+    dgo_data = read_compiled(filepath, needed)
+    baselines = run_catalog.run_baselines(dataname, catalog_path)
+    calibrated = calibrate(dgo_data, dataname, load_table(calibration_path), baselines or None)
+    if (columns is not None) and (len(needed) > len(columns)):
+        keep = ["time"] + [c for c in columns if c != "time"]
+        calibrated = calibrated[keep].copy()  # attrs are kept by the selection
+    return calibrated
+
+'''
+desc: version of the calibration sources, part of the cache key of calibrated runs so they are rebuilt when the table
+or the catalog changes
+output: tuple of the (mtime_ns, size) of the table and the catalog (None for missing files)
+'''
+def calibration_signature(calibration_path=CALIBRATION_PATH, catalog_path=run_catalog.CATALOG_PATH):
+    signature = []
+    for path in [calibration_path, catalog_path]:
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+'''
+desc: calibration table estimated from the catalogued pre-heat baselines: the median offset of every unit and channel
+input: catalog_path - run catalog
+output: dataframe of Unit, Channel, Gain (1), Offset, Runs
+'''
+def estimate_table(catalog_path=run_catalog.CATALOG_PATH):
+    baselines = run_catalog.baselines(path=catalog_path)
+    if len(baselines) == 0:
+        return pd.DataFrame(columns=CALIBRATION_COLUMNS + ["Runs"])
+    table = baselines.groupby(["Unit", "Channel"], as_index=False).agg(Offset=("Offset", "median"),
+                                                                       Runs=("Offset", "size"))
+    table.insert(2, "Gain", 1.0)
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="sensor calibration of the compiled runs")
+    parser.add_argument("--catalog", default=run_catalog.CATALOG_PATH, help="sqlite file of the run catalog")
+    parser.add_argument("--table", default=CALIBRATION_PATH, help="calibration table csv")
+    parser.add_argument("--estimate", action="store_true",
+                        help="write the table from the median pre-heat baseline of each unit (overwrites it)")
+    args = parser.parse_args()
+
+    if args.estimate:
+        table = estimate_table(args.catalog)
+        table[CALIBRATION_COLUMNS].to_csv(args.table, index=False)
+        print(table.to_string(index=False))
+    else:
+        print("pre-heat baselines (catalog):")
+        print(run_catalog.baselines(path=args.catalog).to_string(index=False))
+        print(f"calibration table ({args.table}):")
+        print(load_table(args.table).to_string(index=False))
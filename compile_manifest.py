@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+"""
+Manifest of the raw -> dgo compile so that compile_dgos() only re-segments raw files that are new, changed, or were
+compiled with different segmentation parameters. The manifest is a json file saved next to the compiled data. Raw files
+the data quality scan left out get an "excluded" entry (with the quality thresholds instead of an output), so they are
+only scanned again once the file or the thresholds change.
+"""
+
+MANIFEST_NAME = ".dgo_manifest.json"
+
+'''
+desc: sha256 of a file's contents, read in 1 MB blocks
+input: filepath - file to hash
+output: hex digest
+'''
+def file_hash(filepath):
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+'''
+desc: load the manifest from save_root (empty if there is none yet or it can't be read)
+input: save_root - folder of the compiled dgo data
+output: dict of raw file (relative to the raw root) -> entry
+'''
+def load_manifest(save_root):
+    path = os.path.join(save_root, MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+'''
+desc: write the manifest to save_root (written to a temp file first so an interrupted run can't leave half a manifest)
+input: save_root - folder of the compiled dgo data
+       manifest - dict of raw file -> entry
+'''
+def save_manifest(save_root, manifest):
+    os.makedirs(save_root, exist_ok=True)
+    path = os.path.join(save_root, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+'''
+desc: build the manifest entry for a raw file
+input: filepath - raw data csv
+       savepath - compiled output of the raw file
+       params - dict of the segmentation parameters used
+       sha256 - hash of the raw file if it was already computed
+       storepath - compiled output in the columnar store (None if the store isn't written)
+output: entry dict
+'''
+def make_entry(filepath, savepath, params, sha256=None, storepath=None):
+    st = os.stat(filepath)
+    return {"sha256": sha256 if sha256 is not None else file_hash(filepath),
+            "mtime_ns": st.st_mtime_ns,
+            "size": st.st_size,
+            "params": dict(params),
+            "output": savepath,
+            "store": storepath}
+
+'''
+desc: build the manifest entry for a raw file the quality scan left out (nothing was written for it)
+input: filepath - raw data csv
+       params - dict of the segmentation parameters of the compile
+       quality_params - dict of the quality thresholds it was scanned with (see data_quality.QUALITY_PARAMS)
+       sha256 - hash of the raw file if it was already computed
+output: entry dict
+'''
+def make_excluded_entry(filepath, params, quality_params, sha256=None):
+    entry = make_entry(filepath, None, params, sha256)
+    entry.update(status="excluded", quality=dict(quality_params))
+    return entry
+
+'''
+desc: check if a raw file needs to be (re)compiled. the size/mtime is checked first and the file is only hashed if that
+changed, so a touched-but-identical file is not recompiled
+input: entry - manifest entry of the raw file (None if it has never been compiled)
+       filepath - raw data csv
+       savepath - where the compiled output should be
+       params - dict of the segmentation parameters for this run
+       storepath - where the output in the columnar store should be (None if the store isn't written)
+       quality_params - quality thresholds of this run, an excluded entry is stale once they change (None to compile
+                        excluded files again regardless)
+output: stale - True if the file needs to be compiled
+        sha256 - hash of the raw file if it had to be computed (None otherwise)
+'''
+def is_stale(entry, filepath, savepath, params, storepath=None, quality_params=None):
+    if (entry is None) or (entry.get("params") != dict(params)):
+        return True, None
+    if entry.get("status") == "excluded":
+        if (quality_params is None) or (entry.get("quality") != dict(quality_params)):
+            return True, None
+    else:
+        if entry.get("output") != savepath:
+            return True, None
+        if (entry.get("store") != storepath) or ((storepath is not None) and not os.path.isfile(storepath)):
+            return True, None
+        if not os.path.isfile(savepath):
+            return True, None
+    st = os.stat(filepath)
+    if (st.st_size == entry.get("size")) and (st.st_mtime_ns == entry.get("mtime_ns")):
+        return False, None
+    sha256 = file_hash(filepath)
+    return sha256 != entry.get("sha256"), sha256
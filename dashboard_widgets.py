@@ -0,0 +1,71 @@
+import cProfile
+import streamlit as st
+import instrumentation
+from filters import SMOOTHING_OPTIONS
+from fleet import Fleet
+from run_catalog import load_runs, RUN_DATES
+"""
+Sidebar widgets shared by the dashboards.
+"""
+
+'''
+desc: pick the runs to look at from the run catalog, so only the selected runs are ever loaded. without a catalog
+(compile hasn't been run with one yet) every compiled run on disk can be picked, but never the runs the data quality
+report marks bad. the sensor calibration (see calibration) is on unless it is unticked
+output: fleet - Fleet of the selected runs
+        selected - catalog rows of the selected runs (name, unit, day, date, runtime, ...)
+'''
+def run_selector():
+    calibrated = st.sidebar.checkbox("Calibrate sensors (pre-heat baseline)", value=True)
+    fleet = Fleet(calibrated=calibrated)
+    if fleet.excluded:
+        st.sidebar.caption(f"Left out by the data quality report: {', '.join(fleet.excluded)}")
+    catalog = load_runs()
+    if len(catalog) == 0:
+        st.sidebar.info("No run catalog yet (run extrapolate_dgo.py), showing every compiled run")
+        catalog = fleet.runs.assign(Date=fleet.runs["Day"].map(RUN_DATES))
+    catalog = catalog[catalog["Name"].isin(fleet.names)]  # only runs that are on disk
+
+    all_units = sorted(catalog["Unit"].unique().tolist())
+    all_days = sorted(catalog["Day"].unique().tolist())
+    units = st.sidebar.multiselect("Units", all_units, default=all_units)
+    days = st.sidebar.multiselect("Days", all_days, default=all_days,
+                                  format_func=lambda d: f"D{d} ({RUN_DATES.get(d, '?')})")
+    selected = catalog[catalog["Unit"].isin(units) & catalog["Day"].isin(days)].reset_index(drop=True)
+    return fleet.select(names=selected["Name"]), selected
+
+'''
+desc: causal filter the deltas are smoothed with before the thresholds are checked (see filters)
+output: filter spec, None for the raw deltas
+'''
+def smoothing_selector():
+    return st.sidebar.selectbox("Smoothing", SMOOTHING_OPTIONS, format_func=lambda spec: spec or "none")
+
+'''
+desc: "profile this rerun" checkbox. call it at the top of the dashboard and pass the result to metrics_panel() at the
+end
+output: enabled cProfile.Profile if the box is ticked, else None
+'''
+def start_profiler():
+    if not st.sidebar.checkbox("Profile this rerun"):
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+'''
+desc: sidebar panel of the timing spans and counters (totals of the streamlit server process, so every rerun and session
+since the last reset), and the profile of this rerun if it was profiled
+input: profiler - output of start_profiler()
+'''
+def metrics_panel(profiler=None):
+    if profiler is not None:
+        profiler.disable()
+    with st.sidebar.expander("Timings"):
+        if st.button("Reset timings"):
+            instrumentation.reset()
+        spans, counters = instrumentation.metrics_frames()
+        st.dataframe(spans[["Calls", "Total [s]", "Mean [ms]", "Max [ms]", "Rows"]])
+        st.dataframe(counters)
+    if profiler is not None:
+        st.sidebar.dataframe(instrumentation.profile_table(profiler), hide_index=True)
@@ -0,0 +1,270 @@
+import argparse
+import glob
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import instrumentation
+from dgo_io import read_raw_csv, read_dgo_csv, parse_run_name, SENSOR_CHANNELS
+"""
+DATA QUALITY -- scan the raw and compiled runs for timestamp gaps, duplicate timestamps, dropouts ("undefined"/empty
+rows), stuck sensors and out of range values, and the unit/days that have no run at all.
+
+Each run is scanned with whole-array operations over all of its channels at once (one NaN mask, one equal-to-previous
+mask, and the longest streak of each column from the edges of the mask), and the files are split over a process pool.
+Gaps and dropouts are measured against the run's own cadence, which isn't always the nominal 5 s (unit 3 logged every
+10-15 s). Every run gets one row:
+
+    ok      nothing worth mentioning
+    warn    something to know about (other cadence, small gaps, duplicate timestamps, a few out of range samples)
+    bad     the exit criteria can't be trusted on it: time going backwards, a gap or dropout of a detection channel of
+            MAX_GAP_MIN or more, a detection channel mostly missing or stuck for STUCK_MIN, or out of range
+
+compile_dgos() scans every raw file before segmenting it, leaves the bad ones out, and writes the rows to REPORT_NAME in
+the compiled folder. Fleet and backtest.py skip the runs the report marks bad, without opening them.
+"""
+
+REPORT_NAME = ".data_quality.csv"  # hidden so the *.csv globs of the compiled folder don't take it for a run
+NOMINAL_PERIOD_S = 5.0
+GAP_FACTOR = 3.0  # a step of more than 3 sample periods is a gap
+WARN_GAP_MIN = 1.0
+MAX_GAP_MIN = 10.0
+STUCK_MIN = 10.0
+MAX_MISSING_FRACTION = 0.5
+MAX_OUT_OF_RANGE_FRACTION = 0.01
+# thresholds a run is judged with, recorded in the compile manifest for the runs left out
+QUALITY_PARAMS = {"nominal_period_s": NOMINAL_PERIOD_S, "gap_factor": GAP_FACTOR, "warn_gap_min": WARN_GAP_MIN,
+                  "max_gap_min": MAX_GAP_MIN, "stuck_min": STUCK_MIN, "max_missing_fraction": MAX_MISSING_FRACTION,
+                  "max_out_of_range_fraction": MAX_OUT_OF_RANGE_FRACTION}
+
+DETECTION_CHANNELS = ["Intake SHT40", "Exhaust SHT40", "Intake Air RH", "Exhaust RH"]
+STUCK_CHANNELS = DETECTION_CHANNELS + ["Bucket Temp", "Watts"]  # measurements that always move a little
+VALID_RANGES = {"Intake SHT40": (-40.0, 125.0), "Exhaust SHT40": (-40.0, 125.0),  # SHT40 spec
+                "Intake Air RH": (0.0, 100.0), "Exhaust RH": (0.0, 100.0),
+                "Bucket Temp": (-40.0, 200.0), "Watts": (0.0, 2000.0), "V_rms ": (90.0, 140.0),
+                "Bucket Heater PWM": (0.0, 100.0), "Intake Heater PWM": (0.0, 100.0), "Grinder PWM": (0.0, 100.0),
+                "Intake Fan PWM": (0.0, 100.0), "Exhaust Fan PWM": (0.0, 100.0)}
+
+QUALITY_COLUMNS = ["Name", "Source", "Status", "Issues", "Rows", "Duration [min]", "Cadence [s]", "Gaps",
+                   "Longest Gap [min]", "Duplicate Times", "Backward Times", "Sentinel Rows",
+                   "Missing Detection [%]", "Longest Dropout [min]", "Longest Stuck [min]", "Out of Range"]
+
+'''
+desc: longest streak of True in every column of a mask
+input: mask - (samples x columns) boolean array
+output: int array, one per column
+'''
+def _longest_runs(mask):
+    n, c = mask.shape
+    padded = np.zeros((c, n + 2), dtype=np.int8)  # columns as rows, so the edges come out column by column
+    padded[:, 1:-1] = mask.T
+    edges = np.diff(padded, axis=1)
+    columns, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    longest = np.zeros(c, dtype=np.intp)
+    np.maximum.at(longest, columns, ends - starts)
+    return longest
+
+'''
+desc: quality checks of one run
+input: data - dataframe of the run (raw or compiled)
+       t_s - sample times [s]
+output: dict of QUALITY_COLUMNS (without Name/Source)
+'''
+def scan_run(data, t_s):
+    t_s = np.asarray(t_s, dtype=np.float64)
+    dt = np.diff(t_s)
+    cadence = float(np.median(dt[dt > 0])) if (dt > 0).any() else np.nan
+    gaps = dt > GAP_FACTOR * cadence
+    longest_gap = float(dt[gaps].max() / 60) if gaps.any() else 0.0
+
+    channels = [c for c in data.columns if c in SENSOR_CHANNELS]
+    values = data[channels].to_numpy(dtype=np.float64)
+    missing = np.isnan(values)
+    sentinel_rows = int(missing.all(axis=1).sum()) if channels else 0
+    longest_nan = dict(zip(channels, _longest_runs(missing) * cadence / 60))
+    # equal to the previous sample (NaN never is), so a streak of k is k + 1 equal samples
+    longest_same = dict(zip(channels, (_longest_runs(values[1:] == values[:-1]) + 1) * cadence / 60))
+
+    ranges = [(c, *VALID_RANGES[c]) for c in channels if c in VALID_RANGES]
+    out_of_range = {}
+    if ranges:
+        lo = np.array([r[1] for r in ranges])
+        hi = np.array([r[2] for r in ranges])
+        v = values[:, [channels.index(r[0]) for r in ranges]]
+        with np.errstate(invalid="ignore"):
+            counts = ((v < lo) | (v > hi)).sum(axis=0)
+        out_of_range = {r[0]: int(n) for r, n in zip(ranges, counts) if n}
+
+    detection = [c for c in DETECTION_CHANNELS if c in channels]
+    missing_detection = float(max((missing[:, channels.index(c)].mean() for c in detection), default=1.0))
+    dropout = float(max((longest_nan[c] for c in detection), default=np.nan))
+    stuck = {c: longest_same[c] for c in STUCK_CHANNELS if (c in channels) and (longest_same[c] >= STUCK_MIN)}
+
+    bad, warn = [], []
+    if (dt < 0).any():
+        bad.append(f"time goes backwards {int((dt < 0).sum())}x")
+    absent = [c for c in DETECTION_CHANNELS if c not in channels]
+    if absent:
+        bad.append(f"no {', '.join(absent)}")
+    if longest_gap >= MAX_GAP_MIN:
+        bad.append(f"{longest_gap:.0f} min gap")
+    elif gaps.any():
+        warn.append(f"{int(gaps.sum())} gaps (longest {longest_gap:.1f} min)")
+    if detection and missing_detection > MAX_MISSING_FRACTION:
+        bad.append(f"{missing_detection:.0%} of a detection channel missing")
+    if dropout >= MAX_GAP_MIN:
+        bad.append(f"{dropout:.0f} min dropout")
+    elif dropout >= WARN_GAP_MIN:
+        warn.append(f"{dropout:.1f} min dropout")
+    for c, minutes in stuck.items():
+        (bad if c in DETECTION_CHANNELS else warn).append(f"{c.strip()} stuck {minutes:.0f} min")
+    for c, n in out_of_range.items():
+        (bad if (c in DETECTION_CHANNELS) and (n > MAX_OUT_OF_RANGE_FRACTION * len(values)) else warn).append(
+            f"{c.strip()} out of range {n}x")
+    if (dt == 0).any():
+        warn.append(f"{int((dt == 0).sum())} duplicate times")
+    if abs(cadence - NOMINAL_PERIOD_S) > 0.1 * NOMINAL_PERIOD_S:
+        warn.append(f"cadence {cadence:g} s")
+
+    valid_t = t_s[~np.isnan(t_s)]
+    return {"Status": "bad" if bad else ("warn" if warn else "ok"),
+            "Issues": "; ".join(bad + warn),
+            "Rows": len(data),
+            "Duration [min]": float((valid_t[-1] - valid_t[0]) / 60) if len(valid_t) else np.nan,
+            "Cadence [s]": cadence,
+            "Gaps": int(gaps.sum()),
+            "Longest Gap [min]": longest_gap,
+            "Duplicate Times": int((dt == 0).sum()),
+            "Backward Times": int((dt < 0).sum()),
+            "Sentinel Rows": sentinel_rows,
+            "Missing Detection [%]": 100 * missing_detection,
+            "Longest Dropout [min]": dropout,
+            "Longest Stuck [min]": float(max((longest_same[c] for c in STUCK_CHANNELS if c in channels),
+                                             default=np.nan)),
+            "Out of Range": sum(out_of_range.values())}
+
+'''
+desc: quality row of a raw log (epoch ms times), e.g. right after it is read for compiling
+input: raw_data - dataframe of a raw log as read_raw_csv() gives it
+       name - run name
+output: dict of QUALITY_COLUMNS
+'''
+def scan_raw(raw_data, name):
+    with instrumentation.span("quality.scan", rows=len(raw_data)):
+        return {"Name": name, "Source": "raw", **scan_run(raw_data, raw_data["time"].to_numpy() / 1000)}
+
+'''
+desc: quality row of a file (runs in a worker process)
+input: filepath - raw (*_RAW.csv) or compiled csv
+output: dict of QUALITY_COLUMNS, and the worker's timing totals under "Metrics"
+'''
+def scan_file(filepath):
+    name = os.path.basename(filepath)[:-len(".csv")]
+    if name.endswith("_RAW"):
+        row = scan_raw(read_raw_csv(filepath, sensor_dtype=np.float64), name[:-len("_RAW")])
+    else:
+        data = read_dgo_csv(filepath, sensor_dtype=np.float64)
+        with instrumentation.span("quality.scan", rows=len(data)):
+            row = {"Name": name, "Source": "compiled", **scan_run(data, data["time"].to_numpy())}
+    # a worker's spans would never reach the parent, so they are sent back with the result
+    row["Metrics"] = instrumentation.snapshot(reset=True) if multiprocessing.parent_process() is not None else None
+    return row
+
+'''
+desc: scan many files on a process pool
+input: filepaths - raw and/or compiled csv's
+       workers - worker processes (None = one per core, 1 = in this process)
+output: dataframe of QUALITY_COLUMNS, one row per file
+'''
+def scan_files(filepaths, workers=None):
+    if (workers == 1) or (len(filepaths) <= 1):
+        rows = [scan_file(f) for f in filepaths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(scan_file, filepaths, chunksize=max(len(filepaths) // 32, 1)))
+    for row in rows:
+        instrumentation.merge(row.pop("Metrics"))
+    return pd.DataFrame(rows, columns=QUALITY_COLUMNS)
+
+'''
+desc: test days without a run, per unit
+input: names - run names
+       days - days every unit should have (default: the days of the test, run_catalog.RUN_DATES)
+output: dataframe of unit and missing days
+'''
+def missing_days(names, days=None):
+    if days is None:
+        from run_catalog import RUN_DATES
+        days = RUN_DATES.keys()
+    present = pd.DataFrame([parse_run_name(name) for name in names], columns=["Unit", "Day"]).dropna()
+    rows = [{"Unit": int(unit), "Missing Days": sorted(set(days) - set(group["Day"].astype(int)))}
+            for unit, group in present.groupby("Unit")]
+    return pd.DataFrame([r for r in rows if r["Missing Days"]], columns=["Unit", "Missing Days"])
+
+'''
+desc: the quality report of a compiled folder (empty if there is none yet)
+input: save_root - folder of the compiled dgo data
+output: dataframe of QUALITY_COLUMNS
+'''
+def load_report(save_root):
+    path = os.path.join(save_root, REPORT_NAME)
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=QUALITY_COLUMNS)
+    return pd.read_csv(path, keep_default_na=False, na_values=[""])
+
+'''
+desc: add or replace rows of the quality report of a compiled folder (written to a temp file first, like the manifest)
+input: save_root - folder of the compiled dgo data
+       rows - list of quality rows (dicts of QUALITY_COLUMNS)
+'''
+def save_report(save_root, rows):
+    if not rows:
+        return
+    new = pd.DataFrame(rows, columns=QUALITY_COLUMNS)
+    report = load_report(save_root)
+    report = pd.concat([report[~report["Name"].isin(new["Name"])], new], ignore_index=True) if len(report) else new
+    os.makedirs(save_root, exist_ok=True)
+    path = os.path.join(save_root, REPORT_NAME)
+    report.sort_values("Name").to_csv(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+'''
+desc: runs the quality report of a compiled folder marks bad
+input: save_root - folder of the compiled dgo data
+output: set of run names (empty without a report)
+'''
+def excluded_runs(save_root):
+    report = load_report(save_root)
+    return set(report.loc[report["Status"] == "bad", "Name"])
+
+
+if __name__ == "__main__":
+    from extrapolate_dgo import RAW_DATA_DIR, DGO_DATA_DIR, find_raw_files
+    parser = argparse.ArgumentParser(description="scan the raw (or compiled) runs for gaps, dropouts, stuck sensors, "
+                                                 "out of range values and missing days")
+    parser.add_argument("--raw-root", default=RAW_DATA_DIR)
+    parser.add_argument("--save-root", default=DGO_DATA_DIR, help="folder of the compiled csv's")
+    parser.add_argument("--compiled", action="store_true", help="scan the compiled csv's instead of the raw ones")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--save", action="store_true",
+                        help=f"write the rows to {REPORT_NAME} in the compiled folder (what compile_dgos() keeps)")
+    parser.add_argument("--out", default=None, help="write the table to this csv")
+    args = parser.parse_args()
+
+    filepaths = sorted(glob.glob(os.path.join(args.save_root, "*.csv"))) if args.compiled \
+        else find_raw_files(args.raw_root)
+    t0 = time.perf_counter()
+    table = scan_files(filepaths, args.workers)
+    print(f"{len(table)} files in {time.perf_counter() - t0:.2f} s, "
+          f"{(table['Status'] == 'bad').sum()} bad, {(table['Status'] == 'warn').sum()} warn")
+    print(table.drop(columns=["Source"]).round(2).to_string(index=False))
+    missing = missing_days(table["Name"])
+    if len(missing):
+        print(missing.to_string(index=False))
+    if args.save:
+        save_report(args.save_root, table.to_dict("records"))
+    if args.out is not None:
+        table.to_csv(args.out, index=False)
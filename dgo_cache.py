@@ -0,0 +1,335 @@
+from collections import OrderedDict
+import os
+import sys
+import threading
+import numpy as np
+import pandas as pd
+from dgo_store import read_compiled
+from instrumentation import span, count as count_metric
+"""
+Cached data layer for the dashboards. Streamlit reruns the whole script on every widget change, so everything that only
+depends on the data files (the loaded runs, the delta series, the crossing indexes, ...) is kept here instead of being
+rebuilt every time a threshold is edited.
+
+The cache is a module level LRU, so it is shared by every rerun and every session of the streamlit server process (and
+by all the dashboards run from it). It is bounded by the (estimated) bytes it holds rather than by a number of entries,
+and every entry remembers the mtime/size of the file it was built from: when the file changes (e.g. compile_dgos()
+re-wrote it) the entry is dropped and rebuilt on the next access.
+
+Cached values are shared between sessions, so they must be treated as read-only. The numpy arrays handed out are
+flagged as not writeable to catch mistakes.
+"""
+
+DGO_DATA_DIR = "./125C_DATA/O2_DGO_DATA"
+CACHE_MAX_BYTES = int(os.environ.get("DGO_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+# channels the dashboards use, the other sensor columns aren't loaded
+DASHBOARD_COLUMNS = ["time", "Intake SHT40", "Exhaust SHT40", "Intake Air RH", "Exhaust RH"]
+
+'''
+desc: thread safe LRU cache of values built from files, bounded by the bytes it holds
+input: max_bytes - memory budget of the cache [bytes]. an entry bigger than the whole budget is returned but not kept
+'''
+class DatasetCache:
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (signature, value, nbytes), least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # key -> [lock, users] while the key is being built, so two sessions asking for the same miss only build it once
+        self._key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    '''
+    desc: get a cached value, building it on a miss or when the file it was built from changed
+    input: key - hashable key of the value, its first element must be the path of the file it depends on
+           build - function () -> value, called on a miss
+    output: value
+    '''
+    def get(self, key, build):
+        signature = file_signature(key[0])
+        value = self._lookup(key, signature)
+        if value is not _MISSING:
+            return value
+
+        lock = self._acquire_key_lock(key)
+        try:
+            with lock:
+                # another session may have built it while we were waiting
+                value = self._lookup(key, signature, count=False)
+                if value is not _MISSING:
+                    return value
+                with span(f"cache.build.{key[1]}"):
+                    value = build()
+                self._store(key, signature, value)
+        finally:
+            self._release_key_lock(key)
+        return value
+
+    '''
+    desc: look up a key, dropping the entry if its file changed
+    input: key, signature - key and current signature of its file
+           count - count the hit/miss in the stats
+    output: value, or _MISSING
+    '''
+    def _lookup(self, key, signature, count=True):
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None) and (entry[0] != signature):
+                self._drop(key)
+                self.invalidations += 1
+                entry = None
+            if entry is None:
+                if count:
+                    self.misses += 1
+                    count_metric("cache.misses")
+                return _MISSING
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+                count_metric("cache.hits")
+            return entry[1]
+
+    '''
+    desc: add a value and evict the least recently used entries until it fits the budget
+    '''
+    def _store(self, key, signature, value):
+        nbytes = estimate_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if nbytes > self.max_bytes:
+                return
+            self._entries[key] = (signature, value, nbytes)
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    '''
+    desc: remove an entry (the lock must be held)
+    '''
+    def _drop(self, key):
+        _, _, nbytes = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    '''
+    desc: lock of a key, created by the first session that needs it
+    '''
+    def _acquire_key_lock(self, key):
+        with self._lock:
+            entry = self._key_locks.get(key)
+            if entry is None:
+                entry = self._key_locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    '''
+    desc: done with the lock of a key, it is deleted once no session is building or waiting for the key
+    '''
+    def _release_key_lock(self, key):
+        with self._lock:
+            entry = self._key_locks[key]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._key_locks[key]
+
+    '''
+    desc: drop the entries built from a file, or everything
+    input: path - file whose entries are dropped (None for all)
+    output: number of entries dropped
+    '''
+    def invalidate(self, path=None):
+        with self._lock:
+            keys = [k for k in self._entries if (path is None) or (k[0] == os.path.abspath(path))]
+            for key in keys:
+                self._drop(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    '''
+    desc: hit/miss stats of the cache
+    output: dict of hits, misses, hit rate, evictions, invalidations, entries, bytes and max bytes
+    '''
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit rate": self.hits / lookups if lookups else np.nan,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations,
+                    "entries": len(self._entries),
+                    "bytes": self._bytes,
+                    "max bytes": self.max_bytes}
+
+_MISSING = object()
+
+'''
+desc: signature of a file, used to notice that it changed since a value was built from it
+input: path - file
+output: (mtime_ns, size), or None if the file doesn't exist
+'''
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+'''
+desc: rough size in memory of a cached value (dataframes, series, arrays, dicts/lists of them, and plain objects holding
+them, e.g. a CrossingIndex). a view of an array is counted as the whole buffer it keeps alive, once per buffer
+input: value
+output: bytes
+'''
+def estimate_nbytes(value, _seen=None):
+    _seen = set() if _seen is None else _seen
+    if id(value) in _seen:
+        return 0
+    _seen.add(id(value))
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        usage = value.memory_usage(deep=True, index=True)
+        return int(usage.sum() if isinstance(usage, pd.Series) else usage)
+    if isinstance(value, np.ndarray):
+        base = value
+        while isinstance(base.base, np.ndarray):
+            base = base.base
+        if base is value:
+            return value.nbytes
+        if id(base) in _seen:
+            return 0
+        _seen.add(id(base))
+        return max(base.nbytes, value.nbytes)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_nbytes(v, _seen) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(estimate_nbytes(v, _seen) for v in value)
+    if hasattr(value, "__dict__"):
+        return sys.getsizeof(value) + sum(estimate_nbytes(v, _seen) for v in vars(value).values())
+    return sys.getsizeof(value)
+
+'''
+desc: flag the numpy arrays of a cached value as read-only, since it is shared between sessions
+'''
+def _freeze(value):
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    elif isinstance(value, dict):
+        for v in value.values():
+            _freeze(v)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _freeze(v)
+    return value
+
+# shared by every session of the server process
+_cache = DatasetCache()
+
+'''
+desc: path of a compiled run
+input: dataname - name of the run, e.g. O2-DVT-DGO-1_D1
+       data_root - folder of the compiled csv's
+output: absolute path of the csv
+'''
+def run_filepath(dataname, data_root=DGO_DATA_DIR):
+    return os.path.abspath(os.path.join(data_root, f"{dataname}.csv"))
+
+'''
+desc: load a compiled run through the cache
+input: filepath - compiled dgo csv
+       columns - channels to load (time is always loaded; None for all)
+       calibrated - apply the sensor calibration (see calibration). the calibrated run is cached under the version of
+                    the calibration table and run catalog, so it is rebuilt when either changes
+output: dgo_data - dataframe (float64 channels, same values as pd.read_csv). read from the columnar store when the run
+        is in it (see dgo_store.read_compiled()). shared, don't modify it
+'''
+def load_run(filepath, columns=DASHBOARD_COLUMNS, calibrated=False):
+    filepath = os.path.abspath(filepath)
+    columns = None if columns is None else tuple(columns)
+    if calibrated:
+        import calibration
+        return _cache.get((filepath, "calibrated_run", columns, calibration.calibration_signature()),
+                          lambda: calibration.load_calibrated(filepath, None if columns is None else list(columns)))
+    return _cache.get((filepath, "run", columns),
+                      lambda: read_compiled(filepath, None if columns is None else list(columns)))
+
+'''
+desc: cache something derived from a compiled run (indexes, moisture series, features, ...)
+input: filepath - compiled dgo csv
+       name - name of the derived value, part of the cache key along with the args
+       build - function (dgo_data, *args) -> value, given the run loaded with the columns
+       args - extra hashable arguments of build (e.g. the pressure for the moisture series)
+       columns - channels build needs
+       calibrated - build it from the calibrated run (see load_run())
+output: value. shared, don't modify it
+'''
+def load_derived(filepath, name, build, *args, columns=DASHBOARD_COLUMNS, calibrated=False):
+    filepath = os.path.abspath(filepath)
+    key = (filepath, name, args, None if columns is None else tuple(columns))
+    if calibrated:
+        import calibration
+        key += ("calibrated", calibration.calibration_signature())
+    return _cache.get(key, lambda: _freeze(build(load_run(filepath, columns, calibrated), *args)))
+
+'''
+desc: time and delta series of a run (exhaust - intake)
+input: dgo_data - dataframe of a compiled run
+output: dict of "t_min" (time [min]), "t_end" (last time [min]), "SHT40" and "RH" (delta series) numpy arrays
+'''
+def run_deltas(dgo_data):
+    t_min = dgo_data["time"].to_numpy(dtype=np.float64) / 60
+    valid = np.flatnonzero(~np.isnan(t_min))
+    return {"t_min": t_min,
+            "t_end": float(t_min[valid[-1]]) if len(valid) else np.nan,
+            "SHT40": (dgo_data["Exhaust SHT40"] - dgo_data["Intake SHT40"]).to_numpy(dtype=np.float64),
+            "RH": (dgo_data["Exhaust RH"] - dgo_data["Intake Air RH"]).to_numpy(dtype=np.float64)}
+
+'''
+desc: cached delta series of a run, see run_deltas()
+input: filepath - compiled dgo csv
+       calibrated - from the calibrated run
+output: dict of numpy arrays (read-only)
+'''
+def load_deltas(filepath, calibrated=False):
+    return load_derived(filepath, "deltas", run_deltas, calibrated=calibrated)
+
+'''
+desc: cached crossing indexes of a run (see threshold_index.build_run_index())
+input: filepath - compiled dgo csv
+       calibrated - from the calibrated run
+       smoothing - filter spec of the deltas (see filters), None for the raw deltas
+output: dict of signal -> CrossingIndex
+'''
+def load_crossing_index(filepath, calibrated=False, smoothing=None):
+    from threshold_index import build_run_index
+    return load_derived(filepath, "crossing_index", build_run_index, smoothing, calibrated=calibrated)
+
+'''
+desc: drop the cached values of a file (or of everything), e.g. after re-compiling the runs in the same process
+input: path - file (None for all)
+output: number of entries dropped
+'''
+def invalidate(path=None):
+    return _cache.invalidate(path)
+
+'''
+desc: hit/miss stats of the shared cache
+output: dict, see DatasetCache.stats()
+'''
+def cache_stats():
+    return _cache.stats()
+
+'''
+desc: hit/miss stats of the shared cache as a one column table, for st.sidebar.dataframe()
+output: dataframe
+'''
+def cache_stats_frame():
+    stats = cache_stats()
+    stats["bytes"] = f"{stats['bytes'] / 1024 ** 2:.1f} MB"
+    stats["max bytes"] = f"{stats['max bytes'] / 1024 ** 2:.1f} MB"
+    stats["hit rate"] = f"{stats['hit rate']:.1%}" if not np.isnan(stats["hit rate"]) else "-"
+    return pd.DataFrame({"Dataset Cache": [str(v) for v in stats.values()]}, index=list(stats.keys()))
@@ -0,0 +1,176 @@
+import os
+import re
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from instrumentation import span
+"""
+Typed loaders for the raw rig csv's and the compiled dgo csv's.
+
+The raw csv's start with a UTF-8 BOM and a first row of "undefined"/empty values (and sometimes have "undefined" rows
+in the middle of a run when the scale drops out). With a plain pd.read_csv those rows turn the sensor columns into
+object columns. These loaders declare the dtype of every known channel up front instead: time is int64 epoch ms
+(float64 seconds in the compiled files) and every sensor is float32 with the sentinels read as NaN. float32 is for the
+in-memory analysis reads only: whatever is written back out (the compile, the cycle segmentation, the gateway) reads the
+sensors as float64, so the written csv's keep the logged values instead of their float32 rounding.
+"""
+
+# channels logged by the rigs, in the order they appear in the raw csv's (unit 1 doesn't log the inductance)
+SENSOR_CHANNELS = ["Ohaus Tare Weight", "Ohaus Water Weight", "Ohaus Weight", "Bucket Temp",
+                   "Bucket Temp 2 (Figure out later lol)", "Intake Air RH", "Exhaust RH", "Grinder PWM", "Grinder RPM",
+                   "Stable Mass ", "Intake Fan PWM", "Intake Fan RPM", "Exhaust Fan PWM", "Exhaust Fan RPM",
+                   "Intake SHT40", "Exhaust SHT40", "V_rms ", "I_rms", "Watts", "Bucket Heater PWM",
+                   "Intake Heater PWM", "Inductance/10000"]
+
+RAW_SCHEMA = {"time": np.int64, **{channel: np.float32 for channel in SENSOR_CHANNELS}}
+
+SENTINELS = ["undefined", ""]
+
+# the D1-D7 dates of the test (3/6/24 ... 3/18/24) are the dates of the epoch ms timestamps in US pacific time
+RIG_TIMEZONE = "America/Los_Angeles"
+
+# O2-DVT-DGO-{unit}_D{day}[_RAW].csv
+RUN_NAME_PATTERN = re.compile(r"^(?P<prefix>.*?)-(?P<unit>\d+)_D(?P<day>\d+)")
+
+'''
+desc: check if the pyarrow csv engine can be used
+output: True if pyarrow is installed
+'''
+def has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+'''
+desc: split a run name or file name like O2-DVT-DGO-1_D3_RAW.csv into its unit and day
+input: name - run name, file name, or path
+output: unit, day - ints (None, None if the name doesn't follow the naming convention)
+'''
+def parse_run_name(name):
+    match = RUN_NAME_PATTERN.match(os.path.basename(name))
+    if match is None:
+        return None, None
+    return int(match["unit"]), int(match["day"])
+
+'''
+desc: read the header of a csv to find which columns it has
+input: filepath - csv file
+output: list of column names
+'''
+def read_columns(filepath):
+    return list(pd.read_csv(filepath, nrows=0, encoding="utf-8-sig").columns)
+
+'''
+desc: read_csv with the dtypes of the declared schema and the sentinels as NaN. the time column is read as float so that
+rows without a time can be dropped before it is cast to its real dtype. channels that aren't in the schema are read as
+sensor channels too. the c engine takes the dtypes as a default so the header doesn't need to be read separately, the
+pyarrow engine needs the exact columns
+input: filepath - csv file
+       columns - columns to load (None for all)
+       time_dtype - dtype of the time column
+       sensor_dtype - dtype of every other column
+       engine - "c" (default), "pyarrow", or None to use pyarrow when it is installed
+       skip_index - don't keep the first column (the index column written by to_csv in the compiled csv's)
+output: dataframe
+'''
+def _read_typed_csv(filepath, columns, time_dtype, sensor_dtype, engine, skip_index=False):
+    if engine is None:
+        engine = "pyarrow" if has_pyarrow() else "c"
+    usecols = None if columns is None else ["time"] + [c for c in columns if c != "time"]
+
+    if engine == "pyarrow":
+        header = read_columns(filepath)[1 if skip_index else 0:]
+        if usecols is None:
+            usecols = header
+        dtype = {c: (np.float64 if c == "time" else sensor_dtype) for c in usecols}
+        data = pd.read_csv(filepath, usecols=usecols, dtype=dtype, na_values=SENTINELS, keep_default_na=False,
+                           encoding="utf-8-sig", engine="pyarrow")
+        data = data[[c for c in header if c in usecols]]  # pyarrow doesn't keep the file's column order
+    else:
+        dtype = defaultdict(lambda: sensor_dtype, time=np.float64)
+        if usecols is None:
+            index_col = 0 if skip_index else None
+        else:
+            # a callable also leaves out the unnamed index column of the compiled csv's
+            wanted = set(usecols)
+            usecols, index_col = (lambda c: c in wanted), None
+        data = pd.read_csv(filepath, usecols=usecols, dtype=dtype, na_values=SENTINELS, keep_default_na=False,
+                           encoding="utf-8-sig", engine="c", index_col=index_col)
+        if (columns is not None) and (len(data.columns) < len(wanted)):
+            raise KeyError(f"{filepath} has no column(s) {sorted(wanted - set(data.columns))}")
+
+    if data["time"].isna().any():
+        data = data[data["time"].notna()]
+    data = data.reset_index(drop=True)
+    data["time"] = data["time"].astype(time_dtype)
+    return data
+
+'''
+desc: load a raw rig csv (e.g. O2-DVT-DGO-1_D1_RAW.csv) with the declared schema
+input: filepath - raw data csv
+       columns - columns to load, e.g. ["Intake SHT40"] (time is always loaded; None for all)
+       sensor_dtype - dtype of the sensor columns (float32 by default)
+       engine - "c" (default), "pyarrow", or None to use pyarrow when it is installed
+output: raw_data - dataframe with int64 epoch ms time and a 0..n-1 index
+'''
+def read_raw_csv(filepath, columns=None, sensor_dtype=np.float32, engine="c"):
+    with span("load.read_raw_csv", nbytes=_file_size(filepath)) as s:
+        raw_data = _read_typed_csv(filepath, columns, np.int64, sensor_dtype, engine)
+        s.rows = len(raw_data)
+    return raw_data
+
+'''
+desc: load a compiled dgo csv (e.g. O2_DGO_DATA/O2-DVT-DGO-1_D1.csv) with the declared schema, dropping the index column
+that to_csv writes
+input: filepath - compiled dgo csv
+       columns - columns to load (time is always loaded; None for all)
+       sensor_dtype - dtype of the sensor columns (float32 by default)
+       engine - "c" (default), "pyarrow", or None to use pyarrow when it is installed
+output: dgo_data - dataframe with float64 time [s] and a 0..n-1 index
+'''
+def read_dgo_csv(filepath, columns=None, sensor_dtype=np.float32, engine="c"):
+    with span("load.read_dgo_csv", nbytes=_file_size(filepath)) as s:
+        dgo_data = _read_typed_csv(filepath, columns, np.float64, sensor_dtype, engine, skip_index=True)
+        s.rows = len(dgo_data)
+    return dgo_data
+
+'''
+desc: size of a file for the load metrics (0 for buffers)
+'''
+def _file_size(filepath):
+    return os.path.getsize(filepath) if isinstance(filepath, (str, os.PathLike)) else 0
+
+'''
+desc: read a raw rig csv in fixed size chunks with the declared schema, for logs too long to load at once (e.g. a rig that
+logged continuously for days). rows without a time are dropped like read_raw_csv() does, and the index keeps counting
+across chunks, so it is the same positional index read_raw_csv() would give the whole file
+input: filepath - raw data csv
+       chunksize - rows per chunk
+       columns - columns to load (time is always loaded; None for all)
+       sensor_dtype - dtype of the sensor columns (float32 by default)
+output: generator of dataframes with int64 epoch ms time
+'''
+def iter_raw_csv(filepath, chunksize=100_000, columns=None, sensor_dtype=np.float32):
+    dtype = defaultdict(lambda: sensor_dtype, time=np.float64)
+    usecols = None
+    if columns is not None:
+        wanted = {"time", *columns}
+        usecols = lambda c: c in wanted
+    position = 0
+    with pd.read_csv(filepath, usecols=usecols, dtype=dtype, na_values=SENTINELS, keep_default_na=False,
+                     encoding="utf-8-sig", engine="c", chunksize=chunksize) as reader:
+        chunks = iter(reader)
+        while True:
+            with span("load.read_raw_chunk") as s:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                chunk = chunk[chunk["time"].notna()]
+                chunk.index = pd.RangeIndex(position, position + len(chunk))
+                chunk["time"] = chunk["time"].astype(np.int64)
+                position += len(chunk)
+                s.rows = len(chunk)
+            if len(chunk):
+                yield chunk
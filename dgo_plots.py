@@ -0,0 +1,209 @@
+import pandas as pd
+from plotly import graph_objects as go
+from threshold_index import build_run_index
+from psychrometrics import moisture_series, STANDARD_PRESSURE
+from dgo_cache import load_derived, load_crossing_index
+from instrumentation import span
+from plot_downsample import decimated_trace
+from filters import parse_filter
+from run_features import load_energy, energy_curve, energy_at
+"""
+Figures and stats tables of the dashboards, importable without streamlit so the batch report (report.py) draws exactly
+what the dashboards show.
+"""
+
+# columns of the stats tables, one row per run
+RH_STATS_COLUMNS = ["Name", "Runtime End", "Time @ RH Threshold", "Diff. in Time (RH)", "MR @ RH Threshold [g/kg]",
+                    "Energy Saved (RH) [Wh]"]
+SHT40_STATS_COLUMNS = ["Name", "Runtime End", "Time @ SHT40 Threshold", "Diff. in Time (SHT40)",
+                       "MR @ SHT40 Threshold [g/kg]", "Energy Saved (SHT40) [Wh]"]
+
+
+'''
+desc: plots ONE dataset
+input: dataname - name of the dataset to be analyzed
+       csv - csv of the dataset to be analyzed --> already processed and contains runtime data only
+       total_pressure - atmospheric pressure of the site [hPa], used for the mixing ratio
+       filepath - csv file the dataset was loaded from, to take the index/mixing ratio from the dataset cache
+       x_range - time window being looked at [min], the traces are decimated to the screen resolution inside it
+       downsample_method - "minmax" or "lttb" (see plot_downsample)
+       calibrated - csv is the calibrated run, take the cached index/mixing ratio of the calibrated run too
+       smoothing - filter spec the deltas are smoothed with (see filters), the thresholds are checked on the smoothed
+                   deltas and those are plotted. None for the raw deltas
+output: fig, the run's row of the RH and SHT40 stats tables (dicts of RH_STATS_COLUMNS/SHT40_STATS_COLUMNS), and the
+        [time, value] of the RH and SHT40 threshold crossings
+'''
+def plot_dgo(dataname, csv, rh_threshold, sht40_threshold, total_pressure=STANDARD_PRESSURE, filepath=None,
+             x_range=None, downsample_method="minmax", calibrated=False, smoothing=None):
+
+    t = csv["time"] /60 # time in minutes
+    t_end = t[t.last_valid_index()]
+    rh_delta = csv["Exhaust RH"] - csv["Intake Air RH"]
+    # rh_delta = csv["Exhaust RH"]
+    sht40_delta = csv["Exhaust SHT40"] - csv["Intake SHT40"]
+    smoother = parse_filter(smoothing)
+    if smoother is not None:
+        rh_delta, sht40_delta = smoother.batch(rh_delta), smoother.batch(sht40_delta)
+
+
+    # plot the delta data as is
+    fig = go.Figure()
+    fig.add_trace(decimated_trace(t, rh_delta, f"RH_Delta_{dataname}", x_range=x_range, method=downsample_method))
+    fig.add_trace(decimated_trace(t, sht40_delta, f"SHT40_Delta_{dataname}", x_range=x_range, method=downsample_method))
+
+
+    t_rh_threshold = None
+    val_rh_threshold = None
+    dt_rh = None
+    mr_rh = None
+
+    t_sht40_threshold = None
+    val_sht40_threshold = None
+    dt_sht40 = None
+    mr_sht40 = None
+
+    # exhaust mixing ratio [g/kg] of the whole run, read at the thresholds
+    if filepath is None:
+        index = build_run_index(csv, smoothing)
+        mr = moisture_series(csv, total_pressure)["Exhaust Mixing Ratio"]
+    else:
+        index = load_crossing_index(filepath, calibrated, smoothing)
+        mr = load_derived(filepath, "moisture", moisture_series, total_pressure,
+                          calibrated=calibrated)["Exhaust Mixing Ratio"]
+
+    if rh_threshold is not None:
+        # determine where the thresholds are crossed (interpolated between the samples on either side)
+        rh_threshold_index = int(index["RH"].first_index(rh_threshold))  # first sample after the crossing
+
+        if rh_threshold_index >= 0:
+            t_rh_threshold = float(index["RH"].first_time(rh_threshold)) # minutes
+            val_rh_threshold = rh_threshold # value of the dataset when the rh threshold is crossed
+            dt_rh = t_end - t_rh_threshold # minutes
+            mr_rh = mr[rh_threshold_index]
+            # fig.add_trace(go.Scatter(mode='markers', x=[t_rh_threshold], y=[val_rh_threshold], name=f"RH Threshold_{dataname}"))
+
+    if sht40_threshold is not None:
+        sht40_threshold_index = int(index["SHT40"].first_index(sht40_threshold))
+
+        if sht40_threshold_index >= 0:
+            t_sht40_threshold = float(index["SHT40"].first_time(sht40_threshold))
+            val_sht40_threshold = sht40_threshold
+            dt_sht40 = t_end - t_sht40_threshold
+            mr_sht40 = mr[sht40_threshold_index]
+            # fig.add_trace(go.Scatter(mode='markers', x=[t_sht40_threshold], y=[val_sht40_threshold], name=f"SHT40 Threshold_{dataname}"))
+
+    # energy stopping at the thresholds would have saved [Wh]
+    energy = load_energy(filepath) if filepath is not None else (energy_curve(csv) if "Watts" in csv else None)
+    saved_rh, saved_sht40 = None, None
+    if energy is not None:
+        e_end, e_rh, e_sht40 = energy_at(energy, [t_end] + [t if t is not None else float("nan")
+                                                           for t in (t_rh_threshold, t_sht40_threshold)])
+        saved_rh, saved_sht40 = e_end - e_rh, e_end - e_sht40
+
+    # one row of each stats table, the tables are built once all the runs are plotted
+    rh_row = dict(zip(RH_STATS_COLUMNS, [dataname, t_end, t_rh_threshold, dt_rh, mr_rh, saved_rh]))
+    sht40_row = dict(zip(SHT40_STATS_COLUMNS, [dataname, t_end, t_sht40_threshold, dt_sht40, mr_sht40, saved_sht40]))
+
+
+    fig.update_layout(title=f"RH and SHT40 Differentials for {dataname}",
+                  xaxis_title="Time [min]",
+                  yaxis_title="Delta Data",
+                  height=800,
+                  width=1000,
+                  )
+    fig.update_xaxes(color="black", title_font_color="black")
+    fig.update_yaxes(color="black", title_font_color="black")
+
+    return fig, rh_row, sht40_row, [t_rh_threshold, val_rh_threshold], [t_sht40_threshold, val_sht40_threshold]
+
+'''
+desc: RH and SHT40 differentials of every run of one unit in one figure, with the threshold crossings marked (the per
+unit figures of temp_rh_delta.py)
+input: unit_fleet - Fleet of the unit's runs
+       unit - unit number (for the names and title)
+       rh_threshold, sht40_threshold, total_pressure, x_range, downsample_method, smoothing - see plot_dgo()
+output: fig, list of the RH stats rows and list of the SHT40 stats rows of the runs
+'''
+def unit_figure(unit_fleet, unit, rh_threshold, sht40_threshold, total_pressure=STANDARD_PRESSURE, x_range=None,
+                downsample_method="minmax", smoothing=None):
+    rh_rows, sht40_rows = [], []
+    rh_thresh_met = [[],[]]  # list of [times],[values]
+    sht40_thresh_met = [[],[]]
+    d = ()
+    for name, day in zip(unit_fleet.names, unit_fleet.runs["Day"]):
+        filepath = unit_fleet.path(name)
+        data = unit_fleet.load(name)  # cached across reruns, see dgo_cache
+        dataname = f"DGO-{unit}_D{day}"
+
+        with span("render.plot_dgo", rows=len(data)):
+            fig, rh_row, sht40_row, rh, sht40 = plot_dgo(dataname, data, rh_threshold, sht40_threshold,
+                                                         total_pressure, filepath, x_range, downsample_method,
+                                                         unit_fleet.calibrated, smoothing)
+        d += fig.data
+        rh_rows.append(rh_row)
+        sht40_rows.append(sht40_row)
+
+        rh_thresh_met[0].append(rh[0])
+        rh_thresh_met[1].append(rh[1])
+        sht40_thresh_met[0].append(sht40[0])
+        sht40_thresh_met[1].append(sht40[1])
+
+    fig_total = go.Figure(data = d)
+    fig_total.add_trace(go.Scatter(x=rh_thresh_met[0],
+                                   y=rh_thresh_met[1],
+                                   mode='markers',
+                                   name="RH Threshold",
+                                   marker=dict(color="red", symbol="diamond")))  # add the threshold markers here
+    fig_total.add_trace(go.Scatter(x=sht40_thresh_met[0],
+                                   y=sht40_thresh_met[1],
+                                   mode='markers',
+                                   name="SHT40 Threshold",
+                                   marker=dict(color="blue", symbol="diamond")))
+    fig_total.update_layout(title=f"RH and SHT40 Differentials for O2-DVT-DGO-{unit}",
+                    xaxis_title="Time [min]",
+                    yaxis_title="Delta Data",
+                    height=900,
+                    width=1000,
+                    )
+    fig_total.update_xaxes(color="black", title_font_color="black")
+    fig_total.update_yaxes(color="black", title_font_color="black")
+    if x_range is not None:
+        fig_total.update_xaxes(range=x_range)
+    return fig_total, rh_rows, sht40_rows
+
+'''
+desc: the RH and SHT40 stats tables from the rows of plot_dgo()
+input: rh_rows, sht40_rows - lists of the rows
+output: rh_stats, sht40_stats - dataframes (NaN where a threshold isn't met)
+'''
+def stats_tables(rh_rows, sht40_rows):
+    r = pd.DataFrame(rh_rows, columns=RH_STATS_COLUMNS)
+    s = pd.DataFrame(sht40_rows, columns=SHT40_STATS_COLUMNS)
+    r[RH_STATS_COLUMNS[1:]] = r[RH_STATS_COLUMNS[1:]].astype(float)  # None (threshold not met) as NaN
+    s[SHT40_STATS_COLUMNS[1:]] = s[SHT40_STATS_COLUMNS[1:]].astype(float)
+    return r, s
+
+'''
+desc: SHT40 and RH differentials of every run of a fleet, one figure each (the figures of inspect_125op.py)
+input: fleet - Fleet
+       x_range, downsample_method - see plot_dgo()
+output: fig_sht40, fig_rh
+'''
+def delta_figures(fleet, x_range=None, downsample_method="minmax"):
+    fig_sht40 = go.Figure()
+    fig_rh = go.Figure()
+    deltas = fleet.deltas()  # time [min] and deltas of all the runs back to back
+    with span("render.traces", rows=len(deltas["time"].values)):
+        for i, (dvt, day) in enumerate(zip(fleet.runs["Unit"], fleet.runs["Day"])):
+            fig_sht40.add_trace(decimated_trace(deltas["time"][i], deltas["SHT40"][i], f"O2-DGO-{dvt}_D{day}",
+                                                x_range=x_range, method=downsample_method))
+            fig_rh.add_trace(decimated_trace(deltas["time"][i], deltas["RH"][i], f"O2-DGO-{dvt}_D{day}",
+                                             x_range=x_range, method=downsample_method))
+    fig_sht40.update_layout(title="SHT 40",xaxis_title="Time [min]", yaxis_title="SHT40 Diff. [degC]",
+                             height=500, width=1000)
+    fig_rh.update_layout(title="RH", xaxis_title="Time [min]", yaxis_title="RH Diff.",
+                             height=500, width=1000)
+    if x_range is not None:
+        fig_sht40.update_xaxes(range=x_range)
+        fig_rh.update_xaxes(range=x_range)
+    return fig_sht40, fig_rh
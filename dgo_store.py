@@ -0,0 +1,147 @@
+import os
+import numpy as np
+import pandas as pd
+from dgo_io import parse_run_name, read_dgo_csv
+"""
+Columnar store of the compiled dgo runs, one file per unit/day:
+
+    {store_root}/unit={unit}/O2-DVT-DGO-{unit}_D{day}.arrow    (or .parquet)
+
+Arrow IPC files are written uncompressed so they can be memory-mapped and the requested channels read without copying
+or re-parsing any text. Parquet is smaller on disk but has to be decoded on read. Both need pyarrow, which is only
+imported when the store is used.
+
+read_compiled() is how the compiled runs are loaded (dataset cache, calibration, backtest, features): it opens the run
+from the store next to the compiled folder when compile_dgos(store_root=...) wrote it there, and parses the csv when it
+didn't (or pyarrow isn't installed).
+"""
+
+STORE_DIR = "./125C_DATA/O2_DGO_STORE"
+STORE_FORMATS = {"arrow": ".arrow", "parquet": ".parquet"}
+
+'''
+desc: import pyarrow (only needed for the store)
+output: pyarrow module
+'''
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("the columnar dgo store needs pyarrow (pip install pyarrow)") from e
+    return pyarrow
+
+'''
+desc: path of a run in the store
+input: store_root - folder of the store
+       dataname - name of the run, e.g. O2-DVT-DGO-1_D1
+       fmt - "arrow" or "parquet"
+output: path
+'''
+def run_path(store_root, dataname, fmt="arrow"):
+    unit, _ = parse_run_name(dataname)
+    return os.path.join(store_root, f"unit={unit}", dataname + STORE_FORMATS[fmt])
+
+'''
+desc: write a compiled run to the store. the columns are written from their numpy arrays so NaN stays NaN instead of
+becoming an arrow null, which keeps the reads zero-copy
+input: dgo_data - dataframe of the extrapolated dgo data (output of extrapolate_dgo())
+       store_root - folder of the store
+       dataname - name of the run, e.g. O2-DVT-DGO-1_D1
+       fmt - "arrow" or "parquet"
+output: path the run was written to
+'''
+def write_run(dgo_data, store_root, dataname, fmt="arrow"):
+    pa = _pyarrow()
+    path = run_path(store_root, dataname, fmt)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.table({c: pa.array(dgo_data[c].to_numpy()) for c in dgo_data.columns})
+
+    # write to a temp file first so a reader never maps half a file
+    tmp = path + ".tmp"
+    if fmt == "arrow":
+        with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        pa.parquet.write_table(table, tmp)
+    os.replace(tmp, path)
+    return path
+
+'''
+desc: open a run from the store as an arrow table. arrow files are memory-mapped so only the pages of the selected
+columns are ever read from disk
+input: path - path of the run (see run_path())
+       columns - channels to load (time is always loaded; None for all)
+output: pyarrow table
+'''
+def read_run_table(path, columns=None):
+    pa = _pyarrow()
+    if columns is not None:
+        columns = ["time"] + [c for c in columns if c != "time"]
+    if path.endswith(STORE_FORMATS["parquet"]):
+        return pa.parquet.read_table(path, columns=columns, memory_map=True)
+    table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+    if (columns is not None) and (set(columns) - set(table.column_names)):
+        raise KeyError(f"{path} has no column(s) {sorted(set(columns) - set(table.column_names))}")
+    return table if columns is None else table.select(columns)
+
+'''
+desc: load the selected channels of a run as numpy arrays. for arrow files these are views of the memory-mapped file
+(read-only), nothing is copied
+input: path - path of the run (see run_path())
+       columns - channels to load (time is always loaded; None for all)
+output: dict of channel -> numpy array
+'''
+def read_run_arrays(path, columns=None):
+    table = read_run_table(path, columns)
+    return {name: np.asarray(col.chunk(0) if col.num_chunks == 1 else col)
+            for name, col in zip(table.column_names, table.columns)}
+
+'''
+desc: store file of a compiled csv: the run of the same name in the store, if it is there and at least as new as the csv
+input: filepath - compiled dgo csv
+       store_root - folder of the store (None for the O2_DGO_STORE folder next to the compiled folder)
+output: path, None if the run isn't in the store (or only an older compile of it is)
+'''
+def stored_path(filepath, store_root=None):
+    filepath = os.path.abspath(filepath)
+    if store_root is None:
+        store_root = os.path.join(os.path.dirname(os.path.dirname(filepath)), os.path.basename(STORE_DIR))
+    dataname = os.path.splitext(os.path.basename(filepath))[0]
+    if parse_run_name(dataname)[0] is None:
+        return None
+    for fmt in STORE_FORMATS:
+        path = run_path(store_root, dataname, fmt)
+        try:
+            if os.path.getmtime(path) >= os.path.getmtime(filepath):
+                return path
+        except OSError:
+            continue
+    return None
+
+'''
+desc: load a compiled run, from the columnar store when it has the run (the channels are views of the memory-mapped
+file, read-only, nothing is parsed or copied), else from the csv. same layout as read_dgo_csv(), with the columns in the
+requested order (time first) either way
+input: filepath - compiled dgo csv
+       columns - channels to load (time is always loaded; None for all)
+       sensor_dtype - dtype of the sensor columns
+       store_root - folder of the store (None for the one next to the compiled folder, see stored_path())
+output: dgo_data - dataframe with float64 time [s] and a 0..n-1 index
+'''
+def read_compiled(filepath, columns=None, sensor_dtype=np.float64, store_root=None):
+    path = stored_path(filepath, store_root)
+    if path is not None:
+        try:
+            arrays = read_run_arrays(path, columns)
+        except ImportError:
+            arrays = None
+        if arrays is not None:
+            # astype only copies the columns whose dtype changes
+            return pd.DataFrame(arrays, copy=False).astype({c: np.float64 if c == "time" else sensor_dtype
+                                                            for c in arrays})
+    dgo_data = read_dgo_csv(filepath, columns, sensor_dtype=sensor_dtype)
+    if columns is not None:  # the csv comes back in file order, give the columns in the order the store does
+        dgo_data = dgo_data[list(dict.fromkeys(["time"] + [c for c in columns if c != "time"]))]
+    return dgo_data
@@ -0,0 +1,252 @@
+from collections import deque, namedtuple
+import math
+import numpy as np
+import pandas as pd
+import calibration
+from filters import parse_filter
+from threshold_index import SIGNAL_DIRECTIONS
+"""
+Streaming version of the exit criteria: a detector that is fed one sample (or one batch) of telemetry at a time and
+emits events as soon as they can be decided, with O(1) state per rig.
+
+    start         - same test as find_dgo_bounds(): the intake SHT40 moved more than start_threshold over 3 samples.
+                    it can only be seen 3 samples late, so the event carries the index/time of the actual start. after
+                    the end of a cycle only a rise counts, otherwise the cool-down would start the next cycle
+    sht_threshold - first sample of the cycle where delta SHT40 crosses the threshold upward, between the valid sample
+                    before it and this one (the same crossings as the dashboards' and backtest's CrossingIndex). the
+                    event time is interpolated between the two samples like CrossingIndex.first_time()
+    rh_threshold  - same for delta RH, crossing downward (see threshold_index.SIGNAL_DIRECTIONS)
+    end           - the last sample before the intake SHT40 starts falling for good (single-step slope <= end_slope),
+                    which is what find_dgo_bounds() finds scanning back from the end of a finished log. live, a fall is
+                    only taken as the end once it has lasted end_confirm samples and dropped end_drop degC, so the short
+                    dips during the cycle are ignored. finish() resolves the end of a log that stops before that.
+                    a threshold met after the last flat sample might turn out to be after the end, so it is held
+                    until the next flat sample (usually the very next one) before it is emitted
+
+Samples with a NaN intake SHT40 (the "undefined" dropout rows) neither start nor break a fall. With smoothing the
+threshold checks are on the deltas smoothed by a causal filter (see filters), the same values filters' batch mode gives
+for the whole log.
+
+The threshold checks are on calibrated deltas by default, like the dashboards: the rig's calibration table entries are
+applied to every sample, and at the start of a cycle the pre-heat baseline is measured from the PREHEAT_SAMPLES raw
+samples before it, the same way compile_dgos() catalogs it (see calibration). The baseline is a constant offset of the
+delta, so it is added after the smoothing filter, which passes constants through unchanged.
+"""
+
+DgoEvent = namedtuple("DgoEvent", ["kind", "index", "time", "elapsed", "value"])
+CHANNELS = ["Intake SHT40", "Exhaust SHT40", "Intake Air RH", "Exhaust RH"]
+
+'''
+desc: incremental dgo start / threshold / end detector for a single rig
+input: sht_threshold - SHT40 delta threshold (None to not check it)
+       rh_threshold - RH delta threshold (None to not check it)
+       start_threshold, end_slope - segmentation parameters, see find_dgo_bounds()
+       end_confirm - number of falling samples before the end of the cycle is called
+       end_drop - drop of the intake SHT40 below its last flat value before the end of the cycle is called [degC]
+       smoothing - filter spec the deltas are smoothed with before the threshold checks (e.g. "ema:12"), None for raw
+       calibrated - check the thresholds on the calibrated deltas (see calibration), like the dashboards do by default
+       dataname - run name of the rig's log (e.g. O2-DVT-DGO-1_D1), its unit picks the calibration table entries
+       table - calibration table (None to load CALIBRATION_PATH)
+'''
+class DgoExitDetector:
+
+    def __init__(self, sht_threshold=None, rh_threshold=None, start_threshold=0.25, end_slope=-0.0075, end_confirm=5,
+                 end_drop=1.0, smoothing=None, calibrated=True, dataname=None, table=None):
+        self.sht_threshold = sht_threshold
+        self.rh_threshold = rh_threshold
+        self.start_threshold = start_threshold
+        self.end_slope = end_slope
+        self.end_confirm = end_confirm
+        self.end_drop = end_drop
+        self.smoothing = smoothing
+        smoother = parse_filter(smoothing)
+        self._smoothers = None if smoother is None else (smoother, smoother.clone())  # SHT40, RH
+        # a derivative filter takes the constant baseline out again
+        self._baseline_gain = 0.0 if getattr(smoother, "deriv", 0) else 1.0
+        self.calibrated = calibrated and ((sht_threshold is not None) or (rh_threshold is not None))
+        self.dataname = dataname
+        if self.calibrated:
+            self._table = calibration.load_table() if table is None else table
+            # the table entries are known up front, the baselines only once a cycle starts
+            gain, offset, _ = calibration.run_corrections(dataname or "", CHANNELS, self._table, {})
+            self._gain, self._offset = gain.tolist(), offset.tolist()
+        self.reset()
+
+    '''
+    desc: forget everything and wait for the start of a new cycle
+    '''
+    def reset(self):
+        self.index = -1
+        self.in_cycle = False
+        self.cycles = 0  # number of cycles ended so far
+        self._recent = deque(maxlen=4)  # (index, time, in_SHT40, delta_SHT40, delta_RH) of the last 4 samples
+        # raw samples before the start (and the 4 of _recent), for the pre-heat baseline
+        self._history = deque(maxlen=calibration.PREHEAT_SAMPLES + 4) if self.calibrated else None
+        self._baseline = [0.0, 0.0]  # SHT40, RH delta offsets of the current cycle
+        self._start_time = None
+        self._met = [False, False]  # SHT40, RH
+        self._last_delta = [None, None]  # (time, delta) of the last valid SHT40/RH delta of the cycle
+        self._last_flat = None  # (index, time, in_SHT40) of the last sample that wasn't falling
+        self._falling = 0
+        self._pending = []  # threshold events after the last flat sample
+        if self._smoothers is not None:
+            for smoother in self._smoothers:
+                smoother.reset()
+
+    '''
+    desc: feed one sample
+    input: time - sample time [ms], as in the raw csv's
+           in_SHT40, ex_SHT40, in_RH, ex_RH - intake/exhaust SHT40 and RH of the sample (NaN/None if missing)
+    output: list of DgoEvent emitted by this sample (usually empty)
+    '''
+    def update(self, time, in_SHT40, ex_SHT40, in_RH=math.nan, ex_RH=math.nan):
+        self.index += 1
+        values = [_float(in_SHT40), _float(ex_SHT40), _float(in_RH), _float(ex_RH)]
+        if self.calibrated:
+            self._history.append(values)
+            values = [v * g + o for v, g, o in zip(values, self._gain, self._offset)]
+        x = _float(in_SHT40)
+        delta_sht, delta_rh = values[1] - values[0], values[3] - values[2]
+        if self._smoothers is not None:  # every sample goes through the filters, in or out of a cycle
+            delta_sht, delta_rh = self._smoothers[0].update(delta_sht), self._smoothers[1].update(delta_rh)
+        sample = (self.index, time, x, delta_sht, delta_rh)
+        previous = self._recent[-1] if self._recent else None
+        self._recent.append(sample)
+        events = []
+
+        if self.in_cycle:
+            return self._advance(sample, previous)
+
+        rise = x - self._recent[0][2] if len(self._recent) == 4 else math.nan
+        if (abs(rise) if self.cycles == 0 else rise) > self.start_threshold:
+            start = self._recent[0]
+            self.in_cycle = True
+            self._start_time = start[1]
+            self._last_flat = start[:3]
+            self._falling = 0
+            if self.calibrated:
+                self._baseline = self._baseline_offsets()
+            events.append(self._event("start", start, start[2]))
+            events += self._check_thresholds(start)
+            # the samples between the start and now haven't been looked at yet
+            recent = list(self._recent)
+            for previous, s in zip(recent[:-1], recent[1:]):
+                events += self._advance(s, previous)
+        return events
+
+    '''
+    desc: step the current cycle by one sample: end of cycle test and threshold checks
+    input: sample - (index, time, in_SHT40, delta_SHT40, delta_RH)
+           previous - the sample before it (None if there is none)
+    output: list of DgoEvent
+    '''
+    def _advance(self, sample, previous):
+        self._pending += self._check_thresholds(sample)
+
+        # end of the cycle, only when this sample and the one right before it are both valid (same as the offline test)
+        x = sample[2]
+        if (previous is not None) and (previous[0] == sample[0] - 1) and not (math.isnan(x) or math.isnan(previous[2])):
+            if (x - previous[2]) > self.end_slope:
+                self._last_flat = sample[:3]
+                self._falling = 0
+                events, self._pending = self._pending, []
+                return events
+            self._falling += 1
+            if (self._falling >= self.end_confirm) and ((self._last_flat[2] - x) >= self.end_drop):
+                return [self._end()]
+        return []
+
+    '''
+    desc: feed a batch of samples (e.g. a chunk of a raw csv)
+    input: data - dataframe or dict with the raw csv columns "time", "Intake SHT40", "Exhaust SHT40", and optionally
+                  "Intake Air RH" and "Exhaust RH"
+    output: list of DgoEvent emitted by the batch
+    '''
+    def update_batch(self, data):
+        n = len(data["time"])
+        columns = [np.asarray(data["time"]).tolist()]
+        for name in ["Intake SHT40", "Exhaust SHT40", "Intake Air RH", "Exhaust RH"]:
+            columns.append(np.asarray(data[name], dtype=np.float64).tolist() if name in data else [math.nan] * n)
+        events = []
+        for row in zip(*columns):
+            events += self.update(*row)
+        return events
+
+    '''
+    desc: the log ended (or the rig stopped sending). if a cycle is still open its end is the last flat sample, which is
+    what find_dgo_bounds() would find for the finished log
+    output: list with the end DgoEvent (empty if no cycle is open)
+    '''
+    def finish(self):
+        if not self.in_cycle:
+            return []
+        return [self._end()]
+
+    '''
+    desc: check a sample of the current cycle against the thresholds: a crossing between the last valid delta and this
+    one, in the direction of the signal (NaN deltas are skipped, like CrossingIndex does)
+    input: sample - (index, time, in_SHT40, delta_SHT40, delta_RH)
+    output: list of threshold DgoEvent, timed at the interpolated crossing
+    '''
+    def _check_thresholds(self, sample):
+        events = []
+        for i, (signal, kind, threshold) in enumerate([("SHT40", "sht_threshold", self.sht_threshold),
+                                                       ("RH", "rh_threshold", self.rh_threshold)]):
+            delta = sample[3 + i] + self._baseline[i] * self._baseline_gain
+            if math.isnan(delta):
+                continue
+            previous, self._last_delta[i] = self._last_delta[i], (sample[1], delta)
+            if (threshold is None) or self._met[i] or (previous is None):
+                continue
+            t0, d0 = previous
+            up = SIGNAL_DIRECTIONS[signal] == "up"
+            if (d0 < threshold <= delta) if up else (delta <= threshold < d0):
+                self._met[i] = True
+                time = t0 + (threshold - d0) / (delta - d0) * (sample[1] - t0)
+                events.append(DgoEvent(kind, sample[0], time, (time - self._start_time) / 1000, delta))
+        return events
+
+    '''
+    desc: pre-heat baseline of the cycle that just started, from the raw samples before it (the last 4 samples are the
+    start and the 3 after it). falls back to the start sample itself, like calibration.fallback_offsets()
+    output: [SHT40, RH] offsets added to the deltas (0 for a channel pair the table calibrates)
+    '''
+    def _baseline_offsets(self):
+        raw = pd.DataFrame(list(self._history), columns=CHANNELS)
+        start = len(raw) - 4
+        baselines = calibration.preheat_offsets(raw, start)
+        fallback = calibration.preheat_offsets(raw.iloc[start:start + 1], 1, 1)
+        baselines = {**fallback, **baselines}
+        _, offset, source = calibration.run_corrections(self.dataname or "", CHANNELS, self._table, baselines)
+        return [float(offset[CHANNELS.index(c)]) if source.get(c) == "baseline" else 0.0
+                for c in ["Exhaust SHT40", "Exhaust RH"]]
+
+    '''
+    desc: close the current cycle and go back to waiting for a start
+    output: end DgoEvent
+    '''
+    def _end(self):
+        event = self._event("end", self._last_flat, self._last_flat[2])
+        self.cycles += 1
+        self.in_cycle = False
+        self._start_time = None
+        self._met = [False, False]
+        self._last_delta = [None, None]
+        self._last_flat = None
+        self._falling = 0
+        self._pending = []  # these were after the end
+        # don't let the fall that ended this cycle also start the next one
+        self._recent.clear()
+        return event
+
+    '''
+    desc: build an event for a sample, with the time since the start of the cycle [s]
+    '''
+    def _event(self, kind, sample, value):
+        return DgoEvent(kind, sample[0], sample[1], (sample[1] - self._start_time) / 1000, value)
+
+'''
+desc: float of a sample value, with None as NaN
+'''
+def _float(value):
+    return math.nan if value is None else float(value)
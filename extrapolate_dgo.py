@@ -2,84 +2,313 @@
 import pandas as pd 
 from plotly import graph_objects as go
 import os
+import glob
+import time
+import argparse
+import multiprocessing
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
+import calibration
+import compile_manifest
+import data_quality
+import dgo_store
+import instrumentation
+import run_catalog
+from dgo_io import read_raw_csv
+
+RAW_DATA_DIR = "./125C_DATA/O2_DGO_RAWDATA"
+DGO_DATA_DIR = "./125C_DATA/O2_DGO_DATA"
+
+# segmentation parameters of find_dgo_bounds(), recorded in the compile manifest
+SEGMENT_PARAMS = {"start_threshold": 0.25, "end_slope": -0.0075}
+'''
+desc: locate the start and end of a single dgo cycle from the intake SHT40 as whole-array operations. the start is the first
+sample within the first half of the log where the temperature has moved more than start_threshold over 3 samples, the end is
+the first sample (scanning back from 10 samples before the last valid one) where the single-step slope is above end_slope
+input: in_SHT40 - series/array of the intake SHT40 for a single unit/day
+       start_threshold - rise over 3 samples that marks the start of the cycle [degC]
+       end_slope - single-step slope that marks the end of the cycle [degC/sample]
+output: start_index, end_index - positional indices of the start and end of the cycle (0 if not found, same as the old loop)
+'''
+def find_dgo_bounds(in_SHT40, start_threshold=0.25, end_slope=-0.0075):
+    x = np.asarray(in_SHT40, dtype=np.float64)
+    half_t = (int)(len(x) / 2)
+    valid = np.flatnonzero(~np.isnan(x))
+    if (half_t == 0) or (len(valid) == 0):
+        return 0, 0
+
+    # start: |x[i + 3] - x[i]| > threshold for i in [0, half_t)
+    rise = np.abs(x[3:half_t + 3] - x[:len(x[3:half_t + 3])]) > start_threshold
+    start_index = int(np.argmax(rise)) if rise.any() else 0
+
+    # end: x[last - i] - x[last - i - 1] > end_slope for i in [0, half_t), scanning back from last
+    last = valid[-1] - 10
+    idx = last - np.arange(half_t)
+    idx = idx[idx >= 1]
+    flat = (x[idx] - x[idx - 1]) > end_slope
+    end_index = int(idx[np.argmax(flat)]) if flat.any() else 0
+
+    return start_index, end_index
+
+'''
+desc: diagnostic figure of the segmentation for a single raw log (delta SHT40, intake SHT40, and the start/end markers)
+input: raw_data - dataframe of the raw data for a single unit/day
+       dataname - title of the figure
+       start_index, end_index - output of find_dgo_bounds()
+output: fig - plotly figure
+'''
+def plot_dgo_bounds(raw_data, dataname, start_index, end_index):
+    in_SHT40 = raw_data["Intake SHT40"]
+    delta_SHT40 = raw_data["Exhaust SHT40"] - in_SHT40
+
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=raw_data["time"], y=delta_SHT40, name="deltaSHT40"))
+    fig.add_trace(go.Scatter(x=raw_data["time"], y=in_SHT40, name="in_SHT40"))
+    fig.add_trace(go.Scatter(x=[raw_data["time"].iloc[start_index], raw_data["time"].iloc[end_index]],
+                             y=[in_SHT40.iloc[start_index], in_SHT40.iloc[end_index]], mode='markers'))
+    fig.update_layout(title=dataname)
+    return fig
+
 '''
 desc: determine the instance of the DGO cycle based on the intake SHT40 [clearer depiction of end] for a single dgo cycle
 input: raw_data - csv file of the raw data for a single unit/day (taken ~2 min before and after visual beginning and end)
+       dataname - name of the dataset, used as the title of the diagnostic figure
+       show_fig - show the diagnostic figure of the start/end (off by default)
+       start_threshold, end_slope - segmentation parameters, see find_dgo_bounds()
 output: dgo_data - dataframe of the extrapolated data from the start of the runtime to the end containing all of the variables
 
 '''
-def extrapolate_dgo(raw_data, dataname):
+def extrapolate_dgo(raw_data, dataname, show_fig=False, start_threshold=SEGMENT_PARAMS["start_threshold"],
+                    end_slope=SEGMENT_PARAMS["end_slope"]):
+    with instrumentation.span("segment.find_bounds", rows=len(raw_data)):
+        start_index, end_index = find_dgo_bounds(raw_data["Intake SHT40"], start_threshold, end_slope)
 
-    t = (raw_data["time"] - raw_data["time"][0]) / 1000  # convert from ms to seconds
-    half_t = (int)(len(t) / 2) 
-    in_RH = raw_data["Intake Air RH"]
-    ex_RH = raw_data["Exhaust RH"]
-    in_SHT40 = raw_data["Intake SHT40"]
-    ex_SHT40 = raw_data["Exhaust SHT40"]
+    if show_fig:
+        plot_dgo_bounds(raw_data, dataname, start_index, end_index).show()
 
-    delta_SHT40 = ex_SHT40 - in_SHT40 
-    # delta_RH = ex_RH - in_RH 
-    found_start = False 
-    found_end = False
-    
-    start_index = 0
-    end_index = 0
+    return slice_dgo(raw_data, start_index, end_index)
+
+'''
+desc: cut a dgo cycle out of the raw data, with the time in seconds from the start of the cycle
+input: raw_data - dataframe of the raw data
+       start_index, end_index - positional indices of the start and end of the cycle (inclusive)
+output: dgo_data - dataframe of the cycle containing all of the variables, with the start/end index and the epoch ms start
+        time kept in its attrs (for the run catalog)
+'''
+def slice_dgo(raw_data, start_index, end_index):
+    # slice every variable EXCLUDING TIME at once, then put the time back in front
+    with instrumentation.span("segment.slice", rows=end_index - start_index + 1):
+        time = raw_data["time"].to_numpy()
+        dgo_data = raw_data.iloc[start_index:end_index+1, 2:].reset_index(drop=True)
+        # ms to seconds
+        dgo_data.insert(0, column="time", value=(time[start_index:end_index+1] - time[start_index]) / 1000)
+    dgo_data.attrs.update(start_index=int(start_index), end_index=int(end_index), start_time=int(time[start_index]))
+    return dgo_data
 
-    last = in_SHT40.last_valid_index() - 10
+'''
+desc: find every raw data file under raw_root (including subfolders, one per rig if needed)
+input: raw_root - folder of the raw data csv's
+output: sorted list of the *_RAW.csv paths
+'''
+def find_raw_files(raw_root=RAW_DATA_DIR):
+    return sorted(glob.glob(os.path.join(raw_root, "**", "*_RAW.csv"), recursive=True))
 
-    fig = go.Figure()
+'''
+desc: a raw file left out of the compile by the quality scan
+'''
+class _Excluded(Exception):
+    pass
 
-    # parse through max half of the time frame to look for each end
-    for i in range(half_t):
-        if ((abs(in_SHT40[i + 3] - in_SHT40[i])) > 0.25) and (not found_start):  # may need the absolute value
-            # print("start: ", i)
-            start_index = i
-            found_start = True   
-            # break
-        if ((in_SHT40[last - i] - in_SHT40[last - i - 1]) > -0.0075) and (not found_end):  # may need the absolute value
-            # print("end: ", i)
-            end_index = last - i
-            found_end = True 
-        if (found_start and found_end):
-            break
+'''
+desc: delete what an earlier compile wrote of a run (see --prune-excluded)
+input: paths - csv/store paths of the run (None are skipped)
+'''
+def _remove_outputs(*paths):
+    for path in paths:
+        if (path is not None) and os.path.isfile(path):
+            os.remove(path)
 
-    fig.add_trace(go.Scatter(x=raw_data["time"], y=delta_SHT40, name="deltaSHT40"))
-    fig.add_trace(go.Scatter(x=raw_data["time"], y=in_SHT40, name="in_SHT40"))
-    fig.add_trace(go.Scatter(x=[raw_data["time"][start_index], raw_data["time"][end_index]], y=[in_SHT40[start_index], in_SHT40[end_index]],mode='markers' ))
-    fig.update_layout(title=dataname)
-    fig.show()
-    runtime = end_index - start_index
-    # print("runtime is: ", runtime)
-    dgo_data = pd.DataFrame() 
-    # dgo_data["time"] = (raw_data["time"][:runtime+1] - raw_data["time"][start_index])/1000  # only take data from beginning to end of dgo runtime
-    # print("time: ", dgo_data["time"])
-    dgo_data["time"] = (raw_data["time"][start_index:end_index+1] - raw_data["time"][start_index])/1000 # ms to seconds
-    num_vars = len(raw_data.columns[2:]) # number of variables EXCLUDING TIME
-    # iterate through the variables to extrapolate only relevant data
-    for i in range(num_vars): 
-        var_name = raw_data.columns[2+i] 
-        extrapolated = raw_data[var_name][start_index:end_index+1]
-        dgo_data.insert(i+1, column=var_name, value=extrapolated)
-    new_index = np.arange(0,len(dgo_data["time"])+1, 1)
-    dgo_data.reset_index(drop=True, inplace=True)
-    # print(new_index)
-    return dgo_data
+'''
+desc: extrapolate the dgo cycle of a single raw data file and save it. runs in a worker process, so errors are caught and
+reported in the summary instead of stopping the whole batch
+input: filepath - raw data csv
+       savepath - where the dgo data csv is written
+       params - segmentation parameters passed to extrapolate_dgo()
+       storepath - where the run is also written in the columnar store (None to only write the csv)
+       catalog - also return the run catalog record of the run
+       exclude_bad - don't segment/write runs the quality scan marks bad (see data_quality)
+       prune - also delete the outputs of an earlier compile of a run the quality scan now marks bad
+output: dict of the name, status, number of rows written, and time taken [s] for the summary (and the catalog "Record",
+        the data "Quality" row, and the "Metrics" of the worker process to merge into the parent's)
+'''
+def compile_dgo_file(filepath, savepath, params=SEGMENT_PARAMS, storepath=None, catalog=False, exclude_bad=True,
+                     prune=False):
+    dataname = os.path.basename(filepath)[:-len("_RAW.csv")]
+    t0 = time.perf_counter()
+    quality = None
+    try:
+        raw_data = read_raw_csv(filepath, sensor_dtype=np.float64)  # float64 so the written csv keeps the logged values
+        quality = data_quality.scan_raw(raw_data, dataname)
+        if exclude_bad and (quality["Status"] == "bad"):
+            raise _Excluded(quality["Issues"])
+        dgo_data = extrapolate_dgo(raw_data, dataname, **params)
+        os.makedirs(os.path.dirname(savepath) or ".", exist_ok=True)
+        with instrumentation.span("write.csv", rows=len(dgo_data)):
+            dgo_data.to_csv(savepath)
+        if storepath is not None:
+            store_root = os.path.dirname(os.path.dirname(storepath))
+            with instrumentation.span("write.store", rows=len(dgo_data)):
+                dgo_store.write_run(dgo_data, store_root, dataname, os.path.splitext(storepath)[1][1:])
+        record = None
+        if catalog:
+            with instrumentation.span("catalog.record", rows=len(dgo_data)):
+                baselines = calibration.preheat_offsets(raw_data, dgo_data.attrs["start_index"])
+                record = run_catalog.run_record(dgo_data, dataname, savepath, baselines)
+        status, rows = "ok", len(dgo_data)
+    except _Excluded as e:
+        # the outputs of an earlier compile stay unless asked otherwise, the quality report is what leaves the run out
+        if prune:
+            _remove_outputs(savepath, storepath)
+        status, rows, record = f"excluded: {e}", 0, None
+    except Exception as e:
+        status, rows, record = f"error: {type(e).__name__}: {e}", 0, None
+    # a worker's spans would never reach the parent, so they are sent back with the result
+    metrics = instrumentation.snapshot(reset=True) if multiprocessing.parent_process() is not None else None
+    return {"Name": dataname, "Status": status, "Rows": rows, "Time [s]": time.perf_counter() - t0, "Record": record,
+            "Quality": quality, "Metrics": metrics}
 
 '''
-desc: iterate through each raw data file and extrapolate dgo cycle data using extrapolate_dgo(). each csv of the dgo data 
-is saved to a folder O2_DGO_DATA
+desc: iterate through each raw data file and extrapolate dgo cycle data using extrapolate_dgo(). the raw files are discovered
+under raw_root and split across a process pool. each csv of the dgo data is saved to save_root (O2_DGO_DATA by default), keeping
+the same subfolders as raw_root. a manifest in save_root records the hash of each raw file and the parameters it was compiled
+with, so only new/changed files (or files compiled with different parameters) are compiled again. if store_root is given,
+each run is also written to the columnar store (see dgo_store) with one file per unit/day. every compiled run gets a row in
+the run catalog (see run_catalog), and runs missing from the catalog are compiled again to fill it in. every raw file is
+scanned for gaps/dropouts/stuck sensors first (see data_quality), the runs it marks bad aren't segmented and are only
+scanned again once the raw file or the quality thresholds change. the scan of every run is kept in a quality report in
+save_root, which is what leaves the bad runs out of the dashboards and the backtest. the outputs of an earlier compile of
+a bad run are kept unless prune_excluded is set
+input: raw_root - folder of the raw data csv's
+       save_root - folder the dgo data csv's are written to
+       workers - number of worker processes (None = one per core, 1 = run in this process)
+       start_threshold, end_slope - segmentation parameters, see find_dgo_bounds()
+       force - recompile everything regardless of the manifest
+       store_root - folder of the columnar store (None to only write csv's)
+       store_format - "arrow" (memory-mappable) or "parquet"
+       catalog_path - sqlite file of the run catalog (None to not keep a catalog)
+       exclude_bad - leave out the runs the quality scan marks bad (False to compile them anyway)
+       prune_excluded - delete the csv, store file and catalog rows an earlier compile left of the runs left out
+output: summary - dataframe with the status and timing of each file (also printed)
 '''
-def compile_dgos():
-    for unit in range(1,4):
-        for day in range(1,8):
-            filepath = f"~/../../SHT40_delta/125C_DATA/O2_DGO_RAWDATA/O2-DVT-DGO-{unit}_D{day}_RAW.csv"
-            savepath = f"~/../../SHT40_delta/125C_DATA/O2_DGO_DATA/O2-DVT-DGO-{unit}_D{day}.csv"
-            if os.path.isfile(filepath):
-                raw_data = pd.read_csv(filepath)
-                dgo_data = extrapolate_dgo(raw_data, f"O2-DVT-DGO-{unit}_D{day}") 
-                dgo_data.to_csv(savepath)
-            
+def compile_dgos(raw_root=RAW_DATA_DIR, save_root=DGO_DATA_DIR, workers=None,
+                 start_threshold=SEGMENT_PARAMS["start_threshold"], end_slope=SEGMENT_PARAMS["end_slope"], force=False,
+                 store_root=None, store_format="arrow", catalog_path=run_catalog.CATALOG_PATH, exclude_bad=True,
+                 prune_excluded=False):
+    t0 = time.perf_counter()
+    params = {"start_threshold": start_threshold, "end_slope": end_slope}
+    manifest = {} if force else compile_manifest.load_manifest(save_root)
+    new_manifest = {}
+    catalogued = run_catalog.catalogued_names(catalog_path) if catalog_path is not None else None
+    report = data_quality.load_report(save_root)
+    issues = dict(zip(report["Name"], report["Issues"]))
+    bad = set(report.loc[report["Status"] == "bad", "Name"])
+    quality_params = data_quality.QUALITY_PARAMS if exclude_bad else None  # None: excluded runs are compiled again
+
+    # split the raw files into the ones that need compiling and the ones that are up to date
+    todo = []  # (key, filepath, savepath, storepath, sha256)
+    results = []
+    dropped = []  # runs the quality scan leaves out (their catalog rows go with prune_excluded)
+    for filepath in find_raw_files(raw_root):
+        key = os.path.relpath(filepath, raw_root)
+        savepath = os.path.join(save_root, key[:-len("_RAW.csv")] + ".csv")
+        storepath = None
+        if store_root is not None:
+            storepath = dgo_store.run_path(store_root, os.path.basename(savepath)[:-len(".csv")], store_format)
+        name = os.path.basename(savepath)[:-len(".csv")]
+        entry = manifest.get(key)
+        excluded = (entry is not None) and (entry.get("status") == "excluded")
+        stale, sha256 = compile_manifest.is_stale(entry, filepath, savepath, params, storepath, quality_params)
+        if (catalogued is not None) and (not excluded) and (name not in catalogued):
+            stale = True
+        if (name not in issues) or (exclude_bad and (not excluded) and (name in bad)):  # e.g. kept with --keep-bad-runs
+            stale = True
+        if stale:
+            todo.append((key, filepath, savepath, storepath, sha256))
+        else:
+            # refresh the size/mtime of files that were touched but hashed the same
+            if (sha256 is not None) and excluded:
+                entry = compile_manifest.make_excluded_entry(filepath, params, quality_params, sha256)
+            elif sha256 is not None:
+                entry = compile_manifest.make_entry(filepath, savepath, params, sha256, storepath)
+            new_manifest[key] = entry
+            if excluded and prune_excluded:
+                _remove_outputs(savepath, storepath)
+                dropped.append(name)
+            results.append({"Name": name, "Status": f"excluded: {issues[name]}" if excluded else "up to date",
+                            "Rows": None if not excluded else 0, "Time [s]": 0.0})
+
+    filepaths = [f for _, f, _, _, _ in todo]
+    savepaths = [s for _, _, s, _, _ in todo]
+    storepaths = [s for _, _, _, s, _ in todo]
+    catalog = [catalog_path is not None] * len(todo)
+    if (workers == 1) or (len(todo) <= 1):
+        compiled = [compile_dgo_file(f, s, params, p, c, exclude_bad, prune_excluded)
+                    for f, s, p, c in zip(filepaths, savepaths, storepaths, catalog)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            compiled = list(pool.map(compile_dgo_file, filepaths, savepaths, [params] * len(todo), storepaths, catalog,
+                                     [exclude_bad] * len(todo), [prune_excluded] * len(todo)))
+
+    for (key, filepath, savepath, storepath, sha256), result in zip(todo, compiled):
+        instrumentation.merge(result["Metrics"])
+        if result["Status"] == "ok":
+            new_manifest[key] = compile_manifest.make_entry(filepath, savepath, params, sha256, storepath)
+        elif result["Status"].startswith("excluded"):
+            new_manifest[key] = compile_manifest.make_excluded_entry(filepath, params, quality_params, sha256)
+            dropped.append(result["Name"])
+    compile_manifest.save_manifest(save_root, new_manifest)
+    data_quality.save_report(save_root, [r["Quality"] for r in compiled if r["Quality"] is not None])
+    if catalog_path is not None:
+        # only this process writes to the catalog, the workers just return the records
+        with instrumentation.span("catalog.upsert", rows=len(compiled)):
+            run_catalog.upsert_runs([r["Record"] for r in compiled if r["Record"] is not None], catalog_path)
+            if prune_excluded:
+                run_catalog.delete_runs(dropped, catalog_path)
+
+    summary = pd.DataFrame(results + compiled, columns=["Name", "Status", "Rows", "Time [s]"])
+    summary = summary.sort_values("Name", ignore_index=True)
+    print(summary.to_string(index=False))
+    excluded = summary["Status"].str.startswith("excluded").sum()
+    print(f"compiled {len(todo)}/{len(summary)} files ({(summary['Status'] == 'ok').sum()} ok, {excluded} excluded) "
+          f"in {time.perf_counter() - t0:.2f} s")
+    return summary
+
 
-# rawdata = pd.read_csv("./125C_DATA/O2_DGO_RAWDATA/O2-DVT-DGO-2_D1_RAW.csv")              
-# extrapolate_dgo(rawdata)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="extrapolate the dgo cycle of every raw data csv")
+    parser.add_argument("--raw-root", default=RAW_DATA_DIR, help="folder searched for *_RAW.csv files")
+    parser.add_argument("--save-root", default=DGO_DATA_DIR, help="folder the dgo data csv's are written to")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per core)")
+    parser.add_argument("--start-threshold", type=float, default=SEGMENT_PARAMS["start_threshold"])
+    parser.add_argument("--end-slope", type=float, default=SEGMENT_PARAMS["end_slope"])
+    parser.add_argument("--force", action="store_true", help="recompile every file, ignoring the manifest")
+    parser.add_argument("--store-root", default=None,
+                        help=f"also write each run to a columnar store in this folder (e.g. {dgo_store.STORE_DIR})")
+    parser.add_argument("--store-format", default="arrow", choices=sorted(dgo_store.STORE_FORMATS))
+    parser.add_argument("--catalog", default=run_catalog.CATALOG_PATH, help="sqlite file of the run catalog")
+    parser.add_argument("--no-catalog", action="store_true", help="don't keep a run catalog")
+    parser.add_argument("--keep-bad-runs", action="store_true",
+                        help="compile the runs the data quality scan marks bad too (they stay marked bad)")
+    parser.add_argument("--prune-excluded", action="store_true",
+                        help="delete what an earlier compile wrote for the runs the data quality scan now leaves out")
+    parser.add_argument("--metrics", default=None, help="append the timing spans to this .jsonl file")
+    parser.add_argument("--profile", default=None,
+                        help="dump a cProfile of the run to this file (only sees this process, use --workers 1)")
+    args = parser.parse_args()
+    with instrumentation.profile(args.profile) if args.profile else nullcontext():
+        compile_dgos(args.raw_root, args.save_root, args.workers, args.start_threshold, args.end_slope, args.force,
+                     args.store_root, args.store_format, None if args.no_catalog else args.catalog,
+                     not args.keep_bad_runs, args.prune_excluded)
+    if args.metrics is not None:
+        instrumentation.export_jsonl(args.metrics, "extrapolate_dgo")
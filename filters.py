@@ -0,0 +1,305 @@
+import argparse
+import copy
+import math
+import time
+from collections import deque
+import numpy as np
+from fleet import Fleet, RaggedArray
+"""
+Causal filters for the delta signals: EMA, moving median and Savitzky-Golay smoothing, and a Savitzky-Golay derivative.
+
+Every filter works two ways with the same object:
+
+    batch(x)    - x is a RaggedArray (e.g. Fleet.deltas(), every run back to back) or a single 1-D array. all the runs
+                  are filtered together with array operations, no loop over the runs and no pandas rolling
+    update(x)   - one sample at a time (the live detector), O(window) state
+
+and the two give bit-identical outputs: the batch code does the same floating point operations in the same order as
+update(), only across all the runs/samples at once. The filters are causal (only the current and past samples), so a
+smoothed crossing is where a live detector would have seen it, lag included.
+
+The filters count samples, not minutes (the rigs log every 5 s, SAMPLE_PERIOD_MIN). A NaN sample (the "undefined"
+dropout rows) gives a NaN output and is skipped, the window is the last valid samples. Filters are written as specs for
+the dashboards and CLI's, e.g. "ema:12", "median:13", "savgol:25:2" and "slope:25:2" (derivative, per minute).
+"""
+
+SAMPLE_PERIOD_MIN = 5 / 60
+BLOCK_SAMPLES = 1 << 18  # window filters are evaluated over blocks of samples, to bound the (samples x window) matrix
+SMOOTHING_OPTIONS = [None, "ema:12", "median:13", "savgol:25:2"]  # choices of the dashboards
+
+'''
+desc: values and row starts of a ragged array or 1-D array, with the NaN samples taken out
+input: x - RaggedArray or 1-D array
+output: valid - mask of the valid samples in x's values
+        v - valid values (float64)
+        starts - for every valid value, the position in v of the first valid value of its row
+'''
+def _valid_rows(x):
+    if isinstance(x, RaggedArray):
+        values, rows, n_rows = np.asarray(x.values, dtype=np.float64), x.row_ids(), len(x)
+    else:
+        values = np.asarray(x, dtype=np.float64)
+        rows, n_rows = np.zeros(len(values), dtype=np.intp), 1
+    valid = ~np.isnan(values)
+    counts = np.bincount(rows[valid], minlength=n_rows)
+    first = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return valid, values[valid], np.repeat(first, counts)
+
+'''
+desc: filtered values back in the shape of the input (NaN where the input is NaN)
+'''
+def _like(x, valid, out_valid):
+    out = np.full(len(valid), np.nan)
+    out[valid] = out_valid
+    return x.with_values(out) if isinstance(x, RaggedArray) else out
+
+'''
+desc: the last window valid samples up to every valid sample, oldest first, NaN before the start of the row
+input: v, starts - see _valid_rows()
+       lo, hi - block of samples
+       window - window length
+output: (hi - lo) x window matrix
+'''
+def _windows(v, starts, lo, hi, window):
+    idx = np.arange(lo, hi)[:, None] - np.arange(window - 1, -1, -1)[None, :]
+    return np.where(idx >= starts[lo:hi, None], v[np.maximum(idx, 0)], np.nan)
+
+'''
+desc: base of the filters: streaming state and copies
+'''
+class _Filter:
+
+    spec = None
+
+    '''
+    desc: a fresh copy of the filter (same parameters, no state), e.g. one per rig or signal
+    '''
+    def clone(self):
+        other = copy.copy(self)
+        other.reset()
+        return other
+
+    '''
+    desc: filter a sequence one sample at a time with update() (continuing from the current state)
+    input: x - 1-D array
+    output: filtered array
+    '''
+    def stream(self, x):
+        return np.array([self.update(value) for value in np.asarray(x, dtype=np.float64).tolist()])
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.spec!r})"
+
+'''
+desc: exponential moving average, y = y + alpha * (x - y), starting at the first valid sample
+input: span - span in samples, alpha = 2 / (span + 1) (the same as pandas ewm(span))
+'''
+class Ema(_Filter):
+
+    def __init__(self, span):
+        self.span = span
+        self.alpha = 2 / (span + 1)
+        self.spec = f"ema:{span:g}"
+        self.reset()
+
+    def reset(self):
+        self._y = math.nan
+
+    '''
+    desc: feed one sample
+    output: filtered value (NaN for a NaN sample)
+    '''
+    def update(self, x):
+        x = float(x)
+        if math.isnan(x):
+            return math.nan
+        self._y = x if math.isnan(self._y) else self._y + self.alpha * (x - self._y)
+        return self._y
+
+    '''
+    desc: filter every row of x. the recursion goes down the sample positions with all the rows side by side
+    input: x - RaggedArray or 1-D array
+    output: filtered values, same type and shape as x
+    '''
+    def batch(self, x):
+        valid, v, starts = _valid_rows(x)
+        out = np.empty(len(v))
+        if len(v):
+            position = np.arange(len(v)) - starts
+            row = np.cumsum(position == 0) - 1  # among the rows with valid samples
+            padded = np.full((position.max() + 1, row[-1] + 1), np.nan)  # sample position x row
+            padded[position, row] = v
+            for j in range(1, len(padded)):
+                y = padded[j - 1]
+                padded[j] = y + self.alpha * (padded[j] - y)  # NaN past the end of a row, never read back
+            out = padded[position, row]
+        return _like(x, valid, out)
+
+'''
+desc: median of the last window valid samples (fewer at the start of a row)
+input: window - window length in samples
+'''
+class MovingMedian(_Filter):
+
+    def __init__(self, window):
+        self.window = int(window)
+        self.spec = f"median:{self.window}"
+        self.reset()
+
+    def reset(self):
+        self._buffer = deque(maxlen=self.window)
+
+    def update(self, x):
+        x = float(x)
+        if math.isnan(x):
+            return math.nan
+        self._buffer.append(x)
+        ordered = sorted(self._buffer)
+        n = len(ordered)
+        return (ordered[(n - 1) // 2] + ordered[n // 2]) / 2
+
+    def batch(self, x):
+        valid, v, starts = _valid_rows(x)
+        out = np.empty(len(v))
+        for lo in range(0, len(v), BLOCK_SAMPLES):
+            hi = min(lo + BLOCK_SAMPLES, len(v))
+            w = np.sort(_windows(v, starts, lo, hi, self.window), axis=1)  # NaN (before the row start) sort last
+            n = np.minimum(np.arange(lo, hi) - starts[lo:hi] + 1, self.window)
+            rows = np.arange(hi - lo)
+            out[lo:hi] = (w[rows, (n - 1) // 2] + w[rows, n // 2]) / 2
+        return _like(x, valid, out)
+
+'''
+desc: causal Savitzky-Golay filter: least squares polynomial through the last window valid samples, evaluated at the
+newest one (NaN until a row has a full window)
+input: window - window length in samples
+       order - polynomial order (< window)
+       deriv - 0 to smooth, 1 for the slope, ...
+       dt - sample period the derivative is taken against (default: per minute)
+'''
+class SavitzkyGolay(_Filter):
+
+    def __init__(self, window, order=2, deriv=0, dt=SAMPLE_PERIOD_MIN):
+        if not 0 <= order < window:
+            raise ValueError(f"the polynomial order has to be below the window, got order {order}, window {window}")
+        self.window, self.order, self.deriv, self.dt = int(window), int(order), int(deriv), dt
+        self.spec = f"{'slope' if deriv == 1 else 'savgol'}:{self.window}:{self.order}"
+        self.coefficients = savgol_coefficients(self.window, self.order, self.deriv, dt)
+        self._c = self.coefficients.tolist()
+        self.reset()
+
+    def reset(self):
+        self._buffer = deque(maxlen=self.window)
+
+    def update(self, x):
+        x = float(x)
+        if math.isnan(x):
+            return math.nan
+        self._buffer.append(x)
+        if len(self._buffer) < self.window:
+            return math.nan
+        acc = self._c[0] * self._buffer[0]
+        for k in range(1, self.window):
+            acc = acc + self._c[k] * self._buffer[k]
+        return acc
+
+    def batch(self, x):
+        valid, v, starts = _valid_rows(x)
+        out = np.empty(len(v))
+        c = self._c
+        for lo in range(0, len(v), BLOCK_SAMPLES):
+            hi = min(lo + BLOCK_SAMPLES, len(v))
+            w = _windows(v, starts, lo, hi, self.window)  # NaN unless the window is full
+            acc = c[0] * w[:, 0]
+            for k in range(1, self.window):  # tap by tap, in the order update() adds them up
+                acc = acc + c[k] * w[:, k]
+            out[lo:hi] = acc
+        return _like(x, valid, out)
+
+'''
+desc: weights of a causal Savitzky-Golay filter, applied to the window oldest sample first
+input: window, order, deriv, dt - see SavitzkyGolay
+output: array of window weights
+'''
+def savgol_coefficients(window, order, deriv=0, dt=SAMPLE_PERIOD_MIN):
+    k = np.arange(-(window - 1), 1, dtype=np.float64)  # newest sample at 0
+    fit = np.linalg.pinv(np.vander(k, order + 1, increasing=True))  # polynomial coefficients from the samples
+    return fit[deriv] * math.factorial(deriv) / dt ** deriv
+
+'''
+desc: a set of named filters run on the same signal, in batch or one sample at a time
+input: filters - dict of name -> filter (or filter spec)
+'''
+class FilterBank:
+
+    def __init__(self, filters):
+        self.filters = {name: parse_filter(f) if isinstance(f, str) else f for name, f in filters.items()}
+
+    def reset(self):
+        for f in self.filters.values():
+            f.reset()
+
+    def clone(self):
+        return FilterBank({name: f.clone() for name, f in self.filters.items()})
+
+    '''
+    desc: feed one sample to every filter
+    output: dict of name -> filtered value
+    '''
+    def update(self, x):
+        return {name: f.update(x) for name, f in self.filters.items()}
+
+    '''
+    desc: filter every row of x with every filter
+    output: dict of name -> filtered values (same type and shape as x)
+    '''
+    def batch(self, x):
+        return {name: f.batch(x) for name, f in self.filters.items()}
+
+FILTERS = {"ema": lambda span: Ema(float(span)),
+           "median": lambda window: MovingMedian(int(window)),
+           "savgol": lambda window, order=2: SavitzkyGolay(int(window), int(order)),
+           "slope": lambda window, order=2: SavitzkyGolay(int(window), int(order), deriv=1)}
+
+'''
+desc: filter from its spec, e.g. "ema:12", "median:13", "savgol:25:2", "slope:25:2"
+input: spec - filter spec (None or "none" for no filter)
+output: filter (None for no filter)
+'''
+def parse_filter(spec):
+    if (spec is None) or (spec.lower() == "none"):
+        return None
+    kind, *params = spec.lower().split(":")
+    if kind not in FILTERS:
+        raise ValueError(f"unknown filter {kind!r}, expected one of {list(FILTERS)}")
+    return FILTERS[kind](*params)
+
+'''
+desc: slope of every row of x (Savitzky-Golay derivative)
+input: x - RaggedArray or 1-D array
+       window, order - see SavitzkyGolay
+       dt - sample period [min]
+output: slope per minute, same type and shape as x
+'''
+def derivative(x, window=25, order=2, dt=SAMPLE_PERIOD_MIN):
+    return SavitzkyGolay(window, order, deriv=1, dt=dt).batch(x)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time the filters over the fleet's deltas, batch against streaming")
+    parser.add_argument("--filters", nargs="+", default=[s for s in SMOOTHING_OPTIONS if s] + ["slope:25:2"])
+    parser.add_argument("--signal", choices=["SHT40", "RH"], default="SHT40")
+    args = parser.parse_args()
+
+    delta = Fleet().deltas()[args.signal]
+    print(f"{len(delta)} runs, {len(delta.values)} samples of the {args.signal} delta")
+    for spec in args.filters:
+        f = parse_filter(spec)
+        t0 = time.perf_counter()
+        batch = f.batch(delta)
+        t_batch = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        streamed = np.concatenate([f.clone().stream(row) for row in delta])
+        t_stream = time.perf_counter() - t0
+        same = np.array_equal(batch.values, streamed, equal_nan=True)
+        print(f"{spec:>12}: batch {t_batch * 1000:8.1f} ms, streaming {t_stream * 1000:8.1f} ms, identical: {same}")
@@ -0,0 +1,296 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+from data_quality import excluded_runs
+from dgo_io import parse_run_name
+from dgo_cache import DGO_DATA_DIR, DASHBOARD_COLUMNS, load_run, load_crossing_index
+"""
+One dataset object for the whole fleet of compiled runs, instead of a load loop in every script.
+
+Fleet lists the runs that are actually on disk (unit/day from the file names, no hard-coded day lists, without the runs
+the data quality report marks bad) and only loads a run when it is accessed, through the shared dataset cache. A channel
+of every run is handed out as a RaggedArray: all the runs back to back in one contiguous numpy array plus the offset of
+each run, so fleet-wide deltas are a single array operation and per-run statistics are one reduceat instead of a pandas
+call per run.
+"""
+
+'''
+desc: variable length rows (one per run) stored back to back in one array
+input: values - 1-D array of all the rows concatenated
+       offsets - start of each row in values, plus the end of the last one (n_rows + 1 ints)
+       names - name of each row (e.g. the run names)
+'''
+class RaggedArray:
+
+    def __init__(self, values, offsets, names=None):
+        self.values = np.asarray(values)
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+        self.names = list(names) if names is not None else [str(i) for i in range(len(self.offsets) - 1)]
+
+    '''
+    desc: build from a list of rows
+    input: rows - list of 1-D arrays
+           names - name of each row
+           dtype - dtype of the values (default: numpy's common dtype)
+    output: RaggedArray
+    '''
+    @classmethod
+    def from_rows(cls, rows, names=None, dtype=None):
+        lengths = [len(row) for row in rows]
+        offsets = np.zeros(len(rows) + 1, dtype=np.intp)
+        np.cumsum(lengths, out=offsets[1:])
+        values = np.concatenate(rows).astype(dtype, copy=False) if rows else np.empty(0, dtype=dtype or np.float64)
+        return cls(values, offsets, names)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    '''
+    desc: row i (a view of the values), or the row with that name
+    '''
+    def __getitem__(self, i):
+        if isinstance(i, str):
+            i = self.names.index(i)
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    '''
+    desc: row number of every value
+    output: int array, same length as values
+    '''
+    def row_ids(self):
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    '''
+    desc: same rows with new values (e.g. the result of an elementwise operation on self.values)
+    '''
+    def with_values(self, values):
+        values = np.asarray(values)
+        if values.shape != self.values.shape:
+            raise ValueError(f"expected {self.values.shape} values, got {values.shape}")
+        return RaggedArray(values, self.offsets, self.names)
+
+    '''
+    desc: values of another ragged array with the same rows
+    '''
+    def _other(self, other):
+        if isinstance(other, RaggedArray):
+            if not np.array_equal(self.offsets, other.offsets):
+                raise ValueError("ragged arrays have different rows")
+            return other.values
+        return other
+
+    def __add__(self, other):
+        return self.with_values(self.values + self._other(other))
+
+    def __sub__(self, other):
+        return self.with_values(self.values - self._other(other))
+
+    def __mul__(self, other):
+        return self.with_values(self.values * self._other(other))
+
+    def __truediv__(self, other):
+        return self.with_values(self.values / self._other(other))
+
+    def __neg__(self):
+        return self.with_values(-self.values)
+
+    '''
+    desc: reduce every row with a ufunc, ignoring NaN values
+    input: ufunc - np.add, np.minimum or np.maximum
+           fill - value NaNs are replaced with (the identity of the ufunc)
+    output: array with one value per row (NaN for rows without any valid value)
+    '''
+    def _reduce(self, ufunc, fill):
+        out = np.full(len(self), np.nan)
+        values = np.asarray(self.values, dtype=np.float64)
+        values = np.where(np.isnan(values), fill, values)
+        rows = np.flatnonzero(self.lengths > 0)
+        if len(rows):
+            out[rows] = ufunc.reduceat(values, self.offsets[rows])
+        out[self.count() == 0] = np.nan
+        return out
+
+    '''
+    desc: number of valid (non-NaN) values of every row
+    '''
+    def count(self):
+        valid = (~np.isnan(self.values)).astype(np.intp)
+        return np.add.reduceat(np.append(valid, 0), self.offsets[:-1]) * (self.lengths > 0)
+
+    def sum(self):
+        return self._reduce(np.add, 0.0)
+
+    def mean(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum() / self.count()
+
+    def min(self):
+        return self._reduce(np.minimum, np.inf)
+
+    def max(self):
+        return self._reduce(np.maximum, -np.inf)
+
+    def std(self):
+        mean = np.repeat(self.mean(), self.lengths)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(self.with_values((self.values - mean) ** 2).sum() / self.count())
+
+    '''
+    desc: index (within the row) of the last valid value of every row
+    output: int array (-1 for rows without any valid value)
+    '''
+    def last_valid_index(self):
+        positions = np.where(np.isnan(self.values), -1, np.arange(len(self.values)))
+        last = np.full(len(self), -1, dtype=np.intp)
+        rows = np.flatnonzero(self.lengths > 0)
+        if len(rows):
+            last[rows] = np.maximum.reduceat(positions, self.offsets[rows])
+        return np.where(last >= 0, last - self.offsets[:-1], -1)
+
+    '''
+    desc: last valid value of every row (NaN for rows without any)
+    '''
+    def last(self):
+        i = self.last_valid_index()
+        return np.where(i >= 0, self.values[np.maximum(self.offsets[:-1] + i, 0)], np.nan)
+
+    '''
+    desc: per-row summary table
+    output: dataframe indexed by name with count, mean, std, min, max, last
+    '''
+    def describe(self):
+        return pd.DataFrame({"count": self.count(), "mean": self.mean(), "std": self.std(), "min": self.min(),
+                             "max": self.max(), "last": self.last()}, index=pd.Index(self.names, name="Name"))
+
+'''
+desc: the compiled runs of the fleet. nothing is loaded until a run or a channel is accessed
+input: data_root - folder of the compiled csv's
+       columns - channels loaded with each run (time is always loaded)
+       calibrated - load the runs with the sensor calibration applied (see calibration)
+       exclude_bad - leave out the runs the data quality report of data_root marks bad (see data_quality)
+'''
+class Fleet:
+
+    def __init__(self, data_root=DGO_DATA_DIR, columns=DASHBOARD_COLUMNS, calibrated=False, exclude_bad=True):
+        self.data_root = data_root
+        self.columns = list(columns)
+        self.calibrated = calibrated
+        runs = discover_runs(data_root)
+        bad = runs["Name"].isin(excluded_runs(data_root)) if exclude_bad else np.zeros(len(runs), dtype=bool)
+        self.excluded = runs.loc[bad, "Name"].tolist()
+        self.runs = runs[~bad].reset_index(drop=True)
+
+    '''
+    desc: the runs of some units/days (or some runs by name) only
+    input: units, days - lists of units/days to keep (None for all)
+           names - list of run names to keep (None for all)
+    output: Fleet with the same data root, columns and calibration
+    '''
+    def select(self, units=None, days=None, names=None):
+        fleet = Fleet.__new__(Fleet)
+        fleet.data_root, fleet.columns, fleet.calibrated = self.data_root, self.columns, self.calibrated
+        fleet.excluded = self.excluded
+        keep = np.ones(len(self.runs), dtype=bool)
+        if units is not None:
+            keep &= self.runs["Unit"].isin(units).to_numpy()
+        if days is not None:
+            keep &= self.runs["Day"].isin(days).to_numpy()
+        if names is not None:
+            keep &= self.runs["Name"].isin(list(names)).to_numpy()
+        fleet.runs = self.runs[keep].reset_index(drop=True)
+        return fleet
+
+    def __len__(self):
+        return len(self.runs)
+
+    @property
+    def names(self):
+        return self.runs["Name"].tolist()
+
+    @property
+    def units(self):
+        return sorted(self.runs["Unit"].unique().tolist())
+
+    '''
+    desc: path of a run
+    '''
+    def path(self, name):
+        return self.runs["Path"].iloc[self.names.index(name)]
+
+    '''
+    desc: load one run (cached, see dgo_cache.load_run())
+    input: name - run name, e.g. O2-DVT-DGO-1_D1
+    output: dataframe of the run's columns. shared, don't modify it
+    '''
+    def load(self, name):
+        return load_run(self.path(name), self.columns, self.calibrated)
+
+    def __getitem__(self, name):
+        return self.load(name)
+
+    '''
+    desc: (name, dataframe) of every run, loaded one at a time
+    '''
+    def items(self):
+        for name in self.names:
+            yield name, self.load(name)
+
+    '''
+    desc: crossing indexes of a run (cached, see dgo_cache.load_crossing_index()), of the deltas smoothed with a filter
+    spec (see filters) if given
+    '''
+    def crossing_index(self, name, smoothing=None):
+        return load_crossing_index(self.path(name), self.calibrated, smoothing)
+
+    '''
+    desc: one channel of every run as a ragged array. runs that don't log the channel (e.g. unit 1 has no inductance)
+    get a row of NaN
+    input: channel - column name
+    output: RaggedArray of float64, one row per run
+    '''
+    def channel(self, channel):
+        rows = []
+        for name in self.names:
+            if channel in self.columns:
+                rows.append(self.load(name)[channel].to_numpy(dtype=np.float64))
+                continue
+            try:
+                rows.append(load_run(self.path(name), ["time", channel], self.calibrated)[channel]
+                            .to_numpy(dtype=np.float64))
+            except KeyError:
+                rows.append(np.full(len(self.load(name)), np.nan))
+        return RaggedArray.from_rows(rows, self.names, np.float64)
+
+    '''
+    desc: time [min] and the exhaust - intake deltas of every run, each as one vectorized operation over the whole fleet
+    output: dict of "time", "SHT40", "RH" -> RaggedArray
+    '''
+    def deltas(self):
+        return {"time": self.channel("time") / 60,
+                "SHT40": self.channel("Exhaust SHT40") - self.channel("Intake SHT40"),
+                "RH": self.channel("Exhaust RH") - self.channel("Intake Air RH")}
+
+'''
+desc: list the compiled runs in a folder
+input: data_root - folder of the compiled csv's
+output: dataframe with the name, unit, day, and path of each run, sorted by unit and day
+'''
+def discover_runs(data_root=DGO_DATA_DIR):
+    rows = []
+    for path in glob.glob(os.path.join(data_root, "*.csv")):
+        name = os.path.splitext(os.path.basename(path))[0]
+        unit, day = parse_run_name(name)
+        if unit is None:
+            continue
+        rows.append({"Name": name, "Unit": unit, "Day": day, "Path": os.path.abspath(path)})
+    runs = pd.DataFrame(rows, columns=["Name", "Unit", "Day", "Path"])
+    return runs.sort_values(["Unit", "Day", "Name"], ignore_index=True)
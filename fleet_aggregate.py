@@ -0,0 +1,184 @@
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+from fleet import Fleet
+"""
+Time aligned fleet summaries. The runs are 1800-2900 samples long and their 5 s sampling jitters, so they can't be
+compared sample by sample. Every run's delta series is interpolated onto one shared elapsed time grid in a single batched
+searchsorted over the whole fleet (no loop over the runs), giving a (runs x grid) matrix. The mean/median/percentile
+envelope across runs (per unit or over the whole fleet) is then one sort and nan-aware reduction over that matrix.
+
+A run is only interpolated inside its own time span, so past the end of a run it is NaN and drops out of the envelope
+instead of being extrapolated.
+"""
+
+GRID_STEP_MIN = 5 / 60  # same as the rig sampling
+ENVELOPE_PERCENTILES = [10, 25, 50, 75, 90]
+SIGNALS = ["SHT40", "RH"]
+
+'''
+desc: elapsed time grid shared by the runs
+input: t_end - end of the grid [min]
+       step - grid step [min]
+output: grid - 0, step, ... up to t_end [min]
+'''
+def common_grid(t_end, step=GRID_STEP_MIN):
+    return np.arange(int(np.floor(t_end / step + 1e-9)) + 1) * step
+
+'''
+desc: linearly interpolate every row of a ragged series onto the same grid in one batched operation. the rows are laid
+back to back on one increasing axis (each row shifted past the end of the previous one) so a single searchsorted finds the
+bracketing samples of every grid point of every row. NaN samples are skipped, grid points outside a row's span are NaN
+input: t - RaggedArray of sample times (increasing within each row)
+       y - RaggedArray of the samples, same rows as t
+       grid - increasing grid, same units as t
+output: (rows x grid) float64 matrix
+'''
+def resample(t, y, grid):
+    if not np.array_equal(t.offsets, y.offsets):
+        raise ValueError("t and y have different rows")
+    grid = np.asarray(grid, dtype=np.float64)
+    n_rows = len(t)
+    out = np.full((n_rows, len(grid)), np.nan)
+    tv = np.asarray(t.values, dtype=np.float64)
+    yv = np.asarray(y.values, dtype=np.float64)
+    valid = ~np.isnan(tv) & ~np.isnan(yv)
+    if (not valid.any()) or (len(grid) == 0):
+        return out
+    rows = t.row_ids()[valid]
+    tv, yv = tv[valid], yv[valid]
+    counts = np.bincount(rows, minlength=n_rows)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    ends = starts + counts - 1  # last sample of each row (only meaningful for rows with samples)
+
+    # shift every row past the previous one so the whole fleet is one increasing axis
+    lo = min(tv.min(), grid[0])
+    span = max(tv.max(), grid[-1]) - lo + 1.0
+    key = (tv - lo) + rows * span
+    query = (grid - lo)[None, :] + (np.arange(n_rows) * span)[:, None]
+
+    has = np.flatnonzero(counts > 0)
+    q = query[has]
+    first, last = starts[has][:, None], ends[has][:, None]
+    left = np.clip(np.searchsorted(key, q, side="right") - 1, first, last)
+    right = np.minimum(left + 1, last)
+    dt = key[right] - key[left]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        w = np.where(dt > 0, (q - key[left]) / dt, 0.0)
+    values = yv[left] + w * (yv[right] - yv[left])
+    inside = (q >= key[first]) & (q <= key[last])
+    out[has] = np.where(inside, values, np.nan)
+    return out
+
+'''
+desc: envelope across the rows of a resampled matrix (NaN entries ignored)
+input: matrix - (runs x grid) output of resample()
+       percentiles - percentiles of the envelope
+       min_runs - grid points with fewer runs than this are NaN (e.g. past the end of most runs)
+output: dataframe with one row per grid point: count, mean, std, min, max and p{percentile} for each percentile
+'''
+def envelope(matrix, percentiles=ENVELOPE_PERCENTILES, min_runs=1):
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float64))
+    count = (~np.isnan(matrix)).sum(axis=0)
+    enough = count >= max(min_runs, 1)
+    stats = {"count": count}
+    names = ["mean", "std", "min", "max"] + [f"p{p:g}" for p in percentiles]
+    for name in names:
+        stats[name] = np.full(matrix.shape[1], np.nan)
+    if enough.any():
+        m = matrix[:, enough]
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # std of a single run
+            stats["mean"][enough] = np.nanmean(m, axis=0)
+            stats["std"][enough] = np.nanstd(m, axis=0)
+        stats["min"][enough] = np.nanmin(m, axis=0)
+        stats["max"][enough] = np.nanmax(m, axis=0)
+        for p, row in zip(percentiles, nan_percentiles(m, percentiles)):
+            stats[f"p{p:g}"][enough] = row
+    return pd.DataFrame(stats)
+
+'''
+desc: percentiles of every column ignoring NaN, same as np.nanpercentile(matrix, percentiles, axis=0) (linear method).
+np.nanpercentile falls back to a python loop over the columns when there are NaNs (every grid point past the end of a
+run), this sorts the matrix once (NaNs sort last) and interpolates between the ranks of all the columns at once
+input: matrix - 2-D array
+       percentiles - list of percentiles (0-100)
+output: (percentiles x columns) array, NaN for columns without any valid value
+'''
+def nan_percentiles(matrix, percentiles):
+    ordered = np.sort(matrix, axis=0)
+    count = (~np.isnan(ordered)).sum(axis=0)
+    rank = (np.asarray(percentiles, dtype=np.float64) / 100)[:, None] * (count - 1)  # percentiles x columns
+    lo = np.floor(rank).astype(np.intp)
+    hi = np.minimum(lo + 1, np.maximum(count - 1, 0))
+    lo = np.maximum(lo, 0)
+    v_lo = np.take_along_axis(ordered, lo, axis=0)
+    v_hi = np.take_along_axis(ordered, hi, axis=0)
+    out = v_lo + (rank - np.floor(rank)) * (v_hi - v_lo)
+    out[:, count == 0] = np.nan
+    return out
+
+'''
+desc: delta series of every run of a fleet on a shared grid
+input: fleet - Fleet
+       signal - "SHT40" or "RH"
+       step - grid step [min]
+       t_end - end of the grid [min] (None for the end of the longest run)
+output: grid [min], (runs x grid) matrix (rows in fleet.names order)
+'''
+def resample_fleet(fleet, signal, step=GRID_STEP_MIN, t_end=None):
+    deltas = fleet.deltas()
+    if t_end is None:
+        t_end = np.nanmax(deltas["time"].max()) if len(fleet) else 0.0
+    grid = common_grid(t_end, step)
+    return grid, resample(deltas["time"], deltas[signal], grid)
+
+'''
+desc: percentile envelopes of a delta signal, per unit or over the whole fleet
+input: fleet - Fleet
+       signal - "SHT40" or "RH"
+       by - "Unit" for one envelope per unit, None for one over the whole fleet
+       step - grid step [min]
+       t_end - end of the grid [min] (None for the end of the longest run)
+       percentiles - percentiles of the envelope
+       min_runs - grid points with fewer runs than this are NaN
+output: long dataframe with Group, Time [min] and the envelope() columns
+'''
+def fleet_envelopes(fleet, signal, by="Unit", step=GRID_STEP_MIN, t_end=None, percentiles=ENVELOPE_PERCENTILES,
+                    min_runs=1):
+    grid, matrix = resample_fleet(fleet, signal, step, t_end)
+    if by is None:
+        groups = {"Fleet": np.ones(len(fleet), dtype=bool)}
+    else:
+        keys = fleet.runs[by].to_numpy()
+        groups = {f"{by} {key}": keys == key for key in sorted(set(keys.tolist()))}
+    frames = []
+    for group, rows in groups.items():
+        stats = envelope(matrix[rows], percentiles, min_runs)
+        stats.insert(0, "Time [min]", grid)
+        stats.insert(0, "Group", group)
+        frames.append(stats)
+    columns = ["Group", "Time [min]"] + list(envelope(np.empty((0, 0)), percentiles).columns)
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="percentile envelopes of the SHT40/RH deltas of the compiled runs")
+    parser.add_argument("--signal", choices=SIGNALS, default="SHT40")
+    parser.add_argument("--by", choices=["unit", "fleet"], default="unit")
+    parser.add_argument("--step", type=float, default=GRID_STEP_MIN, help="grid step [min]")
+    parser.add_argument("--min-runs", type=int, default=1)
+    parser.add_argument("--units", type=int, nargs="*", default=None)
+    parser.add_argument("--days", type=int, nargs="*", default=None)
+    parser.add_argument("--out", default=None, help="csv to write the envelopes to (prints a summary otherwise)")
+    args = parser.parse_args()
+
+    fleet = Fleet().select(units=args.units, days=args.days)
+    envelopes = fleet_envelopes(fleet, args.signal, by=None if args.by == "fleet" else "Unit", step=args.step,
+                                min_runs=args.min_runs)
+    if args.out is not None:
+        envelopes.to_csv(args.out, index=False)
+    else:
+        every = max(int(round(10 / args.step)), 1)  # every 10 min
+        print(envelopes.groupby("Group", group_keys=False).apply(lambda g: g.iloc[::every]).to_string(index=False))
@@ -1,9 +1,9 @@
-import pandas as pd 
-from plotly import graph_objects as go
-from plotly.subplots import make_subplots
 import streamlit as st
-import os
-from extrapolate_dgo import compile_dgos
+from dgo_cache import cache_stats_frame
+from dashboard_widgets import run_selector, start_profiler, metrics_panel
+from instrumentation import span
+from plot_downsample import DOWNSAMPLE_METHODS
+from dgo_plots import delta_figures
 """
 EXIT CRITERIA EXPLORATION -- 125degC operation 
 
@@ -11,7 +11,7 @@ This script reads in csv files of all the variables and inspects the differences
 intake and exhaust SHT40s, and the RH values. 
 """
 
-# compile_dgos()  # takes all of the raw data csv's and extrapolates the runtime data
+# run extrapolate_dgo.py first, it takes all of the raw data csv's and extrapolates the runtime data
 
 '''
 desc: 
@@ -23,33 +23,21 @@ output:
 # 3. keep track of time the threshold is met, how much shorter the runtime would be
 
 
-fig_sht40 = go.Figure()
-fig_rh = go.Figure()
+profiler = start_profiler()
 
-for dvt in range(1,4):
-    for day in range(1,8):
-        filepath = f"./125C_DATA/O2_DGO_DATA/O2-DVT-DGO-{dvt}_D{day}.csv"
+# traces are decimated to the screen resolution, narrowing the window re-fetches it at full resolution
+time_window = st.sidebar.slider("Time Window [min]", 0.0, 500.0, (0.0, 500.0), step=1.0)
+x_range = None if time_window == (0.0, 500.0) else time_window
+downsample_method = st.sidebar.selectbox("Downsampling", DOWNSAMPLE_METHODS)
 
-        if os.path.isfile(filepath):
-            data = pd.read_csv(filepath)
-            t = data["time"] / 60 # convert from seconds to minutes
-            in_SHT40 = data["Intake SHT40"]
-            ex_SHT40 = data["Exhaust SHT40"]
-            delta_SHT40 = ex_SHT40 - in_SHT40 
-
-            in_RH = data["Intake Air RH"]
-            ex_RH = data["Exhaust RH"]
-            delta_RH = ex_RH - in_RH 
-
-            fig_sht40.add_trace(go.Scatter(x=t, y=delta_SHT40, name=f"O2-DGO-{dvt}_D{day}"))
-            fig_rh.add_trace(go.Scatter(x=t, y=delta_RH, name=f"O2-DGO-{dvt}_D{day}"))
-fig_sht40.update_layout(title="SHT 40",xaxis_title="Time [min]", yaxis_title="SHT40 Diff. [degC]",
-                         height=500, width=1000)
-fig_rh.update_layout(title="RH", xaxis_title="Time [min]", yaxis_title="RH Diff.",
-                         height=500, width=1000)
+fleet, _ = run_selector()  # runs picked from the run catalog, only those are loaded
+fig_sht40, fig_rh = delta_figures(fleet, x_range, downsample_method)  # same figures as the batch report
 st.title("125C Operation - Runtime Comparison")
-st.plotly_chart(fig_sht40)
-st.plotly_chart(fig_rh)
+with span("render.plotly_chart"):
+    st.plotly_chart(fig_sht40)
+    st.plotly_chart(fig_rh)
+st.sidebar.dataframe(cache_stats_frame())
+metrics_panel(profiler)
 
 
 
@@ -0,0 +1,298 @@
+import argparse
+import cProfile
+import io
+import json
+import os
+import pstats
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+import pandas as pd
+"""
+Timing spans and counters around the hot stages (load, segment, detect, render), to see where the time goes and catch
+regressions as the dataset grows.
+
+    with span("load.read_csv", nbytes=size) as s:
+        data = pd.read_csv(...)
+        s.rows = len(data)
+
+Every span adds to the totals of its name (calls, seconds, max, rows, bytes) and is kept as an event (the last
+EVENT_LIMIT of them). The totals are shown in the dashboards' sidebar (see dashboard_widgets.metrics_panel()), batch
+runs append the events and a summary to a JSON lines file with export_jsonl(), and profile() wraps a block in cProfile
+for when the spans aren't detailed enough. Spans are cheap (a perf_counter and a lock) so they are always on, set
+DGO_METRICS=0 to turn them off.
+
+Worker processes have their own totals: they send snapshot(reset=True) back with their results and the parent
+merge()s them.
+"""
+
+METRICS_ENABLED = os.environ.get("DGO_METRICS", "1") != "0"
+EVENT_LIMIT = 10_000
+
+'''
+desc: one timed block. rows/nbytes can be set inside the block once they are known
+'''
+class Span:
+
+    __slots__ = ("name", "rows", "nbytes", "start", "seconds")
+
+    def __init__(self, name, rows=0, nbytes=0):
+        self.name = name
+        self.rows = rows
+        self.nbytes = nbytes
+        self.start = time.perf_counter()
+        self.seconds = 0.0
+
+'''
+desc: thread safe totals of the spans and counters of this process
+'''
+class Metrics:
+
+    def __init__(self, enabled=METRICS_ENABLED):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.spans = {}  # name -> {"calls", "seconds", "max_seconds", "rows", "bytes"}
+            self.counters = {}
+            self.events = deque(maxlen=EVENT_LIMIT)
+
+    '''
+    desc: time a block (see the module docstring)
+    input: name - stage name, "<stage>.<step>" by convention (e.g. load.read_csv)
+           rows, nbytes - rows/bytes processed, if known up front
+    output: context manager yielding the Span
+    '''
+    @contextmanager
+    def span(self, name, rows=0, nbytes=0):
+        s = Span(name, rows, nbytes)
+        if not self.enabled:
+            yield s
+            return
+        try:
+            yield s
+        finally:
+            s.seconds = time.perf_counter() - s.start
+            self._add(s.name, 1, s.seconds, s.seconds, s.rows, s.nbytes)
+            with self._lock:
+                self.events.append({"time": time.time(), "span": s.name, "seconds": s.seconds, "rows": int(s.rows),
+                                    "bytes": int(s.nbytes), "pid": os.getpid()})
+
+    def _add(self, name, calls, seconds, max_seconds, rows, nbytes):
+        with self._lock:
+            total = self.spans.setdefault(name, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0, "rows": 0, "bytes": 0})
+            total["calls"] += calls
+            total["seconds"] += seconds
+            total["max_seconds"] = max(total["max_seconds"], max_seconds)
+            total["rows"] += int(rows)
+            total["bytes"] += int(nbytes)
+
+    '''
+    desc: add to a counter (e.g. cache hits)
+    '''
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    '''
+    desc: plain data copy of the totals, e.g. to send back from a worker process
+    input: reset - clear the totals after copying them
+    output: dict of "spans", "counters", "peak_rss_mb", "pid"
+    '''
+    def snapshot(self, reset=False):
+        with self._lock:
+            snap = {"spans": {name: dict(total) for name, total in self.spans.items()}, "counters": dict(self.counters),
+                    "peak_rss_mb": peak_rss_mb(), "pid": os.getpid()}
+        if reset:
+            self.reset()
+        return snap
+
+    '''
+    desc: add the totals of a snapshot (e.g. from a worker process)
+    '''
+    def merge(self, snap):
+        if not snap:
+            return
+        for name, total in snap["spans"].items():
+            self._add(name, total["calls"], total["seconds"], total["max_seconds"], total["rows"], total["bytes"])
+        for name, n in snap["counters"].items():
+            self.count(name, n)
+        if (snap.get("peak_rss_mb") is not None) and (snap["pid"] != os.getpid()):
+            with self._lock:
+                self.counters[f"peak_rss_mb.pid_{snap['pid']}"] = snap["peak_rss_mb"]  # the peak of each worker
+
+    '''
+    desc: table of the span totals, slowest first
+    output: dataframe indexed by span name
+    '''
+    def frame(self):
+        columns = ["Calls", "Total [s]", "Mean [ms]", "Max [ms]", "Rows", "MB", "Rows/s"]
+        with self._lock:
+            spans = {name: dict(total) for name, total in self.spans.items()}
+        rows = {}
+        for name, total in spans.items():
+            seconds = total["seconds"]
+            rows[name] = [total["calls"], seconds, 1000 * seconds / max(total["calls"], 1), 1000 * total["max_seconds"],
+                          total["rows"], total["bytes"] / 1e6, total["rows"] / seconds if seconds > 0 else None]
+        frame = pd.DataFrame.from_dict(rows, orient="index", columns=columns)
+        frame.index.name = "Span"
+        return frame.sort_values("Total [s]", ascending=False)
+
+    '''
+    desc: append the events since the last export and a summary line to a JSON lines file
+    input: path - .jsonl file
+           label - stored with the summary (e.g. the command that was run)
+    '''
+    def export_jsonl(self, path, label=None):
+        with self._lock:
+            events = list(self.events)
+            self.events.clear()
+        snap = self.snapshot()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            for event in events:
+                f.write(json.dumps(event) + "\n")
+            f.write(json.dumps({"time": time.time(), "summary": label, **snap}) + "\n")
+
+'''
+desc: peak resident memory of this process [MB] (None where the resource module doesn't exist, e.g. windows)
+'''
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024  # bytes on mac, KB on linux
+
+'''
+desc: git commit of the tree the code runs from (recorded with benchmark and report results)
+output: dict of the commit hash (None outside of git) and whether there are uncommitted changes
+'''
+def git_state():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                                    text=True, check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {"commit": commit, "dirty": dirty}
+
+_metrics = Metrics()
+
+'''
+desc: time a block with the metrics of this process (see Metrics.span())
+'''
+def span(name, rows=0, nbytes=0):
+    return _metrics.span(name, rows, nbytes)
+
+'''
+desc: add to a counter of the metrics of this process
+'''
+def count(name, n=1):
+    _metrics.count(name, n)
+
+def snapshot(reset=False):
+    return _metrics.snapshot(reset)
+
+def merge(snap):
+    _metrics.merge(snap)
+
+def reset():
+    _metrics.reset()
+
+'''
+desc: table of the span totals of this process, plus the counters and the peak memory
+output: spans - dataframe (see Metrics.frame()), counters - dataframe of name -> value
+'''
+def metrics_frames():
+    snap = _metrics.snapshot()
+    counters = {**snap["counters"], "peak_rss_mb": snap["peak_rss_mb"]}
+    return _metrics.frame(), pd.DataFrame({"Value": counters}).rename_axis("Counter")
+
+def export_jsonl(path, label=None):
+    _metrics.export_jsonl(path, label)
+
+'''
+desc: run a block under cProfile
+input: path - file the stats are dumped to (for snakeviz/pstats, None to not save them)
+output: context manager yielding the cProfile.Profile (see profile_table())
+'''
+@contextmanager
+def profile(path=None):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path is not None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            profiler.dump_stats(path)
+
+'''
+desc: top functions of a profile
+input: profiler - cProfile.Profile (or a path of dumped stats)
+       limit - number of functions
+       sort - pstats sort key
+output: dataframe of the functions with their calls, own time and cumulative time
+'''
+def profile_table(profiler, limit=25, sort="cumulative"):
+    stats = pstats.Stats(profiler, stream=io.StringIO()) if not isinstance(profiler, str) else pstats.Stats(profiler)
+    stats.sort_stats(sort)
+    rows = []
+    for func in stats.fcn_list[:limit]:
+        calls, primitive, own, cumulative, _ = stats.stats[func]
+        filename, line, name = func
+        rows.append({"Function": f"{os.path.basename(filename)}:{line}({name})", "Calls": calls,
+                     "Own [s]": own, "Cumulative [s]": cumulative})
+    return pd.DataFrame(rows, columns=["Function", "Calls", "Own [s]", "Cumulative [s]"])
+
+'''
+desc: read a JSON lines file written by export_jsonl()
+input: path - .jsonl file
+output: events - dataframe of the span events, summaries - list of the summary dicts
+'''
+def read_jsonl(path):
+    events, summaries = [], []
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            (summaries if "summary" in record else events).append(record)
+    return pd.DataFrame(events, columns=["time", "span", "seconds", "rows", "bytes", "pid"]), summaries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="summarize a metrics file written with --metrics, or a cProfile dump")
+    parser.add_argument("path", help=".jsonl metrics file or a cProfile stats file")
+    parser.add_argument("--events", action="store_true",
+                        help="aggregate the span events of every export instead of showing the totals of the last one "
+                             "(events of worker processes aren't kept, only their totals)")
+    parser.add_argument("--limit", type=int, default=25, help="functions to show for a cProfile dump")
+    args = parser.parse_args()
+
+    if not args.path.endswith(".jsonl"):
+        print(profile_table(args.path, args.limit).to_string(index=False))
+    else:
+        events, summaries = read_jsonl(args.path)
+        if args.events:
+            table = events.groupby("span").agg(Calls=("seconds", "size"), Total_s=("seconds", "sum"),
+                                               Mean_ms=("seconds", "mean"), Max_ms=("seconds", "max"),
+                                               Rows=("rows", "sum"), MB=("bytes", "sum"))
+            table[["Mean_ms", "Max_ms"]] *= 1000
+            table["MB"] /= 1e6
+            print(table.sort_values("Total_s", ascending=False).to_string())
+        elif summaries:
+            last = summaries[-1]
+            metrics = Metrics(enabled=True)
+            metrics.merge({**last, "pid": os.getpid()})
+            print(f"{last['summary']} ({len(summaries)} exports in the file)")
+            print(metrics.frame().to_string())
+            print(f"peak rss {last['peak_rss_mb']} MB, counters {last['counters']}")
@@ -0,0 +1,124 @@
+import numpy as np
+from plotly import graph_objects as go
+"""
+Server side decimation of the traces sent to the browser. A plot is ~1000 px wide so there is no point in sending more
+than a couple of points per pixel per trace, however long the run is. Two decimations are available:
+
+    minmax - keeps the min and the max of every bucket of samples. keeps every spike/dip, fully vectorized (default)
+    lttb   - largest triangle three buckets, one point per bucket picked to keep the visual shape of the line. smoother
+             looking for the same number of points but loops over the buckets
+
+Only the samples inside the time window being looked at are decimated (plus one on either side so the line runs to the
+edge of the plot), so zooming into a window re-fetches it at full screen resolution. The traces are Scattergl (WebGL)
+so the browser can draw hundreds of runs without freezing.
+"""
+
+SCREEN_POINTS = 2000  # points per trace, ~2 per pixel of a 1000 px wide plot
+DOWNSAMPLE_METHODS = ["minmax", "lttb"]
+
+'''
+desc: slice of the samples inside a window of x, plus one sample on either side
+input: x - sample x (time), increasing
+       x_range - (x_min, x_max) of the window (None for everything)
+output: slice
+'''
+def window_slice(x, x_range=None):
+    if x_range is None:
+        return slice(0, len(x))
+    lo = max(np.searchsorted(x, x_range[0], side="left") - 1, 0)
+    hi = min(np.searchsorted(x, x_range[1], side="right") + 1, len(x))
+    return slice(lo, hi)
+
+'''
+desc: indices of the min and max sample of each of n_out/2 buckets of samples (NaN samples are ignored), plus the first and
+last valid sample
+input: y - samples
+       n_out - max number of points to keep
+output: sorted indices of the samples to keep
+'''
+def minmax_indices(y, n_out=SCREEN_POINTS):
+    y = np.asarray(y, dtype=np.float64)
+    valid = ~np.isnan(y)
+    n = len(y)
+    if n <= n_out:
+        return np.flatnonzero(valid)
+    n_buckets = max(n_out // 2 - 1, 1)
+    size = -(-n // n_buckets)  # ceil
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(n_buckets, size)
+    empty = np.isnan(padded).all(axis=1)
+    lows = np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    highs = np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+    offsets = np.arange(n_buckets) * size
+    keep = np.concatenate([(offsets + lows)[~empty], (offsets + highs)[~empty]])
+    valid_idx = np.flatnonzero(valid)
+    if len(valid_idx):
+        keep = np.concatenate([keep, valid_idx[[0, -1]]])
+    return np.unique(keep)
+
+'''
+desc: largest triangle three buckets: first and last sample, and the one sample of each bucket in between that makes the
+largest triangle with the point kept in the previous bucket and the average of the next bucket (NaN samples are ignored)
+input: x, y - samples
+       n_out - number of points to keep
+output: sorted indices of the samples to keep
+'''
+def lttb_indices(x, y, n_out=SCREEN_POINTS):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    valid = np.flatnonzero(~np.isnan(x) & ~np.isnan(y))
+    n = len(valid)
+    if (n <= n_out) or (n_out < 3):
+        return valid
+    xv, yv = x[valid], y[valid]
+
+    # n_out - 2 buckets between the first and last sample, and the average of each (the last one "averages" the last sample)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    counts = np.diff(edges)
+    avg_x = np.append(np.add.reduceat(xv[1:n - 1], edges[:-1] - 1) / counts, xv[-1])
+    avg_y = np.append(np.add.reduceat(yv[1:n - 1], edges[:-1] - 1) / counts, yv[-1])
+
+    keep = np.empty(n_out, dtype=np.intp)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        ax, ay = xv[a], yv[a]
+        area = np.abs((ax - avg_x[i + 1]) * (yv[lo:hi] - ay) - (ax - xv[lo:hi]) * (avg_y[i + 1] - ay))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+    return valid[keep]
+
+'''
+desc: decimate a trace to what the plot can show
+input: x, y - samples (x increasing, e.g. time)
+       n_out - max number of points to keep
+       x_range - (x_min, x_max) window being looked at (None for everything)
+       method - "minmax" or "lttb"
+output: x, y - decimated numpy arrays
+'''
+def downsample(x, y, n_out=SCREEN_POINTS, x_range=None, method="minmax"):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    window = window_slice(x, x_range)
+    x, y = x[window], y[window]
+    if method == "minmax":
+        keep = minmax_indices(y, n_out)
+    elif method == "lttb":
+        keep = lttb_indices(x, y, n_out)
+    else:
+        raise ValueError(f"unknown downsample method {method!r}, expected one of {DOWNSAMPLE_METHODS}")
+    return x[keep], y[keep]
+
+'''
+desc: WebGL line trace of a decimated series
+input: x, y - samples (x increasing, e.g. time)
+       name - trace name
+       n_out, x_range, method - see downsample()
+       kwargs - passed on to go.Scattergl (line=..., etc.)
+output: go.Scattergl
+'''
+def decimated_trace(x, y, name, n_out=SCREEN_POINTS, x_range=None, method="minmax", **kwargs):
+    x_ds, y_ds = downsample(x, y, n_out, x_range, method)
+    return go.Scattergl(x=x_ds, y=y_ds, name=name, mode="lines", **kwargs)
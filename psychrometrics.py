@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+"""
+Psychrometrics for whole intake/exhaust series. Every function takes scalars or numpy arrays / pandas series and works
+elementwise, so a whole run (or a whole fleet of runs concatenated) is a handful of array operations.
+
+Formulas follow MetPy (https://unidata.github.io/MetPy/latest/api/references.html):
+    temperature in degC, pressure in hPa, relative humidity as a fraction (the rigs log percent, divide by 100)
+"""
+
+MOLECULAR_WEIGHT_RATIO = 0.6219569100577033  # epsilon, Mw / Md
+STANDARD_PRESSURE = 1013.25  # hPa
+WATER_GAS_CONSTANT = 461.5  # J/(kg K)
+
+'''
+desc: saturation vapor pressure (Bolton 1980)
+Resource: https://unidata.github.io/MetPy/latest/api/generated/metpy.calc.saturation_vapor_pressure.html
+input: temperature_air - air temperature [degC]
+output: saturation vapor pressure [hPa]
+'''
+def saturation_vapor_pressure(temperature_air):
+    temperature_air = np.asarray(temperature_air, dtype=np.float64)
+    return 6.112 * np.exp((17.67 * temperature_air) / (temperature_air + 243.5))
+
+'''
+desc: precomputed lookup table of the saturation vapor pressure, linearly interpolated (~1e-7 relative error with the
+default 0.01 degC step). numpy's exp is already vectorized so on a pc this isn't faster, it is meant for hosts where the
+exp is the expensive part (e.g. a controller evaluating sample by sample)
+input: t_min, t_max - temperature range of the table [degC] (outside of it the end values are used)
+       step - temperature step [degC]
+'''
+class SaturationTable:
+
+    def __init__(self, t_min=-40.0, t_max=150.0, step=0.01):
+        self.temperature = np.arange(t_min, t_max + step / 2, step)
+        self.pressure = saturation_vapor_pressure(self.temperature)
+
+    def __call__(self, temperature_air):
+        return np.interp(np.asarray(temperature_air, dtype=np.float64), self.temperature, self.pressure)
+
+'''
+desc: saturation vapor pressure, from the lookup table if one is given
+'''
+def _saturation_pressure(temperature_air, table):
+    return saturation_vapor_pressure(temperature_air) if table is None else table(temperature_air)
+
+'''
+desc: standard atmosphere pressure at an altitude, for sites that aren't at sea level
+input: altitude - altitude above sea level [m]
+output: pressure [hPa]
+'''
+def pressure_from_altitude(altitude):
+    return STANDARD_PRESSURE * (1 - 2.25577e-5 * np.asarray(altitude, dtype=np.float64)) ** 5.25588
+
+'''
+desc: saturation mixing ratio
+https://unidata.github.io/MetPy/latest/api/generated/metpy.calc.saturation_mixing_ratio.html
+input: temperature_air - air temperature [degC]
+       total_pressure - total pressure [hPa] (scalar, or one value per sample)
+       molecular_weight_ratio - epsilon
+       table - optional SaturationTable
+output: saturation mixing ratio [kg/kg]
+'''
+def saturation_mixing_ratio(temperature_air, total_pressure=STANDARD_PRESSURE,
+                            molecular_weight_ratio=MOLECULAR_WEIGHT_RATIO, table=None):
+    saturation_pressure = _saturation_pressure(temperature_air, table)
+    return molecular_weight_ratio * (saturation_pressure / (total_pressure - saturation_pressure))
+
+'''
+desc: mixing ratio from relative humidity
+https://unidata.github.io/MetPy/latest/api/generated/metpy.calc.mixing_ratio_from_relative_humidity.html
+input: relative_humidity - relative humidity [fraction]
+       temperature_air - air temperature [degC]
+       total_pressure - total pressure [hPa]
+       table - optional SaturationTable
+output: mixing ratio [kg/kg]
+'''
+def mixing_ratio_from_rh(relative_humidity, temperature_air, total_pressure=STANDARD_PRESSURE, table=None):
+    mr_s = saturation_mixing_ratio(temperature_air, total_pressure, table=table)
+    return np.asarray(relative_humidity, dtype=np.float64) * mr_s
+
+'''
+desc: vapor pressure from relative humidity
+input: relative_humidity - relative humidity [fraction]
+       temperature_air - air temperature [degC]
+       table - optional SaturationTable
+output: vapor pressure [hPa]
+'''
+def vapor_pressure_from_rh(relative_humidity, temperature_air, table=None):
+    return np.asarray(relative_humidity, dtype=np.float64) * _saturation_pressure(temperature_air, table)
+
+'''
+desc: absolute humidity (mass of water vapor per volume of air) from relative humidity
+input: relative_humidity - relative humidity [fraction]
+       temperature_air - air temperature [degC]
+       table - optional SaturationTable
+output: absolute humidity [g/m^3]
+'''
+def absolute_humidity(relative_humidity, temperature_air, table=None):
+    vapor_pressure = vapor_pressure_from_rh(relative_humidity, temperature_air, table) * 100  # hPa to Pa
+    return 1000 * vapor_pressure / (WATER_GAS_CONSTANT * (np.asarray(temperature_air, dtype=np.float64) + 273.15))
+
+'''
+desc: dew point from relative humidity (inverse of the Bolton formula)
+https://unidata.github.io/MetPy/latest/api/generated/metpy.calc.dewpoint.html
+input: relative_humidity - relative humidity [fraction]
+       temperature_air - air temperature [degC]
+       table - optional SaturationTable
+output: dew point [degC] (NaN for 0 RH)
+'''
+def dew_point(relative_humidity, temperature_air, table=None):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        val = np.log(vapor_pressure_from_rh(relative_humidity, temperature_air, table) / 6.112)
+        dp = 243.5 * val / (17.67 - val)
+    return np.where(np.isfinite(dp), dp, np.nan)
+
+'''
+desc: moisture signals of the intake and exhaust air for a whole run (or many runs concatenated)
+input: dgo_data - dataframe with the "Intake SHT40", "Exhaust SHT40", "Intake Air RH" and "Exhaust RH" columns [percent RH]
+       total_pressure - pressure of the run/site [hPa] (scalar, or one value per sample)
+       table - optional SaturationTable
+output: dataframe of the intake/exhaust mixing ratio [g/kg], absolute humidity [g/m^3] and dew point [degC], and the
+        exhaust - intake delta of each
+'''
+def moisture_series(dgo_data, total_pressure=STANDARD_PRESSURE, table=None):
+    moisture = pd.DataFrame(index=dgo_data.index)
+    for side, rh_column, temp_column in [("Intake", "Intake Air RH", "Intake SHT40"),
+                                         ("Exhaust", "Exhaust RH", "Exhaust SHT40")]:
+        rh = dgo_data[rh_column].to_numpy(dtype=np.float64) / 100
+        temp = dgo_data[temp_column].to_numpy(dtype=np.float64)
+        moisture[f"{side} Mixing Ratio"] = 1000 * mixing_ratio_from_rh(rh, temp, total_pressure, table)
+        moisture[f"{side} Absolute Humidity"] = absolute_humidity(rh, temp, table)
+        moisture[f"{side} Dew Point"] = dew_point(rh, temp, table)
+    for name in ["Mixing Ratio", "Absolute Humidity", "Dew Point"]:
+        moisture[f"Delta {name}"] = moisture[f"Exhaust {name}"] - moisture[f"Intake {name}"]
+    return moisture
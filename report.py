@@ -0,0 +1,285 @@
+import argparse
+import datetime
+import html
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import instrumentation
+from dgo_plots import unit_figure, stats_tables, delta_figures
+from filters import parse_filter
+from fleet import Fleet
+from psychrometrics import STANDARD_PRESSURE
+from run_features import feature_table
+"""
+Headless exit criteria report: the stats tables and figures of the dashboards for a list of thresholds and a run
+selection, written to a report folder without streamlit.
+
+    python report.py --sht -5 -6 --rh 8 7 --units 1 2 --workers 8
+
+Every (SHT40, RH) threshold pair is one scenario, as if it was typed into temp_rh_delta.py: per unit a figure of the
+runs' differentials with the crossings marked, and the RH/SHT40 stats tables of plot_dgo() (time at the threshold,
+time and energy saved, mixing ratio). The figures are rendered by a process pool, one task per scenario and unit plus
+one for the fleet wide differentials (inspect_125op.py), so the time goes down with the cores as runs and thresholds are
+added. The report folder gets:
+
+    index.html          summary per scenario, the stats tables and the figures
+    figures/            one html (sharing one plotly.min.js) or png per figure, not used with --format single
+    stats_rh.csv        stats tables of every scenario, with the thresholds as columns
+    stats_sht40.csv
+    summary.csv         per scenario: runs crossing each threshold, mean time saved, total energy saved
+    features.csv        run_features table of the selection
+    report.json         thresholds, runs, format, commit, timings
+
+--format single writes one self-contained index.html (plotly.js inlined once) that can be mailed around, png needs
+the kaleido package. For the nightly run, e.g. from cron on the compute node:
+
+    0 2 * * * cd /path/to/125Op_ExitCriteria && python report.py --out ./reports/$(date +\\%F) --sht -5 --rh 8
+"""
+
+REPORT_ROOT = "./reports"
+FORMATS = ["html", "single", "png"]
+DEFAULT_THRESHOLDS = [(-5.0, 8.0)]  # (SHT40, RH) delta thresholds
+
+'''
+desc: parse a threshold, "none" leaves that signal out
+'''
+def _threshold(text):
+    return None if text.lower() == "none" else float(text)
+
+'''
+desc: pair up the SHT40 and RH thresholds given on the command line (a single value goes with every one of the other)
+input: sht40, rh - lists of thresholds (float or None)
+output: list of (SHT40 threshold, RH threshold)
+'''
+def threshold_pairs(sht40, rh):
+    if len(sht40) == 1:
+        sht40 = sht40 * len(rh)
+    if len(rh) == 1:
+        rh = rh * len(sht40)
+    if len(sht40) != len(rh):
+        raise ValueError(f"{len(sht40)} SHT40 and {len(rh)} RH thresholds can't be paired up")
+    return list(zip(sht40, rh))
+
+'''
+desc: label of a threshold pair for file names and titles
+'''
+def pair_label(pair):
+    sht40, rh = pair
+    fmt = lambda v: "none" if v is None else f"{v:g}"
+    return f"sht{fmt(sht40)}_rh{fmt(rh)}"
+
+'''
+desc: write a figure in the report's format
+input: fig - plotly figure
+       out_dir - report folder
+       stem - file name without extension
+       fmt - "html", "png" or "single"
+output: path of the figure relative to the report folder, or its html div for "single"
+'''
+def write_figure(fig, out_dir, stem, fmt):
+    if fmt == "single":
+        return fig.to_html(full_html=False, include_plotlyjs=False)
+    os.makedirs(os.path.join(out_dir, "figures"), exist_ok=True)
+    path = os.path.join("figures", f"{stem}.{fmt}")
+    if fmt == "png":
+        fig.write_image(os.path.join(out_dir, path))
+    else:
+        fig.write_html(os.path.join(out_dir, path), include_plotlyjs="directory")  # one plotly.min.js for all
+    return path
+
+'''
+desc: render one task of the report (runs in a worker process)
+input: task - dict of the kind ("unit" or "fleet"), the run selection and the rendering options
+output: dict of the task's figures and stats rows (and the worker's timing totals)
+'''
+def _render_task(task):
+    fleet = Fleet(task["data_root"], calibrated=task["calibrated"]).select(names=task["names"])
+    result = {"kind": task["kind"], "pair": task.get("pair"), "unit": task.get("unit"), "figures": [],
+              "rh_rows": [], "sht40_rows": []}
+    with instrumentation.span(f"report.{task['kind']}", rows=len(fleet)):
+        if task["kind"] == "fleet":
+            for fig, stem in zip(delta_figures(fleet, None, task["downsample_method"]), ["fleet_sht40", "fleet_rh"]):
+                result["figures"].append(write_figure(fig, task["out_dir"], stem, task["format"]))
+        else:
+            sht40_threshold, rh_threshold = task["pair"]
+            fig, result["rh_rows"], result["sht40_rows"] = unit_figure(fleet, task["unit"], rh_threshold,
+                                                                       sht40_threshold, task["total_pressure"], None,
+                                                                       task["downsample_method"], task["smoothing"])
+            stem = f"{pair_label(task['pair'])}_unit{task['unit']}"
+            result["figures"].append(write_figure(fig, task["out_dir"], stem, task["format"]))
+    # a worker's spans would never reach the parent, so they are sent back with the result
+    result["metrics"] = instrumentation.snapshot(reset=True) if multiprocessing.parent_process() is not None else None
+    return result
+
+'''
+desc: per scenario summary of the stats tables
+input: rh_stats, sht40_stats - stats tables of every scenario (with the threshold columns)
+output: dataframe with one row per scenario
+'''
+def summarize(rh_stats, sht40_stats):
+    keys = ["SHT40 Threshold", "RH Threshold"]
+    parts = []
+    for signal, stats in [("SHT40", sht40_stats), ("RH", rh_stats)]:
+        grouped = stats.groupby(keys, dropna=False, sort=False)
+        parts.append(grouped.agg(**{f"Runs Crossing {signal}": (f"Time @ {signal} Threshold", "count"),
+                                    f"Mean Diff. in Time ({signal})": (f"Diff. in Time ({signal})", "mean"),
+                                    f"Total Energy Saved ({signal}) [kWh]": (f"Energy Saved ({signal}) [Wh]",
+                                                                             lambda e: e.sum() / 1000)}))
+    summary = pd.concat(parts, axis=1).reset_index()
+    summary.insert(2, "Runs", len(sht40_stats) // max(len(summary), 1))
+    return summary
+
+'''
+desc: the report's index page
+input: meta - report.json contents
+       summary - output of summarize()
+       scenarios - list of (pair, rh stats, sht40 stats, figures) per scenario
+       fleet_figures - figures of the fleet wide differentials
+       fmt - figure format (see write_figure())
+output: html text
+'''
+def index_html(meta, summary, scenarios, fleet_figures, fmt):
+    def figure_html(figure):
+        if fmt == "single":
+            return figure
+        if fmt == "png":
+            return f'<img src="{html.escape(figure)}" style="max-width:100%">'
+        return f'<iframe src="{html.escape(figure)}" width="1050" height="950" style="border:none"></iframe>'
+    table = lambda frame: frame.to_html(index=False, float_format=lambda v: f"{v:.2f}", na_rep="", border=0)
+
+    head = ""
+    if fmt == "single":
+        from plotly.offline import get_plotlyjs
+        head = f"<script>{get_plotlyjs()}</script>"
+    body = ["<h1>125C Operation - Exit Criteria Report</h1>",
+            f"<p>{html.escape(meta['created'])}, {len(meta['runs'])} runs, commit {html.escape(str(meta['commit']))}, "
+            f"{'calibrated' if meta['calibrated'] else 'uncalibrated'} deltas"
+            f"{', smoothed with ' + html.escape(meta['smoothing']) if meta['smoothing'] else ''}. "
+            "Times are in minutes. A positive difference in time indicates how much <i>shorter</i> the runtime would "
+            "be if DGO is stopped at the threshold.</p>",
+            "<h2>Summary</h2>", table(summary),
+            "<h2>Differentials</h2>"] + [figure_html(f) for f in fleet_figures]
+    for pair, rh_stats, sht40_stats, figures in scenarios:
+        sht40, rh = pair
+        body += [f"<h2>SHT40 threshold {sht40}, RH threshold {rh}</h2>",
+                 f"<h3>RH stats when RH threshold = {rh}</h3>", table(rh_stats),
+                 f"<h3>SHT40 stats when SHT40 threshold = {sht40}</h3>", table(sht40_stats)]
+        body += [figure_html(f) for f in figures]
+    return (f"<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Exit Criteria Report</title>{head}"
+            "<style>body{font-family:sans-serif} table{border-collapse:collapse} "
+            "td,th{padding:2px 8px;text-align:right}</style></head>\n<body>\n" + "\n".join(body) + "\n</body></html>\n")
+
+'''
+desc: generate the report
+input: pairs - list of (SHT40 threshold, RH threshold)
+       units, days - run selection (None for all)
+       out_dir - report folder (created, existing files are overwritten)
+       fmt - "html", "single" or "png"
+       workers - worker processes (None for one per core, 1 to render in this process)
+       data_root - folder of the compiled csv's
+       calibrated - apply the sensor calibration, like the dashboards do by default
+       total_pressure - atmospheric pressure [hPa] for the mixing ratio
+       downsample_method - "minmax" or "lttb"
+       smoothing - filter spec the deltas are smoothed with (see filters), like the dashboards' "Smoothing" box. None
+                   for the raw deltas
+output: meta - contents of report.json
+'''
+def generate_report(pairs=DEFAULT_THRESHOLDS, units=None, days=None, out_dir=None, fmt="html", workers=None,
+                    data_root=None, calibrated=True, total_pressure=STANDARD_PRESSURE, downsample_method="minmax",
+                    smoothing=None):
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {FORMATS}")
+    parse_filter(smoothing)  # a bad spec fails here rather than in every worker
+    if fmt == "png":
+        import kaleido  # noqa: F401  (plotly needs it for write_image, fail before rendering anything)
+    t0 = time.perf_counter()
+    fleet = Fleet(calibrated=calibrated) if data_root is None else Fleet(data_root, calibrated=calibrated)
+    fleet = fleet.select(units=units, days=days)
+    if len(fleet) == 0:
+        # e.g. run from another folder than the repo, the relative data root finds nothing
+        raise ValueError(f"no runs selected in {os.path.abspath(fleet.data_root)} (units {units}, days {days})")
+    out_dir = out_dir or os.path.join(REPORT_ROOT, datetime.date.today().isoformat())
+    os.makedirs(out_dir, exist_ok=True)
+
+    common = {"data_root": fleet.data_root, "calibrated": calibrated, "out_dir": out_dir, "format": fmt,
+              "total_pressure": total_pressure, "downsample_method": downsample_method, "smoothing": smoothing}
+    tasks = [dict(common, kind="fleet", names=fleet.names)]
+    for i, pair in enumerate(pairs):
+        for unit in fleet.units:
+            tasks.append(dict(common, kind="unit", pair=tuple(pair), index=i, unit=unit,
+                              names=fleet.select(units=[unit]).names))
+    if (workers == 1) or (len(tasks) == 1):
+        results = [_render_task(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_render_task, tasks))
+    for result in results:
+        instrumentation.merge(result["metrics"])
+    t_render = time.perf_counter() - t0
+
+    # stats tables per scenario, in unit order (the tasks come back in order)
+    scenarios, all_rh, all_sht40 = [], [], []
+    for pair in pairs:
+        parts = [r for r in results if (r["kind"] == "unit") and (r["pair"] == tuple(pair))]
+        rh_stats, sht40_stats = stats_tables(sum((r["rh_rows"] for r in parts), []),
+                                             sum((r["sht40_rows"] for r in parts), []))
+        scenarios.append((pair, rh_stats, sht40_stats, sum((r["figures"] for r in parts), [])))
+        thresholds = {"SHT40 Threshold": pair[0], "RH Threshold": pair[1]}
+        all_rh.append(rh_stats.assign(**thresholds))
+        all_sht40.append(sht40_stats.assign(**thresholds))
+    rh_stats = pd.concat(all_rh, ignore_index=True) if all_rh else pd.DataFrame()
+    sht40_stats = pd.concat(all_sht40, ignore_index=True) if all_sht40 else pd.DataFrame()
+    summary = summarize(rh_stats, sht40_stats) if pairs else pd.DataFrame()
+    rh_stats.to_csv(os.path.join(out_dir, "stats_rh.csv"), index=False)
+    sht40_stats.to_csv(os.path.join(out_dir, "stats_sht40.csv"), index=False)
+    summary.to_csv(os.path.join(out_dir, "summary.csv"), index=False)
+    feature_table(fleet).to_csv(os.path.join(out_dir, "features.csv"))
+
+    fleet_figures = next(r["figures"] for r in results if r["kind"] == "fleet")
+    meta = {"created": datetime.datetime.now().isoformat(timespec="seconds"), **instrumentation.git_state(),
+            "thresholds": [list(p) for p in pairs], "runs": fleet.names, "format": fmt, "workers": workers,
+            "calibrated": calibrated, "smoothing": smoothing, "total_pressure": total_pressure, "tasks": len(tasks),
+            "render_seconds": t_render, "seconds": None}
+    with open(os.path.join(out_dir, "index.html"), "w", encoding="utf-8") as f:
+        f.write(index_html(meta, summary, scenarios, fleet_figures, fmt))
+    meta["seconds"] = time.perf_counter() - t0
+    with open(os.path.join(out_dir, "report.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="headless exit criteria report (stats tables and figures)")
+    parser.add_argument("--sht", type=_threshold, nargs="+", default=[DEFAULT_THRESHOLDS[0][0]],
+                        help="SHT40 delta thresholds, paired with the RH ones in order (none to leave it out)")
+    parser.add_argument("--rh", type=_threshold, nargs="+", default=[DEFAULT_THRESHOLDS[0][1]],
+                        help="RH delta thresholds (a single threshold goes with every SHT40 one)")
+    parser.add_argument("--units", type=int, nargs="*", default=None)
+    parser.add_argument("--days", type=int, nargs="*", default=None)
+    parser.add_argument("--out", default=None, help=f"report folder (default: {REPORT_ROOT}/<today>)")
+    parser.add_argument("--format", choices=FORMATS, default="html",
+                        help="html files, one self-contained html, or png (needs kaleido)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--data-root", default=None, help="folder of the compiled csv's")
+    parser.add_argument("--no-calibration", action="store_true", help="don't apply the sensor calibration")
+    parser.add_argument("--pressure", type=float, default=STANDARD_PRESSURE, help="atmospheric pressure [hPa]")
+    parser.add_argument("--smoothing", default=None, help="smooth the deltas first, e.g. ema:12 or median:13")
+    parser.add_argument("--metrics", default=None, help="append the timing spans to this .jsonl file")
+    args = parser.parse_args()
+    try:
+        pairs = threshold_pairs(args.sht, args.rh)
+    except ValueError as e:
+        parser.error(str(e))
+
+    try:
+        meta = generate_report(pairs, args.units, args.days, args.out, args.format, args.workers, args.data_root,
+                               not args.no_calibration, args.pressure, smoothing=args.smoothing)
+    except ValueError as e:  # e.g. no runs selected, or a bad --smoothing spec
+        parser.error(str(e))
+    print(f"{meta['tasks']} figure tasks, {len(meta['runs'])} runs, {len(meta['thresholds'])} threshold pairs "
+          f"in {meta['seconds']:.2f} s -> {args.out or os.path.join(REPORT_ROOT, datetime.date.today().isoformat())}")
+    if args.metrics is not None:
+        instrumentation.export_jsonl(args.metrics, "report.py")
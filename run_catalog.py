@@ -0,0 +1,327 @@
+import argparse
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from dgo_io import parse_run_name, RIG_TIMEZONE
+from threshold_index import build_run_index
+"""
+SQLite catalog of the compiled runs, so "which runs exist, how long were they, when did they cross -2 degC" is a query
+instead of reading every csv. compile_dgos() writes one row per run as it compiles it:
+
+    runs            name, unit, day, calendar date, path, start/end index in the raw log, rows, runtime [min], compiled at
+    channel_stats   min/max/mean of every channel of every run
+    crossings       first crossing time [min] of the SHT40/RH deltas for a grid of thresholds (CROSSING_THRESHOLDS),
+                    same interpolated crossing as threshold_index, on the raw deltas (uncalibrated, unsmoothed)
+    baselines       pre-heat offset of the exhaust sensors to the intake ones (see calibration)
+
+The catalogued crossings are of the deltas as compiled: the dashboards find theirs on the calibrated (and optionally
+smoothed) deltas, which a grid fixed at compile time can't follow, so they take them from the cached CrossingIndex of
+each run instead. crossing_times() answers "when did they cross" for the raw deltas without loading any run.
+
+The dashboards filter and summarize the runs from here and only load the series of the runs that are selected.
+"""
+
+CATALOG_PATH = "./125C_DATA/dgo_catalog.sqlite"
+
+# calendar date of each test day (the dashboards used to only have this as a string)
+RUN_DATES = {1: "2024-03-06", 2: "2024-03-07", 3: "2024-03-08", 4: "2024-03-11", 5: "2024-03-14", 6: "2024-03-15",
+             7: "2024-03-18"}
+
+# thresholds the crossing times are catalogued for (the deltas span about -21..0 degC and 0..28 RH)
+CROSSING_THRESHOLDS = {"SHT40": np.round(np.arange(-21.0, 1.0 + 1e-9, 0.25), 2),
+                       "RH": np.round(np.arange(0.0, 28.0 + 1e-9, 0.25), 2)}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    name TEXT PRIMARY KEY,
+    unit INTEGER,
+    day INTEGER,
+    date TEXT,
+    path TEXT,
+    start_index INTEGER,
+    end_index INTEGER,
+    rows INTEGER,
+    runtime_min REAL,
+    compiled_at TEXT
+);
+CREATE TABLE IF NOT EXISTS channel_stats (
+    name TEXT REFERENCES runs(name) ON DELETE CASCADE,
+    channel TEXT,
+    min REAL,
+    max REAL,
+    mean REAL,
+    PRIMARY KEY (name, channel)
+);
+CREATE TABLE IF NOT EXISTS crossings (
+    name TEXT REFERENCES runs(name) ON DELETE CASCADE,
+    signal TEXT,
+    threshold REAL,
+    time_min REAL,
+    PRIMARY KEY (name, signal, threshold)
+);
+CREATE TABLE IF NOT EXISTS baselines (
+    name TEXT REFERENCES runs(name) ON DELETE CASCADE,
+    channel TEXT,
+    offset REAL,
+    samples INTEGER,
+    PRIMARY KEY (name, channel)
+);
+CREATE INDEX IF NOT EXISTS runs_unit_day ON runs (unit, day);
+"""
+
+RUN_COLUMNS = {"name": "Name", "unit": "Unit", "day": "Day", "date": "Date", "path": "Path",
+               "start_index": "Start Index", "end_index": "End Index", "rows": "Rows", "runtime_min": "Runtime [min]",
+               "compiled_at": "Compiled At"}
+
+'''
+desc: open (and create if needed) the catalog
+input: path - sqlite file
+output: sqlite3 connection
+'''
+def connect(path=CATALOG_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=WAL")  # the dashboards can read while compile_dgos() writes
+    con.execute("PRAGMA foreign_keys=ON")
+    con.executescript(SCHEMA)
+    return con
+
+'''
+desc: calendar date of a run: the rig local date of its first sample if it is known, else the date of its test day
+input: day - test day (1-7)
+       start_time - epoch ms of the first sample (None if unknown)
+output: date string (YYYY-MM-DD), None if neither is known
+'''
+def run_date(day, start_time=None):
+    if start_time is not None:
+        return pd.Timestamp(start_time, unit="ms", tz="UTC").tz_convert(RIG_TIMEZONE).strftime("%Y-%m-%d")
+    return RUN_DATES.get(day)
+
+'''
+desc: catalog record of a compiled run. runs in the compile workers, so it only returns plain data
+input: dgo_data - dataframe of the compiled run (output of extrapolate_dgo(), with the start/end index and start time
+                  in its attrs)
+       dataname - name of the run
+       path - where the compiled csv was written
+       baselines - pre-heat baselines of the run, dict of channel -> (offset, samples), see calibration.preheat_offsets()
+output: dict with the "run" row, the "channel_stats", "crossings" and "baselines" rows
+'''
+def run_record(dgo_data, dataname, path, baselines=None):
+    unit, day = parse_run_name(dataname)
+    t = dgo_data["time"].to_numpy(dtype=np.float64)
+    t_valid = t[~np.isnan(t)]
+    run = {"name": dataname, "unit": unit, "day": day, "date": run_date(day, dgo_data.attrs.get("start_time")),
+           "path": os.path.abspath(path), "start_index": dgo_data.attrs.get("start_index"),
+           "end_index": dgo_data.attrs.get("end_index"), "rows": len(dgo_data),
+           "runtime_min": float(t_valid[-1] / 60) if len(t_valid) else None,
+           "compiled_at": pd.Timestamp.now(tz="UTC").isoformat(timespec="seconds")}
+
+    channels = [c for c in dgo_data.columns if c != "time"]
+    agg = dgo_data[channels].astype(np.float64).agg(["min", "max", "mean"])  # NaN samples skipped
+    stats = [(dataname, c, _sql(agg.at["min", c]), _sql(agg.at["max", c]), _sql(agg.at["mean", c])) for c in channels]
+
+    crossings = []
+    if {"Exhaust SHT40", "Intake SHT40", "Exhaust RH", "Intake Air RH"} <= set(dgo_data.columns):
+        index = build_run_index(dgo_data)
+        for signal, thresholds in CROSSING_THRESHOLDS.items():
+            times = index[signal].first_time(thresholds)
+            crossings += [(dataname, signal, float(x), _sql(tc)) for x, tc in zip(thresholds, times)]
+    baselines = [(dataname, c, float(offset), int(n)) for c, (offset, n) in (baselines or {}).items()]
+    return {"run": run, "channel_stats": stats, "crossings": crossings, "baselines": baselines}
+
+'''
+desc: NaN as NULL for sqlite
+'''
+def _sql(value):
+    value = float(value)
+    return None if np.isnan(value) else value
+
+'''
+desc: add or replace runs in the catalog, in a single transaction
+input: records - list of run_record() outputs
+       path - sqlite file
+'''
+def upsert_runs(records, path=CATALOG_PATH):
+    if not records:
+        return
+    con = connect(path)
+    try:
+        with con:
+            for record in records:
+                run = record["run"]
+                con.execute("DELETE FROM runs WHERE name = ?", (run["name"],))  # cascades to the stats/crossings
+                con.execute(f"INSERT INTO runs ({', '.join(run)}) VALUES ({', '.join('?' * len(run))})",
+                            list(run.values()))
+                con.executemany("INSERT INTO channel_stats VALUES (?, ?, ?, ?, ?)", record["channel_stats"])
+                con.executemany("INSERT INTO crossings VALUES (?, ?, ?, ?)", record["crossings"])
+                con.executemany("INSERT INTO baselines VALUES (?, ?, ?, ?)", record.get("baselines", []))
+    finally:
+        con.close()
+
+'''
+desc: take runs out of the catalog (e.g. runs the quality scan now leaves out), in a single transaction
+input: names - run names
+       path - sqlite file
+'''
+def delete_runs(names, path=CATALOG_PATH):
+    names = list(names)
+    if (not names) or (not os.path.isfile(path)):
+        return
+    con = connect(path)
+    try:
+        with con:
+            con.executemany("DELETE FROM runs WHERE name = ?", [(name,) for name in names])  # cascades
+    finally:
+        con.close()
+
+'''
+desc: names of the runs in the catalog (empty if there is no catalog yet). runs without channel stats (catalogued
+      while the catalog didn't keep them) are left out, so compile_dgos() fills them in
+input: path - sqlite file
+output: set of run names
+'''
+def catalogued_names(path=CATALOG_PATH):
+    if not os.path.isfile(path):
+        return set()
+    con = connect(path)
+    try:
+        return {row[0] for row in con.execute("SELECT DISTINCT runs.name FROM runs "
+                                              "JOIN channel_stats s ON s.name = runs.name")}
+    finally:
+        con.close()
+
+'''
+desc: query the runs without loading them
+input: units, days - lists of units/days to keep (None for all)
+       path - sqlite file
+output: dataframe of the runs (see RUN_COLUMNS), sorted by unit and day. empty if there is no catalog yet
+'''
+def load_runs(units=None, days=None, path=CATALOG_PATH):
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=list(RUN_COLUMNS.values()))
+    where, params = _filters(units, days)
+    con = connect(path)
+    try:
+        runs = pd.read_sql_query(f"SELECT * FROM runs {where} ORDER BY unit, day, name", con, params=params)
+    finally:
+        con.close()
+    return runs.rename(columns=RUN_COLUMNS)
+
+'''
+desc: where clause of the unit/day filters
+'''
+def _filters(units, days, table="runs"):
+    clauses, params = [], []
+    for column, values in [("unit", units), ("day", days)]:
+        if values is not None:
+            values = [int(v) for v in values]
+            clauses.append(f"{table}.{column} IN ({', '.join('?' * len(values))})" if values else "0")
+            params += values
+    return ("WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+'''
+desc: min/max/mean of channels of the runs, without loading them
+input: channels - channel names (None for all)
+       units, days - lists of units/days to keep (None for all)
+       path - sqlite file
+output: dataframe with one row per run and channel
+'''
+def channel_stats(channels=None, units=None, days=None, path=CATALOG_PATH):
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=["Name", "Unit", "Day", "Channel", "Min", "Max", "Mean"])
+    where, params = _filters(units, days)
+    if channels is not None:
+        where += (" AND " if where else "WHERE ") + f"s.channel IN ({', '.join('?' * len(channels))})"
+        params += list(channels)
+    con = connect(path)
+    try:
+        return pd.read_sql_query("SELECT s.name AS Name, runs.unit AS Unit, runs.day AS Day, s.channel AS Channel, "
+                                 "s.min AS Min, s.max AS Max, s.mean AS Mean FROM channel_stats s "
+                                 f"JOIN runs ON runs.name = s.name {where} ORDER BY runs.unit, runs.day, s.channel",
+                                 con, params=params)
+    finally:
+        con.close()
+
+'''
+desc: when each run first crossed a threshold, without loading them. these are the crossings of the raw deltas
+      (uncalibrated, unsmoothed), the dashboards' calibrated ones come from the cached CrossingIndex
+input: signal - "SHT40" or "RH"
+       threshold - threshold of the delta, snapped to the nearest catalogued one (see CROSSING_THRESHOLDS)
+       units, days - lists of units/days to keep (None for all)
+       path - sqlite file
+output: dataframe of name, runtime end, time @ threshold and diff. in time [min] (same columns as the dashboards). NaN for
+        runs that never cross it
+'''
+def crossing_times(signal, threshold, units=None, days=None, path=CATALOG_PATH):
+    grid = CROSSING_THRESHOLDS[signal]
+    snapped = float(grid[np.argmin(np.abs(grid - threshold))])
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=["Name", "Runtime End", f"Time @ {signal} Threshold", f"Diff. in Time ({signal})"])
+    where, params = _filters(units, days)
+    con = connect(path)
+    try:
+        times = pd.read_sql_query("SELECT runs.name AS Name, runs.runtime_min AS end, c.time_min AS cross FROM runs "
+                                  "LEFT JOIN crossings c ON c.name = runs.name AND c.signal = ? AND c.threshold = ? "
+                                  f"{where} ORDER BY runs.unit, runs.day, runs.name", con,
+                                  params=[signal, snapped] + params)
+    finally:
+        con.close()
+    return pd.DataFrame({"Name": times["Name"],
+                         "Runtime End": times["end"].astype(float),
+                         f"Time @ {signal} Threshold": times["cross"].astype(float),
+                         f"Diff. in Time ({signal})": (times["end"] - times["cross"]).astype(float)})
+
+'''
+desc: pre-heat baselines of the runs
+input: units, days - lists of units/days to keep (None for all)
+       path - sqlite file
+output: dataframe of name, unit, day, channel, offset, samples. empty if there is no catalog yet
+'''
+def baselines(units=None, days=None, path=CATALOG_PATH):
+    columns = ["Name", "Unit", "Day", "Channel", "Offset", "Samples"]
+    if not os.path.isfile(path):
+        return pd.DataFrame(columns=columns)
+    where, params = _filters(units, days)
+    con = connect(path)
+    try:
+        return pd.read_sql_query("SELECT b.name AS Name, runs.unit AS Unit, runs.day AS Day, b.channel AS Channel, "
+                                 "b.offset AS Offset, b.samples AS Samples FROM baselines b "
+                                 f"JOIN runs ON runs.name = b.name {where} ORDER BY runs.unit, runs.day, b.channel",
+                                 con, params=params)
+    finally:
+        con.close()
+
+'''
+desc: pre-heat baselines of one run
+input: name - run name
+       path - sqlite file
+output: dict of channel -> (offset, samples), empty if the run (or the catalog) has none
+'''
+def run_baselines(name, path=CATALOG_PATH):
+    if not os.path.isfile(path):
+        return {}
+    con = connect(path)
+    try:
+        rows = con.execute("SELECT channel, offset, samples FROM baselines WHERE name = ?", (name,)).fetchall()
+    finally:
+        con.close()
+    return {channel: (offset, samples) for channel, offset, samples in rows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="query the run catalog")
+    parser.add_argument("--catalog", default=CATALOG_PATH, help="sqlite file")
+    parser.add_argument("--units", type=int, nargs="*", default=None)
+    parser.add_argument("--days", type=int, nargs="*", default=None)
+    parser.add_argument("--crossing", nargs=2, metavar=("SIGNAL", "THRESHOLD"), default=None,
+                        help="first crossing times of the raw deltas, e.g. --crossing SHT40 -2")
+    parser.add_argument("--channels", nargs="*", default=None, help="min/max/mean of these channels")
+    args = parser.parse_args()
+
+    print(load_runs(args.units, args.days, args.catalog).drop(columns=["Path"]).to_string(index=False))
+    if args.crossing is not None:
+        print(crossing_times(args.crossing[0], float(args.crossing[1]), args.units, args.days,
+                             args.catalog).to_string(index=False))
+    if args.channels is not None:
+        print(channel_stats(args.channels or None, args.units, args.days, args.catalog).to_string(index=False))
@@ -0,0 +1,197 @@
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from dgo_cache import load_derived
+from dgo_store import read_compiled
+from fleet import Fleet
+"""
+Per run features of the compiled runs: energy, water removed, drying rates and heater saturation, one row per run.
+
+Every feature of a run comes out of one pass of array operations over its samples (run_features()), so the whole table
+is either built through the dataset cache (the dashboards) or split over a process pool (feature_table(workers=...)).
+The cumulative energy of a run is kept as well, so the energy used up to a threshold crossing, and what stopping there
+would have saved, can be read off for any threshold without going back to the samples (threshold_energy()).
+
+The Ohaus weights are in kg and Watts is the power drawn by the whole unit.
+"""
+
+FEATURE_CHANNELS = ["Watts", "Ohaus Water Weight", "Intake Heater PWM", "Bucket Heater PWM"]
+WEIGHT_WINDOW_MIN = 5.0  # start/end water weight: median of the first/last 5 min (the scale is noisy)
+RATE_WINDOW_MIN = 5.0  # drying rate: water weight change over 5 min
+RATE_SMOOTH_SAMPLES = 13  # ~1 min running median of the water weight first, the scale spikes now and then
+SATURATED_PWM = 100.0
+
+'''
+desc: energy used from the start of the cycle up to every sample (trapezoids between the valid samples, the dropout
+rows get the value interpolated between their neighbours)
+input: t_min - sample times [min]
+       watts - power [W]
+output: cumulative energy [Wh], same length as t_min
+'''
+def cumulative_energy(t_min, watts):
+    t_min = np.asarray(t_min, dtype=np.float64)
+    watts = np.asarray(watts, dtype=np.float64)
+    valid = ~np.isnan(t_min) & ~np.isnan(watts)
+    if valid.sum() < 2:
+        return np.full(len(t_min), np.nan)
+    tv, wv = t_min[valid], watts[valid]
+    energy = np.concatenate([[0.0], np.cumsum(np.diff(tv) / 60 * (wv[1:] + wv[:-1]) / 2)])
+    return np.where(np.isnan(t_min), np.nan, np.interp(t_min, tv, energy))
+
+'''
+desc: time and cumulative energy of a run, see cumulative_energy()
+input: dgo_data - dataframe of a compiled run with a Watts column
+output: dict of "t_min" and "energy" [Wh] numpy arrays
+'''
+def energy_curve(dgo_data):
+    t_min = dgo_data["time"].to_numpy(dtype=np.float64) / 60
+    return {"t_min": t_min, "energy": cumulative_energy(t_min, dgo_data["Watts"].to_numpy(dtype=np.float64))}
+
+'''
+desc: energy used up to some times
+input: curve - output of energy_curve()
+       t_min - times [min] (NaN for none)
+output: energy [Wh] at each time (NaN for NaN times)
+'''
+def energy_at(curve, t_min):
+    t_min = np.asarray(t_min, dtype=np.float64)
+    valid = ~np.isnan(curve["energy"])
+    if not valid.any():
+        return np.full(t_min.shape, np.nan)
+    return np.where(np.isnan(t_min), np.nan, np.interp(t_min, curve["t_min"][valid], curve["energy"][valid]))
+
+'''
+desc: every feature of one run
+input: dgo_data - dataframe of a compiled run (at least time and FEATURE_CHANNELS)
+output: dict of feature -> value (NaN where the run doesn't have what a feature needs)
+'''
+def run_features(dgo_data):
+    t = dgo_data["time"].to_numpy(dtype=np.float64) / 60
+    watts = dgo_data["Watts"].to_numpy(dtype=np.float64)
+    water = dgo_data["Ohaus Water Weight"].to_numpy(dtype=np.float64)
+    intake_pwm = dgo_data["Intake Heater PWM"].to_numpy(dtype=np.float64)
+    bucket_pwm = dgo_data["Bucket Heater PWM"].to_numpy(dtype=np.float64)
+    valid_t = t[~np.isnan(t)]
+    t_end = valid_t[-1] if len(valid_t) else np.nan
+    hours = t_end / 60
+
+    energy = cumulative_energy(t, watts)
+    energy_total = energy[~np.isnan(energy)][-1] if (~np.isnan(energy)).any() else np.nan
+
+    # water removed: start - end weight, and the steepest drop over RATE_WINDOW_MIN of the smoothed weight
+    has_water = ~np.isnan(water) & ~np.isnan(t)
+    tw, w = t[has_water], water[has_water]
+    water_start = np.median(w[tw <= tw[0] + WEIGHT_WINDOW_MIN]) if len(w) else np.nan
+    water_end = np.median(w[tw >= tw[-1] - WEIGHT_WINDOW_MIN]) if len(w) else np.nan
+    if len(w) >= RATE_SMOOTH_SAMPLES:
+        half = RATE_SMOOTH_SAMPLES // 2
+        padded = np.concatenate([np.full(half, w[0]), w, np.full(half, w[-1])])
+        w = np.median(np.lib.stride_tricks.sliding_window_view(padded, RATE_SMOOTH_SAMPLES), axis=1)
+    later = np.searchsorted(tw, tw + RATE_WINDOW_MIN)
+    inside = later < len(tw)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        rates = (w[inside] - w[later[inside]]) / (tw[later[inside]] - tw[inside]) * 60  # kg/h
+    peak_rate = rates.max() if len(rates) else np.nan
+
+    # heater saturation: time to the first sample at full power, and how long it stays there (up to the first sample
+    # after it below full power)
+    saturated = intake_pwm >= SATURATED_PWM
+    t_to_saturation, saturated_min = np.nan, np.nan
+    if saturated.any():
+        first = np.argmax(saturated)
+        below = (intake_pwm[first:] < SATURATED_PWM)  # NaN rows are neither
+        t_to_saturation = t[first]
+        saturated_min = (t[first + np.argmax(below)] if below.any() else t_end) - t_to_saturation
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return {"Runtime End": t_end,
+                "Energy [Wh]": energy_total,
+                "Mean Power [W]": energy_total / hours,
+                "Peak Power [W]": np.nanmax(watts) if (~np.isnan(watts)).any() else np.nan,
+                "Water Start [kg]": water_start,
+                "Water End [kg]": water_end,
+                "Water Removed [kg]": water_start - water_end,
+                "Mean Drying Rate [kg/h]": (water_start - water_end) / hours,
+                "Peak Drying Rate [kg/h]": peak_rate,
+                "Time to Heater Saturation [min]": t_to_saturation,
+                "Heater Saturated Duration [min]": saturated_min,
+                "Intake Heater Duty [%]": np.nanmean(intake_pwm) if (~np.isnan(intake_pwm)).any() else np.nan,
+                "Bucket Heater Duty [%]": np.nanmean(bucket_pwm) if (~np.isnan(bucket_pwm)).any() else np.nan,
+                "Energy per Water [Wh/kg]": energy_total / (water_start - water_end)
+                                            if water_start > water_end else np.nan}
+
+'''
+desc: cached features of a run (see run_features())
+input: filepath - compiled dgo csv
+output: dict of feature -> value
+'''
+def load_features(filepath):
+    return load_derived(filepath, "features", run_features, columns=FEATURE_CHANNELS)
+
+'''
+desc: cached cumulative energy of a run (see energy_curve())
+input: filepath - compiled dgo csv
+output: dict of "t_min" and "energy" numpy arrays (read-only)
+'''
+def load_energy(filepath):
+    return load_derived(filepath, "energy", energy_curve, columns=["Watts"])
+
+'''
+desc: features of a compiled csv, read without the cache (for the worker processes)
+'''
+def _file_features(filepath):
+    return run_features(read_compiled(filepath, FEATURE_CHANNELS))
+
+'''
+desc: feature table of a fleet
+input: fleet - Fleet
+       workers - worker processes (1 to go through the dataset cache in this process, None for one per core)
+output: dataframe indexed by run name with the unit, day and every feature of run_features()
+'''
+def feature_table(fleet, workers=1):
+    paths = [fleet.path(name) for name in fleet.names]
+    if workers == 1:
+        rows = [load_features(path) for path in paths]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            rows = list(pool.map(_file_features, paths, chunksize=max(len(paths) // 32, 1)))
+    table = pd.DataFrame(rows, index=pd.Index(fleet.names, name="Name"))
+    table.insert(0, "Day", fleet.runs["Day"].to_numpy())
+    table.insert(0, "Unit", fleet.runs["Unit"].to_numpy())
+    return table
+
+'''
+desc: add the energy used up to a threshold crossing and the energy stopping there would have saved to a crossing
+table (e.g. threshold_index.crossing_stats())
+input: fleet - Fleet the runs of the table come from
+       stats - dataframe with Name and "Time @ {signal} Threshold" [min]
+       signal - "SHT40" or "RH"
+output: copy of stats with "Energy @ {signal} Threshold [Wh]" and "Energy Saved ({signal}) [Wh]"
+'''
+def threshold_energy(fleet, stats, signal):
+    at_cross, saved = [], []
+    for name, t_cross in zip(stats["Name"], stats[f"Time @ {signal} Threshold"].to_numpy(dtype=np.float64)):
+        curve = load_energy(fleet.path(name))
+        e_cross, e_end = energy_at(curve, [t_cross, np.nanmax(curve["t_min"])])
+        at_cross.append(e_cross)
+        saved.append(e_end - e_cross)
+    return stats.assign(**{f"Energy @ {signal} Threshold [Wh]": at_cross, f"Energy Saved ({signal}) [Wh]": saved})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="per run feature table of the compiled runs")
+    parser.add_argument("--units", type=int, nargs="*", default=None)
+    parser.add_argument("--days", type=int, nargs="*", default=None)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--out", default=None, help="write the table to this csv")
+    args = parser.parse_args()
+
+    fleet = Fleet().select(units=args.units, days=args.days)
+    t0 = time.perf_counter()
+    table = feature_table(fleet, args.workers)
+    print(f"{len(table)} runs in {time.perf_counter() - t0:.2f} s")
+    if args.out is not None:
+        table.to_csv(args.out)
+    print(table.round(3).to_string())
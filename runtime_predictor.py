@@ -0,0 +1,279 @@
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+from fleet import Fleet
+"""
+Early prediction of the end of a dgo run ("Runtime End") from its first minutes.
+
+Past the heat-up transient (FIT_START_MIN) the SHT40 and RH deltas recover and the Ohaus water weight drifts, each
+roughly as a decay y(t) = a + b * exp(-(t - t0) / tau). For a fixed tau the model is linear in a and b, so every run is
+fitted for every tau of TAU_GRID_MIN at once from sufficient statistics (sums of 1, e, e^2, y, y*e, y^2 per run and tau,
+one bincount over the whole fleet per tau) and the tau with the smallest squared error is kept. The statistics are just
+sums, so a live rig can keep adding samples (DecayFit.update() / RuntimePredictor) and re-solve in O(taus).
+
+A run is predicted to end when its fitted curves reach the level its unit's archived runs ended at (median over the
+signals that get there), never before the current time and within the range of runtimes the unit has run for. Units
+without any archived runs aren't bounded. evaluate() replays this leave-one-out over the archive at a few horizons and
+reports the error next to the plain unit median runtime, which is hard to beat while the runtimes are set by the cycle
+program (150/240 min on units 1 and 2).
+"""
+
+FIT_START_MIN = 10.0  # the SHT40 delta bottoms out around 10 min, the decay is fitted from there
+TAU_GRID_MIN = np.geomspace(5, 3000, 60)
+MIN_FIT_SAMPLES = 12  # 1 min of samples
+END_WINDOW_MIN = 5.0  # end level of an archived run: mean of its last 5 min
+HORIZONS_MIN = [30, 60, 90, 120]
+# signal -> (exhaust, intake) channels of a delta, or the channel itself
+FIT_SIGNALS = {"SHT40": ("Exhaust SHT40", "Intake SHT40"), "RH": ("Exhaust RH", "Intake Air RH"),
+               "Water": ("Ohaus Water Weight", None)}
+
+'''
+desc: least squares fit of y = a + b * exp(-(t - t0) / tau) for every tau of a grid, for many runs at once, from
+running sums so samples can be added as they arrive
+input: n_runs - number of runs fitted side by side
+       taus - grid of decay times [min]
+       t0 - start of the fit [min], earlier samples are ignored
+'''
+class DecayFit:
+
+    def __init__(self, n_runs=1, taus=TAU_GRID_MIN, t0=FIT_START_MIN):
+        self.taus = np.asarray(taus, dtype=np.float64)
+        self.t0 = t0
+        self.n = np.zeros(n_runs)
+        self.sy = np.zeros(n_runs)
+        self.syy = np.zeros(n_runs)
+        self.se = np.zeros((n_runs, len(self.taus)))
+        self.see = np.zeros((n_runs, len(self.taus)))
+        self.sye = np.zeros((n_runs, len(self.taus)))
+
+    '''
+    desc: add samples
+    input: t - sample times [min]
+           y - samples
+           rows - run of each sample (None if every sample is from run 0)
+    output: self
+    '''
+    def update(self, t, y, rows=None):
+        t = np.atleast_1d(np.asarray(t, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        rows = np.zeros(len(t), dtype=np.intp) if rows is None else np.atleast_1d(np.asarray(rows, dtype=np.intp))
+        keep = (t >= self.t0) & ~np.isnan(y)  # NaN times fail the comparison too
+        x, y, rows = t[keep] - self.t0, y[keep], rows[keep]
+        if len(x) == 0:
+            return self
+        n_runs = len(self.n)
+        self.n += np.bincount(rows, minlength=n_runs)
+        self.sy += np.bincount(rows, y, n_runs)
+        self.syy += np.bincount(rows, y * y, n_runs)
+        for j, tau in enumerate(self.taus):
+            e = np.exp(-x / tau)
+            self.se[:, j] += np.bincount(rows, e, n_runs)
+            self.see[:, j] += np.bincount(rows, e * e, n_runs)
+            self.sye[:, j] += np.bincount(rows, y * e, n_runs)
+        return self
+
+    '''
+    desc: best fit of every run (the tau of the grid with the smallest squared error)
+    output: dict of "a", "b", "tau", "rmse", "n" arrays (one per run, NaN where there are too few samples)
+    '''
+    def solve(self):
+        n = self.n[:, None]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            det = n * self.see - self.se ** 2
+            b = (n * self.sye - self.se * self.sy[:, None]) / det
+            a = (self.sy[:, None] - b * self.se) / n
+            sse = self.syy[:, None] - a * self.sy[:, None] - b * self.sye
+        # a tau so long that exp() is flat over the samples can't be told from the constant term
+        ok = (n >= MIN_FIT_SAMPLES) & (det > 1e-12 * n * self.see) & np.isfinite(sse)
+        sse = np.where(ok, sse, np.inf)
+        best = np.argmin(sse, axis=1)
+        rows = np.arange(len(best))
+        found = np.isfinite(sse[rows, best])
+        pick = lambda m: np.where(found, m[rows, best], np.nan)
+        return {"a": pick(a), "b": pick(b), "tau": np.where(found, self.taus[best], np.nan),
+                "rmse": np.where(found, np.sqrt(np.maximum(pick(sse), 0) / np.maximum(self.n, 1)), np.nan),
+                "n": self.n.copy()}
+
+'''
+desc: time a fitted curve reaches a level
+input: fit - output of DecayFit.solve()
+       level - level of every run (or one for all)
+       t0 - start of the fit [min]
+output: times [min]: t0 if the curve already started past the level, NaN if it never gets there
+'''
+def level_time(fit, level, t0=FIT_START_MIN):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        e = (np.asarray(level, dtype=np.float64) - fit["a"]) / fit["b"]
+        t = np.where(e >= 1, t0, t0 - fit["tau"] * np.log(e))
+    return np.where(np.isfinite(t) & (e > 0), t, np.nan)
+
+'''
+desc: time [min] and the fitted signals of every run of a fleet
+input: fleet - Fleet
+output: t - RaggedArray of time [min], signals - dict of FIT_SIGNALS name -> RaggedArray
+'''
+def fleet_signals(fleet):
+    t = fleet.channel("time") / 60
+    signals = {}
+    for signal, (channel, reference) in FIT_SIGNALS.items():
+        series = fleet.channel(channel)
+        signals[signal] = series if reference is None else series - fleet.channel(reference)
+    return t, signals
+
+'''
+desc: fit every signal of every run on the samples up to a horizon
+input: t, signals - output of fleet_signals()
+       horizon - last time used [min] (None for the whole runs)
+output: dict of signal -> DecayFit.solve() output
+'''
+def fit_runs(t, signals, horizon=None):
+    rows = t.row_ids()
+    seen = np.ones(len(t.values), dtype=bool) if horizon is None else t.values <= horizon
+    fits = {}
+    for signal, y in signals.items():
+        fits[signal] = DecayFit(len(t)).update(t.values[seen], y.values[seen], rows[seen]).solve()
+    return fits
+
+'''
+desc: runtime and end levels of finished runs, what the predictions are calibrated on
+input: fleet - Fleet of finished (compiled) runs
+       t, signals - output of fleet_signals() (computed if not given)
+output: dataframe of Name, Unit, Runtime End [min] and the end level of each signal (mean of the last END_WINDOW_MIN)
+'''
+def archive_table(fleet, t=None, signals=None):
+    if t is None:
+        t, signals = fleet_signals(fleet)
+    t_end = t.last()
+    rows = t.row_ids()
+    last = t.values >= (t_end[rows] - END_WINDOW_MIN)
+    archive = pd.DataFrame({"Name": fleet.names, "Unit": fleet.runs["Unit"].to_numpy(), "Runtime End": t_end})
+    for signal, y in signals.items():
+        valid = last & ~np.isnan(y.values)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            archive[f"End {signal}"] = (np.bincount(rows[valid], y.values[valid], len(t))
+                                        / np.bincount(rows[valid], minlength=len(t)))
+    return archive
+
+'''
+desc: per unit prior of the archive: median end level of each signal, and the median/min/max runtime
+input: archive - output of archive_table()
+output: dataframe indexed by unit
+'''
+def unit_priors(archive):
+    levels = [c for c in archive.columns if c.startswith("End ")]
+    grouped = archive.groupby("Unit")
+    priors = grouped[levels].median()
+    priors["Runtime Median"] = grouped["Runtime End"].median()
+    priors["Runtime Min"] = grouped["Runtime End"].min()
+    priors["Runtime Max"] = grouped["Runtime End"].max()
+    return priors
+
+'''
+desc: predicted end of every run from its fits
+input: fits - output of fit_runs() (or of DecayFit.solve() per signal)
+       priors - one row of unit_priors() per run (NaN for runs of units that aren't in the archive)
+       now - current time of every run [min], the end can't be before it
+output: dataframe of Predicted End [min], Source ("fit" or "prior"), and the time each signal reaches its level
+'''
+def predict_end(fits, priors, now):
+    priors = priors.reset_index(drop=True)
+    times = {f"{signal} End": level_time(fit, priors[f"End {signal}"].to_numpy()) for signal, fit in fits.items()}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)  # runs where no signal reaches its level
+        fitted = np.nanmedian(np.vstack(list(times.values())), axis=0)
+    source = np.where(np.isnan(fitted), "prior", "fit")
+    end = np.where(np.isnan(fitted), priors["Runtime Median"].to_numpy(), fitted)
+    end = np.fmin(np.fmax(end, priors["Runtime Min"].to_numpy()), priors["Runtime Max"].to_numpy())
+    end = np.fmax(end, now)
+    return pd.DataFrame({"Predicted End": end, "Source": source, **times})
+
+'''
+desc: replay the predictions over the archive: every run is predicted at each horizon from its own samples up to it,
+with the priors of the other runs (leave-one-out), and compared with where it actually ended
+input: fleet - Fleet of compiled runs
+       horizons - prediction times [min]
+output: dataframe of one row per run still going at each horizon: Name, Unit, Horizon, Runtime End, Predicted End,
+        Error, Source, Prior End (median runtime of the unit's other runs) and Prior Error [min]
+'''
+def evaluate(fleet, horizons=HORIZONS_MIN):
+    t, signals = fleet_signals(fleet)
+    archive = archive_table(fleet, t, signals)
+    priors = []
+    for i, unit in enumerate(archive["Unit"]):
+        others = unit_priors(archive.drop(index=i))
+        priors.append(others.loc[unit] if unit in others.index else pd.Series(np.nan, index=others.columns))
+    priors = pd.DataFrame(priors)
+
+    frames = []
+    for horizon in horizons:
+        running = (archive["Runtime End"] > horizon).to_numpy()
+        predicted = predict_end(fit_runs(t, signals, horizon), priors, horizon)
+        frame = pd.DataFrame({"Name": archive["Name"], "Unit": archive["Unit"], "Horizon [min]": horizon,
+                              "Runtime End": archive["Runtime End"], "Predicted End": predicted["Predicted End"],
+                              "Source": predicted["Source"], "Prior End": priors["Runtime Median"].to_numpy()})
+        frame["Error [min]"] = frame["Predicted End"] - frame["Runtime End"]
+        frame["Prior Error [min]"] = frame["Prior End"] - frame["Runtime End"]
+        frames.append(frame[running])
+    return pd.concat(frames, ignore_index=True)
+
+'''
+desc: mean/median absolute error of evaluate() per horizon
+input: results - output of evaluate()
+output: dataframe indexed by horizon
+'''
+def summarize(results):
+    errors = results.assign(abs_error=results["Error [min]"].abs(), abs_prior=results["Prior Error [min]"].abs())
+    return errors.groupby("Horizon [min]").agg(Runs=("Name", "size"), MAE=("abs_error", "mean"),
+                                               Median_AE=("abs_error", "median"), Prior_MAE=("abs_prior", "mean"),
+                                               From_Fit=("Source", lambda s: int((s == "fit").sum())))
+
+'''
+desc: live prediction for one rig, fed the samples as they arrive (e.g. from the telemetry gateway)
+input: priors - the rig's unit row of unit_priors() (None for no levels/bounds: then nothing is predicted)
+       taus, t0 - see DecayFit
+'''
+class RuntimePredictor:
+
+    def __init__(self, priors=None, taus=TAU_GRID_MIN, t0=FIT_START_MIN):
+        self.priors = priors
+        self.fits = {signal: DecayFit(1, taus, t0) for signal in FIT_SIGNALS}
+        self.now = 0.0
+
+    '''
+    desc: add samples
+    input: t_min - elapsed time since the start of the cycle [min] (scalar or array)
+           values - dict of signal (see FIT_SIGNALS) -> samples at t_min (deltas for SHT40/RH)
+    '''
+    def update(self, t_min, values):
+        for signal, y in values.items():
+            self.fits[signal].update(t_min, y)
+        self.now = max(self.now, float(np.nanmax(np.atleast_1d(t_min))))
+
+    '''
+    desc: current prediction
+    output: dict of the predicted end [min], the remaining time [min] and the source
+    '''
+    def predict(self):
+        if self.priors is None:
+            return {"Predicted End": None, "Remaining": None, "Source": None}
+        fits = {signal: fit.solve() for signal, fit in self.fits.items()}
+        row = predict_end(fits, pd.DataFrame([self.priors]), self.now).iloc[0]
+        return {"Predicted End": float(row["Predicted End"]), "Remaining": float(row["Predicted End"]) - self.now,
+                "Source": row["Source"]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="backtest the early runtime prediction over the compiled runs")
+    parser.add_argument("--horizons", type=float, nargs="+", default=HORIZONS_MIN, help="prediction times [min]")
+    parser.add_argument("--units", type=int, nargs="*", default=None)
+    parser.add_argument("--days", type=int, nargs="*", default=None)
+    parser.add_argument("--out", default=None, help="write the per run predictions to this csv")
+    args = parser.parse_args()
+
+    fleet = Fleet().select(units=args.units, days=args.days)
+    results = evaluate(fleet, args.horizons)
+    if args.out is not None:
+        results.to_csv(args.out, index=False)
+    print(results.round(1).to_string(index=False))
+    print(summarize(results).round(1).to_string())
@@ -0,0 +1,218 @@
+import argparse
+import os
+import time
+from contextlib import nullcontext
+import numpy as np
+import pandas as pd
+import dgo_store
+import instrumentation
+from dgo_io import iter_raw_csv, RUN_NAME_PATTERN, RIG_TIMEZONE
+from exit_detector import DgoExitDetector
+from extrapolate_dgo import slice_dgo, SEGMENT_PARAMS
+"""
+Multi-cycle segmentation of long raw rig logs.
+
+extrapolate_dgo() expects a raw file trimmed by hand to a single cycle. Here a log of any length (e.g. a rig logging
+continuously for days) is streamed in fixed size chunks through the same start/end detector used live (exit_detector),
+and every dgo cycle found is written out as its own run:
+
+    {save_root}/{prefix}-{unit}_D{day}_C{cycle}.csv     e.g. O2-DVT-DGO-2_D3_C1.csv
+
+Only the rows of the cycle being cut out (plus the last few rows while waiting for a start) are kept in memory, so a
+cycle that spans any number of chunks comes out the same as if the whole log had been loaded. The day counts the
+calendar days (rig local time) that had cycles, starting from the day in the log's name, so a continuous log numbers its
+days the same way the hand-trimmed files do. The cycle counts the cycles within that day.
+"""
+
+CYCLE_DATA_DIR = "./125C_DATA/O2_DGO_CYCLES"
+CHUNK_ROWS = 50_000
+CYCLE_COLUMNS = ["Name", "Unit", "Day", "Cycle", "Start", "End", "Rows", "Duration [min]"]
+
+'''
+desc: incremental cycle cutter: fed consecutive chunks of a raw log, hands back every dgo cycle as soon as its end is
+detected. only the rows of the open cycle (or the last 3 rows while waiting for a start) are kept
+input: start_threshold, end_slope - segmentation parameters, see find_dgo_bounds()
+       end_confirm, end_drop - how long/far the intake SHT40 has to fall before a cycle is ended, see DgoExitDetector
+'''
+class CycleSegmenter:
+
+    def __init__(self, start_threshold=SEGMENT_PARAMS["start_threshold"], end_slope=SEGMENT_PARAMS["end_slope"],
+                 end_confirm=5, end_drop=1.0):
+        self.detector = DgoExitDetector(start_threshold=start_threshold, end_slope=end_slope, end_confirm=end_confirm,
+                                        end_drop=end_drop)
+        self.pieces = []  # chunks (or the tails of chunks) that can still be part of a cycle
+        self.cycle_start = None
+
+    '''
+    desc: feed the next chunk of the log
+    input: chunk - dataframe of raw rows, indexed by their position in the log (as iter_raw_csv() gives them)
+    output: list of (start_index, end_index, raw_cycle) of the cycles that ended in this chunk
+    '''
+    def feed(self, chunk):
+        if len(chunk) == 0:
+            return []
+        self.pieces.append(chunk)
+        cycles = []
+        with instrumentation.span("segment.detect", rows=len(chunk)):
+            events = self.detector.update_batch(chunk)
+        for event in events:
+            if event.kind == "start":
+                self.cycle_start = event.index
+            elif event.kind == "end":
+                cycles.append((self.cycle_start, event.index, self._rows(self.cycle_start, event.index)))
+                self.cycle_start = None
+
+        # keep the open cycle, or the last 3 rows since a start is only seen 3 samples late
+        # (only the head of the buffer is ever cut, so this stays cheap however many chunks a cycle spans)
+        keep_from = self.cycle_start if self.cycle_start is not None else self.pieces[-1].index[-1] - 2
+        while self.pieces[0].index[-1] < keep_from:
+            self.pieces.pop(0)
+        if self.pieces[0].index[0] < keep_from:
+            self.pieces[0] = self.pieces[0].loc[keep_from:]
+        return cycles
+
+    '''
+    desc: the log ended. a cycle that is still open ends at its last flat sample
+    output: list with the (start_index, end_index, raw_cycle) of the open cycle (empty if none)
+    '''
+    def finish(self):
+        cycles = [(self.cycle_start, event.index, self._rows(self.cycle_start, event.index))
+                  for event in self.detector.finish()]
+        self.cycle_start = None
+        return cycles
+
+    '''
+    desc: rows start..end (inclusive, positional index of the log) out of the buffered chunks
+    '''
+    def _rows(self, start, end):
+        return pd.concat([p.loc[start:end] for p in self.pieces if (p.index[-1] >= start) and (p.index[0] <= end)])
+
+'''
+desc: names the cycles of a log as they come: the day goes up with every new calendar day (rig local time) that has a
+cycle, the cycle counts the cycles within the day
+input: prefix, unit, first_day - see log_name()
+       tz - time zone of the rig
+'''
+class CycleNamer:
+
+    def __init__(self, prefix, unit, first_day, tz=RIG_TIMEZONE):
+        self.prefix = prefix
+        self.unit = unit
+        self.day = first_day
+        self.tz = tz
+        self.cycle = 0
+        self._last_date = None
+
+    '''
+    desc: name of the next cycle
+    input: start_time - epoch ms of the first sample of the cycle
+    output: dataname, day, cycle
+    '''
+    def next(self, start_time):
+        date = pd.Timestamp(start_time, unit="ms", tz="UTC").tz_convert(self.tz).date()
+        if (self._last_date is not None) and (date != self._last_date):
+            self.day += 1
+            self.cycle = 0
+        self._last_date = date
+        self.cycle += 1
+        return f"{self.prefix}-{self.unit}_D{self.day}_C{self.cycle}", self.day, self.cycle
+
+'''
+desc: stream a raw log and cut out every dgo cycle in it
+input: filepath - raw data csv (any length)
+       chunksize - rows read at a time
+       params - segmentation parameters, see CycleSegmenter
+output: generator of (start_index, end_index, raw_cycle) with the positional indices of the cycle in the log and the raw rows
+        of the cycle (inclusive, indexed by their position in the log)
+'''
+def iter_cycles(filepath, chunksize=CHUNK_ROWS, **params):
+    segmenter = CycleSegmenter(**params)
+    for chunk in iter_raw_csv(filepath, chunksize, sensor_dtype=np.float64):  # the cycles are written out, keep float64
+        yield from segmenter.feed(chunk)
+    yield from segmenter.finish()
+
+'''
+desc: save a cut out cycle as a run, same format as compile_dgos()
+input: raw_cycle - raw rows of the cycle
+       save_root - folder the cycle csv's are written to
+       dataname - name of the run
+       store_root - folder of the columnar store (None to only write the csv)
+       store_format - "arrow" or "parquet"
+output: summary dict of the run (see CYCLE_COLUMNS, without the unit/day/cycle)
+'''
+def write_cycle(raw_cycle, save_root, dataname, store_root=None, store_format="arrow"):
+    dgo_data = slice_dgo(raw_cycle.reset_index(drop=True), 0, len(raw_cycle) - 1)
+    os.makedirs(save_root, exist_ok=True)
+    with instrumentation.span("write.csv", rows=len(dgo_data)):
+        dgo_data.to_csv(os.path.join(save_root, dataname + ".csv"))
+    if store_root is not None:
+        with instrumentation.span("write.store", rows=len(dgo_data)):
+            dgo_store.write_run(dgo_data, store_root, dataname, store_format)
+    start, end = pd.to_datetime(raw_cycle["time"].iloc[[0, -1]], unit="ms", utc=True)
+    return {"Name": dataname, "Start": start, "End": end, "Rows": len(dgo_data),
+            "Duration [min]": dgo_data["time"].iloc[-1] / 60}
+
+'''
+desc: prefix, unit and day of a raw log from its name (O2-DVT-DGO-1_D3_RAW.csv -> "O2-DVT-DGO", 1, 3)
+input: filepath - raw data csv
+       unit, first_day - used when the name doesn't follow the naming convention (or to override it)
+output: prefix, unit, day
+'''
+def log_name(filepath, unit=None, first_day=None):
+    match = RUN_NAME_PATTERN.match(os.path.basename(filepath))
+    prefix = match["prefix"] if match else "O2-DVT-DGO"
+    if unit is None:
+        unit = int(match["unit"]) if match else 0
+    if first_day is None:
+        first_day = int(match["day"]) if match else 1
+    return prefix, unit, first_day
+
+'''
+desc: segment a raw log into its dgo cycles and save each one as a run, same format as compile_dgos()
+input: filepath - raw data csv (any length)
+       save_root - folder the cycle csv's are written to
+       chunksize - rows read at a time
+       unit, first_day - unit and day of the log (default: from its name)
+       tz - time zone of the rig, used to tell the days apart
+       store_root - folder of the columnar store (None to only write csv's)
+       store_format - "arrow" or "parquet"
+       params - segmentation parameters passed to iter_cycles()
+output: summary - dataframe with the name, unit, day, cycle, start/end time, rows, and duration of every cycle
+'''
+def segment_log(filepath, save_root=CYCLE_DATA_DIR, chunksize=CHUNK_ROWS, unit=None, first_day=None, tz=RIG_TIMEZONE,
+                store_root=None, store_format="arrow", **params):
+    namer = CycleNamer(*log_name(filepath, unit, first_day), tz)
+    rows = []
+    for _, _, raw_cycle in iter_cycles(filepath, chunksize, **params):
+        dataname, day, cycle = namer.next(raw_cycle["time"].iloc[0])
+        row = write_cycle(raw_cycle, save_root, dataname, store_root, store_format)
+        row.update({"Unit": namer.unit, "Day": day, "Cycle": cycle,
+                    "Start": row["Start"].tz_convert(tz), "End": row["End"].tz_convert(tz)})
+        rows.append(row)
+    return pd.DataFrame(rows, columns=CYCLE_COLUMNS)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="split long raw rig logs into one run per dgo cycle")
+    parser.add_argument("logs", nargs="+", help="raw data csv's")
+    parser.add_argument("--save-root", default=CYCLE_DATA_DIR, help="folder the cycle csv's are written to")
+    parser.add_argument("--chunksize", type=int, default=CHUNK_ROWS, help="rows read at a time")
+    parser.add_argument("--unit", type=int, default=None, help="unit of the log (default: from its name)")
+    parser.add_argument("--first-day", type=int, default=None, help="day of the first cycle (default: from its name)")
+    parser.add_argument("--tz", default=RIG_TIMEZONE, help="time zone of the rig")
+    parser.add_argument("--start-threshold", type=float, default=SEGMENT_PARAMS["start_threshold"])
+    parser.add_argument("--end-slope", type=float, default=SEGMENT_PARAMS["end_slope"])
+    parser.add_argument("--store-root", default=None, help="also write each cycle to a columnar store in this folder")
+    parser.add_argument("--store-format", default="arrow", choices=sorted(dgo_store.STORE_FORMATS))
+    parser.add_argument("--metrics", default=None, help="append the timing spans to this .jsonl file")
+    parser.add_argument("--profile", default=None, help="dump a cProfile of the run to this file")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    with instrumentation.profile(args.profile) if args.profile else nullcontext():
+        summary = pd.concat([segment_log(log, args.save_root, args.chunksize, args.unit, args.first_day, args.tz,
+                                         args.store_root, args.store_format, start_threshold=args.start_threshold,
+                                         end_slope=args.end_slope) for log in args.logs], ignore_index=True)
+    print(summary.to_string(index=False))
+    print(f"{len(summary)} cycles from {len(args.logs)} logs in {time.perf_counter() - t0:.2f} s")
+    if args.metrics is not None:
+        instrumentation.export_jsonl(args.metrics, "segment_cycles " + " ".join(args.logs))
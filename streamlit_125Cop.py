@@ -3,168 +3,110 @@ import plotly.figure_factory as ff
 import numpy as np
 import pandas as pd 
 import plotly.graph_objects as go
+from dgo_cache import cache_stats_frame
+from dashboard_widgets import run_selector, smoothing_selector, start_profiler, metrics_panel
+from instrumentation import span
+from run_catalog import RUN_DATES
+from threshold_index import crossing_stats
+from plot_downsample import decimated_trace, DOWNSAMPLE_METHODS
+from fleet_aggregate import fleet_envelopes
+from run_features import feature_table, threshold_energy
+from filters import parse_filter
+from plotly.colors import qualitative, hex_to_rgb
 
 st.set_page_config(layout="wide")
+profiler = start_profiler()
 
 ### 
 st.title("125C Operation Investigation of Exit Criteria")
 st.header("Inspect the differential between SHT40 and RH sensors to determine if this is a valid DGO exit criteria")
-st.write("D1: 3/6/24, D2: 3/7/24, D3:3/8, D4: 3/11, D5: 3/14, D6: 3/15, D7: 3/18")
+st.write(", ".join(f"D{day}: {pd.Timestamp(date).month}/{pd.Timestamp(date).day}/{pd.Timestamp(date):%y}"
+                   for day, date in RUN_DATES.items()))
 ###
 
 
 sht_threshold = st.number_input('SHT40 Delta Threshold')
 rh_threshold = st.number_input('RH Delta Threshold')
 
+# traces are decimated to the screen resolution, narrowing the window re-fetches it at full resolution
+time_window = st.sidebar.slider("Time Window [min]", 0.0, 500.0, (0.0, 500.0), step=1.0)
+x_range = None if time_window == (0.0, 500.0) else time_window
+downsample_method = st.sidebar.selectbox("Downsampling", DOWNSAMPLE_METHODS)
+# one trace per run, or the median and 10-90th percentile band of each unit on a common time grid
+trace_view = st.sidebar.radio("Traces", ["Runs", "Unit Envelopes"])
+smoothing = smoothing_selector()  # causal filter of the deltas, the crossings are found on the smoothed deltas
+
 fig_sht = go.Figure()
 fig_rh = go.Figure() 
 
-met_sht = [[],[]] # times, vals
-met_rh = [[],[]] # times, vals
-
-rh_stats = pd.DataFrame({"Name":[],
-                            "Runtime End":[],
-                            "Time @ RH Threshold":[],
-                            "Diff. in Time (RH)":[],
-                        })
-sht_stats = pd.DataFrame({"Name":[],
-                            "Runtime End":[],
-                            "Time @ SHT40 Threshold":[],
-                            "Diff. in Time (SHT40)":[],
-                        })
-
-# read in the csv's of the data --> already extrapolated to runtime
-for unit in range(1,3): # units 1 and 2 for now
-    for day in range(1,8):
-        dataname = f"O2-DVT-DGO-{unit}_D{day}"
-        dgo_data = pd.read_csv(f"./125C_DATA/O2_DGO_DATA/{dataname}.csv")
-        t_min = dgo_data["time"] / 60
-        t_end = t_min[t_min.last_valid_index()]
-        delta_SHT = dgo_data["Exhaust SHT40"] - dgo_data["Intake SHT40"]
-        delta_RH = dgo_data["Exhaust RH"] - dgo_data["Intake Air RH"] 
-
-        t_sht_threshold = None
-        val_sht_threshold = None
-        dt_sht = None 
-
-        t_rh_threshold = None
-        val_rh_threshold = None
-        dt_rh = None 
-
-        # determine the threshold met
-        if sht_threshold is not None:
-            sht_filt = delta_SHT.where(abs(delta_SHT - sht_threshold) < 0.025) # may need to increase 0.025 if it's too fine
-            sht_threshold_index = sht_filt.first_valid_index() 
-
-            if (sht_threshold_index is not None):
-                t_sht_threshold = t_min[sht_threshold_index]
-                val_sht_threshold = delta_SHT[sht_threshold_index]
-                dt_sht = t_end - t_sht_threshold 
-                met_sht[0].append(t_sht_threshold)
-                met_sht[1].append(val_sht_threshold)
-        
-        if rh_threshold is not None:
-            rh_filt = delta_RH.where(abs(delta_RH - rh_threshold) < 0.025) # may need to increase 0.025 if it's too fine
-            rh_threshold_index = rh_filt.first_valid_index()
-
-            if (rh_threshold_index is not None):
-                t_rh_threshold = t_min[rh_threshold_index]
-                val_rh_threshold = delta_RH[rh_threshold_index]
-                dt_rh = t_end - t_rh_threshold
-                met_rh[0].append(t_rh_threshold)
-                met_rh[1].append(val_rh_threshold)
-
-        sht_stats.loc[len(sht_stats.index)] = [dataname, # name
-                                               t_end, # runtime end [minutes] 
-                                               t_sht_threshold, # time @ sht threshold
-                                               dt_sht # diff in time (sht)
-                                            ]
-        rh_stats.loc[len(rh_stats.index)] = [dataname,  # name
-                                               t_end, # runtime end [minutes]
-                                               t_rh_threshold, # time @ rh threshold
-                                               dt_rh # diff in time (rh)
-                                            ]
-
-        # add data to plots 
-        fig_sht.add_trace(go.Scatter(x=t_min, y=delta_SHT, name=dataname))
-        fig_rh.add_trace(go.Scatter(x=t_min, y=delta_RH, name=dataname))
-
-        
-# read in the csv's of the data --> already extrapolated to runtime
-for unit in range(3,4): # include unit 3
-    for day in range(2,5):
-        dataname = f"O2-DVT-DGO-{unit}_D{day}"
-        dgo_data = pd.read_csv(f"./125C_DATA/O2_DGO_DATA/{dataname}.csv")
-        t_min = dgo_data["time"] / 60
-        t_end = t_min[t_min.last_valid_index()]
-        delta_SHT = dgo_data["Exhaust SHT40"] - dgo_data["Intake SHT40"]
-        delta_RH = dgo_data["Exhaust RH"] - dgo_data["Intake Air RH"] 
-
-        t_sht_threshold = None
-        val_sht_threshold = None
-        dt_sht = None 
-
-        t_rh_threshold = None
-        val_rh_threshold = None
-        dt_rh = None 
-
-        # determine the threshold met
-        if sht_threshold is not None:
-            sht_filt = delta_SHT.where(abs(delta_SHT - sht_threshold) < 0.025) # may need to increase 0.025 if it's too fine
-            sht_threshold_index = sht_filt.first_valid_index() 
-
-            if (sht_threshold_index is not None):
-                t_sht_threshold = t_min[sht_threshold_index]
-                val_sht_threshold = delta_SHT[sht_threshold_index]
-                dt_sht = t_end - t_sht_threshold 
-                met_sht[0].append(t_sht_threshold)
-                met_sht[1].append(val_sht_threshold)
-        
-        if rh_threshold is not None:
-            rh_filt = delta_RH.where(abs(delta_RH - rh_threshold) < 0.025) # may need to increase 0.025 if it's too fine
-            rh_threshold_index = rh_filt.first_valid_index()
-
-            if (rh_threshold_index is not None):
-                t_rh_threshold = t_min[rh_threshold_index]
-                val_rh_threshold = delta_RH[rh_threshold_index]
-                dt_rh = t_end - t_rh_threshold
-                met_rh[0].append(t_rh_threshold)
-                met_rh[1].append(val_rh_threshold)
-
-        sht_stats.loc[len(sht_stats.index)] = [dataname, # name
-                                               t_end, # runtime end [minutes] 
-                                               t_sht_threshold, # time @ sht threshold
-                                               dt_sht # diff in time (sht)
-                                            ]
-        rh_stats.loc[len(rh_stats.index)] = [dataname,  # name
-                                               t_end, # runtime end [minutes]
-                                               t_rh_threshold, # time @ rh threshold
-                                               dt_rh # diff in time (rh)
-                                            ]
-
-        # add data to plots 
-        fig_sht.add_trace(go.Scatter(x=t_min, y=delta_SHT, name=dataname))
-        fig_rh.add_trace(go.Scatter(x=t_min, y=delta_RH, name=dataname))        
+# runs picked from the run catalog, only those are loaded (lazily, through the dataset cache)
+fleet, selected = run_selector()
+st.dataframe(selected[[c for c in ["Name", "Unit", "Day", "Date", "Runtime [min]", "Rows"] if c in selected]])
+deltas = fleet.deltas()  # time [min] and deltas of all the runs back to back, one subtraction per signal
+smoother = parse_filter(smoothing)
+if smoother is not None:
+    with span("detect.smooth", rows=len(deltas["time"].values)):  # every run at once
+        deltas.update(SHT40=smoother.batch(deltas["SHT40"]), RH=smoother.batch(deltas["RH"]))
+indexes = {name: fleet.crossing_index(name, smoothing) for name in fleet.names}
+
+# first crossing of the thresholds (interpolated, NaN if never crossed), how much earlier than the end it is and the
+# energy stopping there would have saved
+sht_stats = threshold_energy(fleet, crossing_stats(indexes, "SHT40", sht_threshold), "SHT40")
+rh_stats = threshold_energy(fleet, crossing_stats(indexes, "RH", rh_threshold), "RH")
+
+met_sht = sht_stats["Time @ SHT40 Threshold"].dropna().tolist()
+met_rh = rh_stats["Time @ RH Threshold"].dropna().tolist()
+
+# add data to plots
+with span("render.traces", rows=len(deltas["time"].values)):
+    if trace_view == "Runs":
+        for i, dataname in enumerate(fleet.names):
+            t_min = deltas["time"][i]
+            fig_sht.add_trace(decimated_trace(t_min, deltas["SHT40"][i], dataname, x_range=x_range,
+                                              method=downsample_method))
+            fig_rh.add_trace(decimated_trace(t_min, deltas["RH"][i], dataname, x_range=x_range,
+                                             method=downsample_method))
+    else:
+        for fig, signal in [(fig_sht, "SHT40"), (fig_rh, "RH")]:
+            envelopes = fleet_envelopes(fleet, signal, by="Unit")
+            for i, (group, env) in enumerate(envelopes.groupby("Group", sort=False)):
+                color = qualitative.Plotly[i % len(qualitative.Plotly)]
+                t_min = env["Time [min]"].to_numpy()
+                trace_kwargs = dict(x_range=x_range, method=downsample_method, legendgroup=group)
+                band = dict(width=0, color=color)
+                fig.add_trace(decimated_trace(t_min, env["p10"].to_numpy(), f"{group} p10", line=band,
+                                              showlegend=False, **trace_kwargs))
+                fig.add_trace(decimated_trace(t_min, env["p90"].to_numpy(), f"{group} p10-p90", line=band,
+                                              fill="tonexty", fillcolor=f"rgba{(*hex_to_rgb(color), 0.25)}",
+                                              **trace_kwargs))
+                fig.add_trace(decimated_trace(t_min, env["p50"].to_numpy(), f"{group} median", line=dict(color=color),
+                                              **trace_kwargs))
 
 # display plots
 fig_sht.add_trace(go.Scatter(x=[0, 500], y=[sht_threshold, sht_threshold], name=' ', line=dict(dash='dash', color='#d3d3d3')))
-fig_sht.add_trace(go.Scatter(x=met_sht[0], y=met_sht[1], name="SHT40 Delta Crossings", mode='markers', line=dict(color='black')))
+fig_sht.add_trace(go.Scatter(x=met_sht, y=[sht_threshold] * len(met_sht), name="SHT40 Delta Crossings", mode='markers', line=dict(color='black')))
 fig_sht.update_layout(title="SHT40 Differential", xaxis_title="Time [min]", yaxis_title="Exhaust - Intake [degC]",
                       height=500, width=800)
 
 fig_rh.add_trace(go.Scatter(x=[0, 500], y=[rh_threshold, rh_threshold], name=' ', line=dict(dash='dash', color='#d3d3d3')))
-fig_rh.add_trace(go.Scatter(x=met_rh[0], y=met_rh[1], name="RH Delta Crossings", mode='markers', line=dict(color='black')))
+fig_rh.add_trace(go.Scatter(x=met_rh, y=[rh_threshold] * len(met_rh), name="RH Delta Crossings", mode='markers', line=dict(color='black')))
 fig_rh.update_layout(title="RH Differential", xaxis_title="Time [min]", yaxis_title="Exhaust - Intake",
                      height=500, width=800)
 
+st.sidebar.dataframe(cache_stats_frame())
+
+if x_range is not None:
+    fig_sht.update_xaxes(range=x_range)
+    fig_rh.update_xaxes(range=x_range)
+
 cols = st.columns([5,2])
-with cols[0]:
+with cols[0], span("render.plotly_chart"):
     st.plotly_chart(fig_sht)
 with cols[1]:
     st.dataframe(sht_stats)
 
 cols2 = st.columns([3,1])
-with cols2[0]:
+with cols2[0], span("render.plotly_chart"):
     st.plotly_chart(fig_rh)
 with cols2[1]:
     st.dataframe(rh_stats)
@@ -175,4 +117,7 @@ with cols2[1]:
 # with stats[1]:
 #     st.dataframe(rh_stats)
 
+with st.expander("Run Features"), span("render.features"):
+    st.dataframe(feature_table(fleet))  # energy, water removed, drying rates (cached per run)
 
+metrics_panel(profiler)
@@ -0,0 +1,507 @@
+import argparse
+import asyncio
+import csv
+import io
+import os
+import tempfile
+import time
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from dgo_io import iter_raw_csv, SENTINELS
+from extrapolate_dgo import RAW_DATA_DIR, find_raw_files
+from segment_cycles import CycleSegmenter, CycleNamer, log_name, write_cycle, CHUNK_ROWS, RIG_TIMEZONE
+"""
+Local ingest gateway for live rig telemetry, and a simulator that replays the raw csv's as if they were live rigs.
+
+Protocol (TCP, one text line per message, any number of rigs at once):
+
+    RIG O2-DVT-DGO-2_D1              name of the rig/log, same naming as the raw files (unit/day are taken from it)
+    "time","Ohaus Tare Weight",...   the header line of the raw csv
+    1709772565000,1.534,...          rows, exactly as in the raw csv
+    END                              the log is over (closes the open cycle). a rig that just disconnects keeps its
+                                     state, so it can reconnect and carry on with the same cycle
+
+Every rig gets a bounded queue of rows. When the gateway falls behind the queue fills up, the connection stops being
+read, and TCP pushes back on the rig, so memory stays bounded however many rigs connect. A consumer per rig takes the
+rows off the queue in batches (batch_rows, or whatever arrived within flush_seconds), appends them to the rig's raw log
+and runs the cycle segmentation of segment_cycles on them. Every cycle is written as a compiled run (csv, and the
+columnar store if one is given) as soon as its end is detected. A session that finds the rig's raw log already there (a
+gateway restart) first runs the segmentation over it, so the cycle names and an open cycle carry on where they left off,
+and a cycle is never written over one that exists.
+
+Rows that aren't numbers (or have more fields than the header) are dropped and counted in the stats, they don't go in
+the raw log. If the consumer of a rig fails anyway, the rig gets an ERROR reply and is disconnected.
+"""
+
+GATEWAY_HOST = "127.0.0.1"
+GATEWAY_PORT = 8765
+LIVE_DATA_DIR = "./125C_DATA/O2_DGO_LIVE"  # {live_root}/raw/{rig}_RAW.csv and {live_root}/cycles/{run}.csv
+QUEUE_ROWS = 10_000  # rows buffered per rig before the rig is pushed back on
+BATCH_ROWS = 500  # rows processed at a time
+FLUSH_SECONDS = 1.0  # max time rows wait for a batch to fill up
+STATS_COLUMNS = ["Rig", "Rows", "Bad Rows", "Batches", "Cycles", "Max Queue", "Mean Latency [ms]",
+                 "Max Latency [ms]", "Connected"]
+
+'''
+desc: state of one rig: its raw log, the cycle segmentation, and the ingest stats. only ever touched by the rig's
+consumer, so the batches can be processed in a worker thread
+input: rig - name of the rig/log, e.g. O2-DVT-DGO-2_D1
+       columns - columns of the rows, from the header line
+       live_root - folder of the raw logs and cycles
+       store_root, store_format - columnar store the cycles are also written to (None for csv only)
+       tz - time zone of the rig
+       params - segmentation parameters, see CycleSegmenter
+'''
+class RigSession:
+
+    def __init__(self, rig, columns, live_root=LIVE_DATA_DIR, store_root=None, store_format="arrow", tz=RIG_TIMEZONE,
+                 **params):
+        self.rig = rig
+        self.columns = columns
+        self.cycle_root = os.path.join(live_root, "cycles")
+        self.store_root = store_root
+        self.store_format = store_format
+        self.params = params
+        self.tz = tz
+        self.segmenter = CycleSegmenter(**params)
+        self.namer = CycleNamer(*log_name(rig), tz)
+        self.position = 0  # positional index of the next row of the log
+
+        raw_root = os.path.join(live_root, "raw")
+        os.makedirs(raw_root, exist_ok=True)
+        self.raw_path = os.path.join(raw_root, f"{rig}_RAW.csv")
+        # a gateway restart or a reconnect appends to the rig's log. a log with other columns is kept aside as
+        # {rig}_RAW.csv.1, .2, ... instead of mixing two headers in one file
+        header = ",".join(f'"{c}"' for c in columns) + "\n"
+        if os.path.isfile(self.raw_path) and (os.path.getsize(self.raw_path) > 0):
+            with open(self.raw_path, encoding="utf-8-sig") as f:
+                old_columns = next(csv.reader([f.readline()]), [])
+            if old_columns != columns:
+                n = 1
+                while os.path.exists(f"{self.raw_path}.{n}"):
+                    n += 1
+                os.replace(self.raw_path, f"{self.raw_path}.{n}")
+        if not (os.path.isfile(self.raw_path) and (os.path.getsize(self.raw_path) > 0)):
+            with open(self.raw_path, "a", encoding="utf-8") as f:
+                f.write(header)
+        else:
+            self._restore()
+
+        self.rows = 0
+        self.bad_rows = 0  # rows dropped because they couldn't be parsed
+        self.batches = 0
+        self.cycles = []
+        self.max_queue = 0
+        self.latencies = []  # [s] from the first row of a batch arriving to the batch being processed
+        self.connected = True
+
+    '''
+    desc: pick up where the rig's log left off (e.g. before a gateway restart): run the segmentation over the rows
+    already logged, so the cycle names carry on from the cycles written from them and a cycle that was still open
+    is carried on too. nothing is written
+    '''
+    def _restore(self):
+        try:
+            for chunk in iter_raw_csv(self.raw_path, CHUNK_ROWS, sensor_dtype=np.float64):
+                for _, _, raw_cycle in self.segmenter.feed(chunk):
+                    self.namer.next(raw_cycle["time"].iloc[0])
+                self.position += len(chunk)
+        except ValueError:  # a log that doesn't parse (written by hand?): _write() still won't overwrite a cycle
+            self.segmenter = CycleSegmenter(**self.params)
+            self.namer = CycleNamer(*log_name(self.rig), self.tz)
+            self.position = 0
+
+    '''
+    desc: process a batch of rows: parse them, append them to the raw log, and cut out the cycles that ended. rows that
+    can't be parsed are dropped (and counted in bad_rows)
+    input: lines - list of csv lines (str, without the newline)
+    output: names of the cycles written
+    '''
+    def process(self, lines):
+        self.rows += len(lines)
+        self.batches += 1
+        try:
+            chunk = self._parse(lines)
+        except ValueError:  # only look at the rows one by one when the batch doesn't parse as a whole
+            kept = [line for line in lines if _valid_row(line, len(self.columns))]
+            try:
+                chunk = self._parse(kept) if kept else None
+            except ValueError:
+                kept, chunk = [], None
+            self.bad_rows += len(lines) - len(kept)
+            lines = kept
+        if chunk is None:
+            return []
+        with open(self.raw_path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        chunk = chunk[chunk["time"].notna()]
+        chunk.index = pd.RangeIndex(self.position, self.position + len(chunk))
+        chunk["time"] = chunk["time"].astype(np.int64)
+        self.position += len(chunk)
+        return self._write(self.segmenter.feed(chunk))
+
+    '''
+    desc: parse csv lines of the rig
+    input: lines - list of csv lines
+    output: dataframe of the rows (float64)
+    '''
+    def _parse(self, lines):
+        return pd.read_csv(io.StringIO("\n".join(lines) + "\n"), header=None, names=self.columns, index_col=False,
+                           na_values=SENTINELS, keep_default_na=False,
+                           dtype=defaultdict(lambda: np.float64, time=np.float64))
+
+    '''
+    desc: the log is over, write the cycle that is still open
+    output: names of the cycles written
+    '''
+    def finish(self):
+        return self._write(self.segmenter.finish())
+
+    '''
+    desc: write cut out cycles as runs. a cycle never replaces one that is already written, it takes the next free name
+    '''
+    def _write(self, cycles):
+        names = []
+        for _, _, raw_cycle in cycles:
+            dataname, _, _ = self.namer.next(raw_cycle["time"].iloc[0])
+            while os.path.exists(os.path.join(self.cycle_root, dataname + ".csv")):
+                dataname, _, _ = self.namer.next(raw_cycle["time"].iloc[0])
+            write_cycle(raw_cycle, self.cycle_root, dataname, self.store_root, self.store_format)
+            names.append(dataname)
+        self.cycles += names
+        return names
+
+    '''
+    desc: ingest stats of the rig (see STATS_COLUMNS)
+    '''
+    def stats(self):
+        latency = np.array(self.latencies) * 1000
+        return {"Rig": self.rig, "Rows": self.rows, "Bad Rows": self.bad_rows, "Batches": self.batches,
+                "Cycles": len(self.cycles), "Max Queue": self.max_queue,
+                "Mean Latency [ms]": latency.mean() if len(latency) else np.nan,
+                "Max Latency [ms]": latency.max() if len(latency) else np.nan, "Connected": self.connected}
+
+'''
+desc: check that a csv line of a rig is a row of numbers (or missing values) with at most one field per column
+input: line - csv line
+       n_columns - number of columns of the header
+output: bool
+'''
+def _valid_row(line, n_columns):
+    fields = next(csv.reader([line]), [])
+    if len(fields) > n_columns:
+        return False
+    try:
+        for value in fields:
+            if value not in SENTINELS:
+                float(value)
+    except ValueError:
+        return False
+    return True
+
+'''
+desc: asyncio server taking line-delimited telemetry from many rigs
+input: host, port - address to listen on
+       live_root - folder of the raw logs and cycles
+       store_root, store_format - columnar store the cycles are also written to (None for csv only)
+       queue_rows - rows buffered per rig before the rig is pushed back on
+       batch_rows - rows processed at a time
+       flush_seconds - max time rows wait for a batch to fill up
+       verbose - print every cycle written
+       params - segmentation parameters, see CycleSegmenter
+'''
+class TelemetryGateway:
+
+    def __init__(self, host=GATEWAY_HOST, port=GATEWAY_PORT, live_root=LIVE_DATA_DIR, store_root=None,
+                 store_format="arrow", queue_rows=QUEUE_ROWS, batch_rows=BATCH_ROWS, flush_seconds=FLUSH_SECONDS,
+                 verbose=True, **params):
+        self.host = host
+        self.port = port
+        self.live_root = live_root
+        self.store_root = store_root
+        self.store_format = store_format
+        self.queue_rows = queue_rows
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self.verbose = verbose
+        self.params = params
+        self.sessions = {}  # rig -> RigSession, kept across reconnects
+        self.server = None
+
+    '''
+    desc: start listening
+    output: asyncio server
+    '''
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port, limit=2 ** 20)
+        self.port = self.server.sockets[0].getsockname()[1]  # in case port 0 was asked for
+        return self.server
+
+    '''
+    desc: stop listening and wait for the connections to finish
+    '''
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    '''
+    desc: one rig connection: hello and header lines, then the rows go onto the rig's bounded queue. if the connection
+    drops, the rows already queued are still processed and the rig is marked disconnected (its open cycle is kept for
+    when it reconnects). if the consumer fails, the rig gets an ERROR reply and is disconnected
+    '''
+    async def _handle(self, reader, writer):
+        rig, session, queue, consumer = None, None, None, None
+        try:
+            hello = (await reader.readline()).decode().strip()
+            if not hello.startswith("RIG "):
+                writer.write(b"ERROR expected 'RIG <name>'\n")
+                return
+            rig = hello[4:].strip()
+            header = (await reader.readline()).decode("utf-8-sig").strip()
+            columns = next(csv.reader([header]))
+            if "time" not in columns:
+                writer.write(b"ERROR expected the raw csv header\n")
+                return
+
+            session = self.sessions.get(rig)
+            if (session is None) or (session.columns != columns):
+                session = await asyncio.to_thread(RigSession, rig, columns, self.live_root, self.store_root,
+                                                  self.store_format, **self.params)
+                self.sessions[rig] = session
+            session.connected = True
+
+            queue = asyncio.Queue(maxsize=self.queue_rows)
+            consumer = asyncio.create_task(self._consume(session, queue))
+            ended = False
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode().rstrip("\r\n")
+                if line == "END":
+                    ended = True
+                    break
+                if line:
+                    # waits (and stops reading) while the queue is full
+                    if not await self._put(queue, (time.perf_counter(), line), consumer):
+                        break
+                    session.max_queue = max(session.max_queue, queue.qsize())
+            await self._put(queue, None, consumer)
+            await consumer  # raises what the consumer failed with
+            if ended:
+                for name in await asyncio.to_thread(session.finish):
+                    self._log(f"{rig}: wrote {name}")
+            writer.write(b"OK\n")
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            self._log(f"{rig or 'unknown rig'}: connection lost ({type(e).__name__})")
+        except Exception as e:
+            self._log(f"{rig or 'unknown rig'}: {type(e).__name__}: {e}")
+            writer.write(f"ERROR {type(e).__name__}: {e}\n".encode())
+        finally:
+            if (consumer is not None) and not consumer.done():
+                # the consumer drains the queue, so there is room for the sentinel
+                if await self._put(queue, None, consumer):
+                    await asyncio.wait([consumer])
+                if (not consumer.cancelled()) and (consumer.exception() is not None):  # failed on the last rows
+                    self._log(f"{rig}: {type(consumer.exception()).__name__}: {consumer.exception()}")
+            if session is not None:
+                session.connected = False
+            writer.close()
+
+    '''
+    desc: put an item on a rig's queue, waiting while it is full, unless the rig's consumer has stopped
+    input: queue - the rig's queue
+           item - (arrival time, line), or None to end
+           consumer - the rig's consumer task
+    output: False if the consumer has stopped (the item is dropped)
+    '''
+    async def _put(self, queue, item, consumer):
+        if queue.full() and not consumer.done():
+            put = asyncio.create_task(queue.put(item))
+            await asyncio.wait([put, consumer], return_when=asyncio.FIRST_COMPLETED)
+            if put.done():
+                return True
+            put.cancel()
+            return False
+        if consumer.done():
+            return False
+        queue.put_nowait(item)
+        return True
+
+    '''
+    desc: take the rows of a rig off its queue in batches and process them in a worker thread
+    '''
+    async def _consume(self, session, queue):
+        done = False
+        while not done:
+            item = await queue.get()
+            if item is None:
+                break
+            first_arrival = item[0]
+            batch = [item[1]]
+            deadline = first_arrival + self.flush_seconds
+            # fill up the batch with whatever is there, and wait for more until the deadline
+            while len(batch) < self.batch_rows:
+                if queue.empty():
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(queue.get(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = queue.get_nowait()
+                if item is None:
+                    done = True
+                    break
+                batch.append(item[1])
+            for name in await asyncio.to_thread(session.process, batch):
+                self._log(f"{session.rig}: wrote {name}")
+            session.latencies.append(time.perf_counter() - first_arrival)
+
+    def _log(self, message):
+        if self.verbose:
+            print(message, flush=True)
+
+    '''
+    desc: ingest stats of every rig seen so far
+    output: dataframe (see STATS_COLUMNS)
+    '''
+    def stats(self):
+        return pd.DataFrame([s.stats() for s in self.sessions.values()], columns=STATS_COLUMNS)
+
+'''
+desc: replay a raw csv to the gateway as if it was a live rig
+input: filepath - raw data csv
+       rig - name the rig announces (default: the file name without _RAW.csv)
+       host, port - address of the gateway
+       speedup - how many times faster than real time the rows are sent (0 for as fast as possible)
+output: dict of the rig, rows sent, time taken [s] and how far behind schedule it got [s] (the gateway pushing back)
+'''
+async def replay_rig(filepath, rig=None, host=GATEWAY_HOST, port=GATEWAY_PORT, speedup=60.0):
+    rig = rig or os.path.basename(filepath)[:-len("_RAW.csv")]
+    reader, writer = await asyncio.open_connection(host, port)
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    first_time = None
+    rows = 0
+    late = 0.0
+    with open(filepath, encoding="utf-8-sig") as f:
+        writer.write(f"RIG {rig}\n{f.readline().strip()}\n".encode())
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            stamp = line.split(",", 1)[0]
+            if speedup > 0 and stamp.isdigit():
+                first_time = int(stamp) if first_time is None else first_time
+                due = t0 + (int(stamp) - first_time) / 1000 / speedup
+                delay = due - loop.time()
+                if delay > 0:
+                    await writer.drain()
+                    await asyncio.sleep(delay)
+                else:
+                    late = max(late, -delay)
+            writer.write((line + "\n").encode())
+            rows += 1
+            if writer.transport.get_write_buffer_size() > 2 ** 16:
+                await writer.drain()
+    writer.write(b"END\n")
+    await writer.drain()
+    await reader.readline()  # OK once the gateway has processed everything
+    writer.close()
+    await writer.wait_closed()
+    return {"Rig": rig, "Rows": rows, "Time [s]": loop.time() - t0, "Behind Schedule [s]": late}
+
+'''
+desc: replay many rigs at once. with more rigs than files the files are reused under new rig names (SIM1-..., SIM2-...)
+input: filepaths - raw data csv's
+       rigs - number of rigs (default: one per file)
+       host, port - address of the gateway
+       speedup - see replay_rig()
+output: dataframe of the replay_rig() results
+'''
+async def replay_fleet(filepaths, rigs=None, host=GATEWAY_HOST, port=GATEWAY_PORT, speedup=60.0):
+    rigs = rigs or len(filepaths)
+    jobs = []
+    for i in range(rigs):
+        filepath = filepaths[i % len(filepaths)]
+        rig = os.path.basename(filepath)[:-len("_RAW.csv")]
+        if i >= len(filepaths):
+            rig = f"SIM{i // len(filepaths)}-{rig}"
+        jobs.append(replay_rig(filepath, rig, host, port, speedup))
+    return pd.DataFrame(await asyncio.gather(*jobs))
+
+'''
+desc: run a gateway and a replay of the raw data against it in the same process, to see how many rigs the host keeps up
+with. the simulator shares the cpu with the gateway, so the numbers are a lower bound
+input: rigs - number of simulated rigs
+       speedup - see replay_rig()
+       raw_root - folder of the raw csv's to replay
+       live_root - folder the gateway writes to (default: a temp folder)
+       gateway_args - passed on to TelemetryGateway
+output: replay - dataframe of the replay_rig() results
+        stats - dataframe of the gateway stats
+'''
+async def bench(rigs=None, speedup=60.0, raw_root=RAW_DATA_DIR, live_root=None, **gateway_args):
+    with tempfile.TemporaryDirectory() as tmp:
+        gateway = TelemetryGateway(port=0, live_root=live_root or tmp, verbose=False, **gateway_args)
+        await gateway.start()
+        t0 = time.perf_counter()
+        replay = await replay_fleet(find_raw_files(raw_root), rigs, gateway.host, gateway.port, speedup)
+        elapsed = time.perf_counter() - t0
+        await gateway.close()
+        stats = gateway.stats()
+    print(stats.describe().T[["mean", "max"]].to_string())
+    print(f"{len(replay)} rigs, {stats['Rows'].sum()} rows, {stats['Cycles'].sum()} cycles in {elapsed:.2f} s "
+          f"({stats['Rows'].sum() / elapsed:.0f} rows/s), at most {replay['Behind Schedule [s]'].max():.2f} s "
+          f"behind schedule")
+    return replay, stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="live telemetry gateway and rig simulator")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve = sub.add_parser("serve", help="run the gateway")
+    serve.add_argument("--host", default=GATEWAY_HOST)
+    serve.add_argument("--port", type=int, default=GATEWAY_PORT)
+    serve.add_argument("--live-root", default=LIVE_DATA_DIR, help="folder the raw logs and cycles are written to")
+    serve.add_argument("--store-root", default=None, help="also write each cycle to a columnar store in this folder")
+    serve.add_argument("--queue-rows", type=int, default=QUEUE_ROWS, help="rows buffered per rig")
+    serve.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="rows processed at a time")
+
+    replay = sub.add_parser("replay", help="replay the raw csv's to a running gateway")
+    bench_parser = sub.add_parser("bench", help="run a gateway and a replay against it in this process")
+    for p in [replay, bench_parser]:
+        p.add_argument("--raw-root", default=RAW_DATA_DIR, help="folder of the raw csv's to replay")
+        p.add_argument("--rigs", type=int, default=None, help="number of rigs (default: one per raw csv)")
+        p.add_argument("--speedup", type=float, default=60.0, help="times faster than real time (0 = no pacing)")
+    replay.add_argument("--host", default=GATEWAY_HOST)
+    replay.add_argument("--port", type=int, default=GATEWAY_PORT)
+    bench_parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS, help="rows processed at a time")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        async def main():
+            gateway = TelemetryGateway(args.host, args.port, args.live_root, args.store_root,
+                                       queue_rows=args.queue_rows, batch_rows=args.batch_rows)
+            server = await gateway.start()
+            print(f"listening on {gateway.host}:{gateway.port}", flush=True)
+            try:
+                async with server:
+                    await server.serve_forever()
+            finally:
+                print(gateway.stats().to_string(index=False))
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "replay":
+        print(asyncio.run(replay_fleet(find_raw_files(args.raw_root), args.rigs, args.host, args.port,
+                                       args.speedup)).to_string(index=False))
+    else:
+        asyncio.run(bench(args.rigs, args.speedup, args.raw_root, batch_rows=args.batch_rows))
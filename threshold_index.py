@@ -0,0 +1,173 @@
+import numpy as np
+import pandas as pd
+from instrumentation import span
+from filters import parse_filter
+"""
+Precomputed crossing index for the exit criteria thresholds.
+
+A delta crosses a threshold upward between samples k-1 and k when delta[k-1] < threshold <= delta[k] (and downward the
+other way around). Every pair of samples covers a range of thresholds, so the first crossing of any threshold is a
+step function of the threshold. It is built once per run by painting the ranges in sample order (earliest crossing
+wins), after which any threshold, or a whole vector of thresholds, is a binary search instead of a rescan of the run.
+The crossing time is linearly interpolated between the two samples on either side of the threshold, instead of taking
+the first sample within a fixed tolerance band.
+
+The SHT40 delta (exhaust - intake) drops right after the start and comes back up as the grounds dry, so its exit
+crossings are upward. The RH delta jumps up after the start and trends back down, so its exit crossings are downward.
+The index can also be built on the deltas smoothed by a causal filter (see filters), so a noisy sample doesn't cross
+early, at the cost of the filter's lag.
+"""
+
+SIGNAL_DIRECTIONS = {"SHT40": "up", "RH": "down"}
+
+'''
+desc: crossing index of one delta series
+input: t - sample times (any unit, e.g. minutes), increasing
+       delta - delta series (exhaust - intake), NaN samples are skipped
+       direction - "up" or "down" crossings
+'''
+class CrossingIndex:
+
+    def __init__(self, t, delta, direction="up"):
+        t = np.asarray(t, dtype=np.float64)
+        delta = np.asarray(delta, dtype=np.float64)
+        valid = ~np.isnan(delta) & ~np.isnan(t)
+        self.direction = direction
+        self.positions = np.flatnonzero(valid)  # sample index in the original series
+        self.t = t[valid]
+        self.delta = delta[valid]
+        self.t_end = t[~np.isnan(t)][-1] if (~np.isnan(t)).any() else np.nan
+
+        # levels of the step function, and the first crossing (valid sample position, -1 if none) between each pair
+        self._levels = np.unique(self.delta)
+        self._first = _paint_first_crossings(self.delta, self._levels, direction)
+
+    def __len__(self):
+        return len(self.delta)
+
+    '''
+    desc: first valid sample where the delta crosses each threshold
+    input: thresholds - scalar or array of thresholds
+    output: k - position in the valid samples of each crossing (-1 if never crossed), same shape as thresholds
+    '''
+    def _first_valid(self, thresholds):
+        x = np.asarray(thresholds, dtype=np.float64)
+        if len(self._levels) < 2:
+            return np.full(x.shape, -1, dtype=np.intp)
+        # up: levels[i] < x <= levels[i + 1], down: levels[i] <= x < levels[i + 1]
+        side = "left" if self.direction == "up" else "right"
+        i = np.searchsorted(self._levels, x, side=side) - 1
+        inside = (i >= 0) & (i < len(self._first))
+        return np.where(inside, self._first[np.clip(i, 0, len(self._first) - 1)], -1)
+
+    '''
+    desc: index of the first sample after each threshold is crossed
+    input: thresholds - scalar or array of thresholds
+    output: index in the original series (-1 if never crossed), same shape as thresholds
+    '''
+    def first_index(self, thresholds):
+        k = self._first_valid(thresholds)
+        return np.where(k >= 0, self.positions[np.maximum(k, 0)] if len(self) else -1, -1)
+
+    '''
+    desc: interpolated time where the delta first crosses each threshold
+    input: thresholds - scalar or array of thresholds
+    output: time (NaN if never crossed), same shape as thresholds
+    '''
+    def first_time(self, thresholds):
+        x = np.asarray(thresholds, dtype=np.float64)
+        k = self._first_valid(x)
+        if len(self) < 2:
+            return np.full(x.shape, np.nan)
+        hi = np.maximum(k, 1)
+        lo = hi - 1
+        d_lo, d_hi = self.delta[lo], self.delta[hi]
+        t_lo, t_hi = self.t[lo], self.t[hi]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing = t_lo + (x - d_lo) / (d_hi - d_lo) * (t_hi - t_lo)
+        return np.where(k >= 1, crossing, np.nan)
+
+'''
+desc: for each pair of neighbouring levels, the first sample where the delta crosses between them in the given direction.
+the sample pairs are painted onto the levels in order with a "next unpainted level" pointer so each level is only painted
+once (n log n overall)
+input: delta - valid delta samples
+       levels - sorted unique values of delta
+       direction - "up" or "down"
+output: first - first crossing sample for levels[i]..levels[i + 1] (-1 if it is never crossed)
+'''
+def _paint_first_crossings(delta, levels, direction):
+    first = np.full(max(len(levels) - 1, 0), -1, dtype=np.intp)
+    if len(first) == 0:
+        return first
+    rank = np.searchsorted(levels, delta)
+    step = np.diff(rank)
+    if direction == "up":
+        ks = np.flatnonzero(step > 0) + 1
+        lo, hi = rank[ks - 1], rank[ks]
+    else:
+        ks = np.flatnonzero(step < 0) + 1
+        lo, hi = rank[ks], rank[ks - 1]
+
+    next_free = np.arange(len(first) + 1)  # union-find over painted levels
+    def find(i):
+        root = i
+        while next_free[root] != root:
+            root = next_free[root]
+        while next_free[i] != root:
+            next_free[i], i = root, next_free[i]
+        return root
+
+    for k, a, b in zip(ks.tolist(), lo.tolist(), hi.tolist()):
+        i = find(a)
+        while i < b:
+            first[i] = k
+            next_free[i] = i + 1
+            i = find(i + 1)
+    return first
+
+'''
+desc: build the crossing indexes of the SHT40 and RH deltas of a compiled run
+input: dgo_data - dataframe of a compiled dgo run
+       smoothing - filter spec the deltas are smoothed with first (e.g. "ema:12", see filters), None for the raw deltas
+output: dict of signal ("SHT40", "RH") -> CrossingIndex, with time in minutes and the directions of SIGNAL_DIRECTIONS
+'''
+def build_run_index(dgo_data, smoothing=None):
+    with span("detect.build_index", rows=len(dgo_data)):
+        t_min = dgo_data["time"] / 60
+        deltas = {"SHT40": (dgo_data["Exhaust SHT40"] - dgo_data["Intake SHT40"]).to_numpy(dtype=np.float64),
+                  "RH": (dgo_data["Exhaust RH"] - dgo_data["Intake Air RH"]).to_numpy(dtype=np.float64)}
+        smoother = parse_filter(smoothing)
+        if smoother is not None:
+            deltas = {signal: smoother.batch(delta) for signal, delta in deltas.items()}
+        return {signal: CrossingIndex(t_min, delta, SIGNAL_DIRECTIONS[signal]) for signal, delta in deltas.items()}
+
+'''
+desc: crossing times of many runs for a whole vector of thresholds
+input: indexes - dict of run name -> output of build_run_index()
+       signal - "SHT40" or "RH"
+       thresholds - list/array of thresholds
+output: dataframe with one row per run and one column per threshold of the time the threshold is first crossed [min]
+'''
+def sweep(indexes, signal, thresholds):
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    with span("detect.sweep", rows=len(indexes) * len(thresholds)):
+        times = np.array([index[signal].first_time(thresholds) for index in indexes.values()])
+    times = times.reshape(-1, len(thresholds))
+    return pd.DataFrame(times, index=list(indexes.keys()), columns=thresholds)
+
+'''
+desc: stats table of the threshold crossing of each run (same columns as the dashboards)
+input: indexes - dict of run name -> output of build_run_index()
+       signal - "SHT40" or "RH"
+       threshold - threshold of the delta
+output: dataframe of name, runtime end, time @ threshold and diff. in time [min]
+'''
+def crossing_stats(indexes, signal, threshold):
+    names = list(indexes.keys())
+    t_end = np.array([index[signal].t_end for index in indexes.values()])
+    t_cross = sweep(indexes, signal, [threshold]).to_numpy()[:, 0]
+    return pd.DataFrame({"Name": names,
+                         "Runtime End": t_end,
+                         f"Time @ {signal} Threshold": t_cross,
+                         f"Diff. in Time ({signal})": t_end - t_cross})